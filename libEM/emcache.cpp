@@ -33,188 +33,295 @@
  * 
  * */
  
-#ifdef IMAGEIO_CACHE    
-// #define DEBUG_CACHE	1
- 
 #include "emcache.h"
 #include "imageio.h"
 #include "util.h"
 #include <stdio.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#ifndef WIN32
+#include <unistd.h>
 #include <pthread.h>
+#include <sys/time.h>
+#endif
 using namespace EMAN;
 
-void *thread_clean( void *ptr ) {
-    while (1) {
-        sleep(1);
-        GlobalCache::instance()->clean();
-    }
+static long current_pid()
+{
+#ifdef WIN32
+	return 0;
+#else
+	return (long)getpid();
+#endif
 }
-void thread_start() {
-    pthread_t thread1;
-    pthread_create(&thread1,NULL,&thread_clean,NULL);
+
+static bool file_stamp(const string & filename, time_t *mtime, long *size)
+{
+	struct stat st;
+	if (stat(filename.c_str(), &st) != 0) return false;
+	*mtime = st.st_mtime;
+	*size = (long)st.st_size;
+	return true;
 }
 
+// Cache key for filename, so different spellings of the same path (relative, absolute, through
+// symlinks) find the same handles. Files which can't be resolved, eg - not yet created, keep their name.
+static string cache_key(const string & filename)
+{
+#ifdef WIN32
+	char buf[_MAX_PATH];
+	if (_fullpath(buf, filename.c_str(), _MAX_PATH)) return string(buf);
+#else
+	char *path = realpath(filename.c_str(), 0);
+	if (path) {
+		string ret(path);
+		free(path);
+		return ret;
+	}
+#endif
+	return filename;
+}
+
+#ifndef WIN32
+static void fork_prepare() { GlobalCache::instance()->lock(); }
+static void fork_parent() { GlobalCache::instance()->unlock(); }
+static void fork_child() { GlobalCache::instance()->after_fork(); }
+#endif
 
 // GlobalCache
 GlobalCache *GlobalCache::global_cache = 0;
 
 GlobalCache::GlobalCache()
+	: max_handles(32), idle_timeout(30), tick(0), last_clean(0),
+	  nhit(0), nmiss(0), nopen(0), nevict(0), nexpire(0), nstale(0), open_time(0)
 {
-    // pthread_mutex_init(&mutex, NULL);
-    thread_start();
+	Util::MUTEX_INIT(&mutex);
+#ifndef WIN32
+	pthread_atfork(fork_prepare, fork_parent, fork_child);
+#endif
 }
 
 GlobalCache::~GlobalCache()
 {
-    clean();
-    pthread_mutex_destroy(&mutex);
+	clean(true);
 }
 
 GlobalCache *GlobalCache::instance()
 {
-	if (!global_cache) {
-		global_cache = new GlobalCache();
-	}
+	// never destroyed, so no handles are closed after the format libraries have shut down
+	static GlobalCache *cache = new GlobalCache();
+	global_cache = cache;
 	return global_cache;
 }
 
-ImageIO *GlobalCache::get_imageio(const string & filename, int rw)
+void GlobalCache::lock()
 {
-    pthread_mutex_lock(&mutex);
-#ifdef DEBUG_CACHE
-    printf("get_imageio: filename: %s, rw: %d\n", filename.c_str(), rw);
-#endif
+	Util::MUTEX_LOCK(&mutex);
+}
 
-    if (file_imageio.count(filename) == 0) {
-        // printf("get_imageio: no cached imageio!\n");
-        pthread_mutex_unlock(&mutex);
-        return 0;        
-    }     
-    
-    ImageIO *io = file_imageio[filename];    
-#ifdef DEBUG_CACHE
-    printf("get_imageio:      found cached; refs: %d, current rw: %d, request rw: %d\n", file_ref[filename], file_rw[filename], rw);
-#endif
-    time_t t = time(0);
-    file_time[filename] = time(0);
-    // printf("get_imageio:      updated time\n");
-    if (file_rw[filename] == rw) {
-        // current == request
-        file_ref[filename]++;
-        // printf("get_imageio:      ref += 1 to %d\n", file_ref[filename]);
-    } else if (file_rw[filename] == 2 && rw == 1) {
-        // current == read_write, request == read
-        file_ref[filename]++;
-        // printf("get_imageio:      ref += 1 to %d (passing write mode to read request)\n", file_ref[filename]);
-    } else if (file_ref[filename] == 0) {
-        // current != request, no open handles
-        // printf("get_imageio:      re-opening in mode %d\n", rw);
-        this->delete_imageio(filename);
-        io = 0;        
-    } else {
-        // current != request, open handles
-        // current is read, request is write -- we can't make this change with open handles. How to fail?
-        file_ref[filename]++;
-        printf("GlobalCache::get_imageio: %s: Cannot switch mode %d to %d with open references!\n", filename.c_str(), file_rw[filename], rw);
-    }
-    pthread_mutex_unlock(&mutex);
-    return io;
-}
-
-void GlobalCache::delete_imageio(const string & filename) {
-    // Lock acquired in caller
-    if (file_imageio.count(filename) == 0) {
-        // printf("delete_imageio: Not in cache\n");
-    } else if (file_ref[filename] == 0) {
-        ImageIO *io = file_imageio[filename];
-        file_imageio.erase(filename);
-        delete io;
-    }
-}
-
-void GlobalCache::close_imageio(const string & filename) {
-    pthread_mutex_lock(&mutex);
-#ifdef DEBUG_CACHE
-    printf("close_imageio: filename: %s\n", filename.c_str());
-#endif
-    if (file_imageio.count(filename) > 0) {
-        ImageIO *io = file_imageio[filename];
-        // Decrement the reference and update the access time.
-        file_ref[filename]--;
-        file_time[filename] = time(0);
-        // printf("close_imageio:      ref -= 1 to %d\n", file_ref[filename]);
-        if (file_ref[filename] == 0 && file_persist[filename] == 0) {
-            // printf("close_imageio:      auto closing!\n");
-            this->delete_imageio(filename);
-        }
-    } else {
-        // printf("close_imageio:      No ImageIO to close!\n");
-    }
-    pthread_mutex_unlock(&mutex);
-}
-
-void GlobalCache::add_imageio(const string & filename, int rw, int persist, ImageIO * io)
-{
-    pthread_mutex_lock(&mutex);    
-#ifdef DEBUG_CACHE
-    printf("add_imageio: filename %s, rw %d, persist %d\n", filename.c_str(), rw, persist);
-#endif
-    if (file_imageio.count(filename) > 0) {
-        // Todo: How to handle error if file is already in cache?
-        // printf("File already in cache.")
-    } else if (io && persist > 0) {
-        // Todo: Make a class to hold all these values and the ImageIO.
-        file_imageio[filename] = io;
-        file_ref[filename] = 1;
-		file_rw[filename] = rw;
-        file_time[filename] = time(0);
-        file_persist[filename] = persist;
+void GlobalCache::unlock()
+{
+	Util::MUTEX_UNLOCK(&mutex);
+}
+
+void GlobalCache::after_fork()
+{
+	// The child inherits the parent's descriptors, which share their file offsets with the
+	// parent, so it must not reuse any cached handle. They are abandoned (by pid) on next use.
+	Util::MUTEX_UNLOCK(&mutex);
+}
+
+ImageIO *GlobalCache::get_imageio(const string & name, int rw)
+{
+	if (rw != ImageIO::READ_ONLY) return 0;
+	string filename = cache_key(name);
+
+	lock();
+	clean_locked(false);
+
+	ImageIO *io = 0;
+	time_t mtime = 0;
+	long size = 0;
+	bool exists = file_stamp(filename, &mtime, &size);
+
+	multimap < string, CacheEntry >::iterator it = idle.find(filename);
+	while (it != idle.end() && it->first == filename) {
+		multimap < string, CacheEntry >::iterator cur = it++;
+		if (cur->second.pid != current_pid()) {
+			delete_entry(cur);
+			continue;
+		}
+		if (!exists || cur->second.mtime != mtime || cur->second.size != size) {
+			nstale++;
+			delete_entry(cur);
+			continue;
+		}
+		io = cur->second.io;
+		cur->second.atime = time(0);
+		inuse[io] = cur->second;
+		idle.erase(cur);
+		break;
 	}
-    pthread_mutex_unlock(&mutex);
+
+	if (io) nhit++;
+	else nmiss++;
+	unlock();
+
+	return io;
 }
 
-int GlobalCache::contains(const string & filename) {
-    pthread_mutex_lock(&mutex);
-    int ret = 0;
-    if (file_imageio.count(filename) > 0) {
-        ret = 1;
-    }
-    pthread_mutex_unlock(&mutex);    
-    return ret;
+void GlobalCache::add_imageio(const string & name, int rw, ImageIO * io, double opentime)
+{
+	string filename = cache_key(name);
+	lock();
+	nopen++;
+	open_time += opentime;
+
+	if (io && rw == ImageIO::READ_ONLY && max_handles > 0) {
+		CacheEntry e;
+		e.filename = filename;
+		e.io = io;
+		e.rw = rw;
+		e.mtime = 0;
+		e.size = 0;
+		file_stamp(filename, &e.mtime, &e.size);
+		e.atime = time(0);
+		e.tick = 0;
+		e.pid = current_pid();
+		inuse[io] = e;
+	}
+	unlock();
 }
 
-void GlobalCache::clean() {
-    pthread_mutex_lock(&mutex);    
-#ifdef DEBUG_CACHE
-    printf("clean: %ld items in cache\n", file_imageio.size());
-#endif
-    
-    // Find cached items to close
-    vector<string> toclose;
-    time_t now = time(0);
-    int seconds;
-    string filename;
-    for (map<string, ImageIO*>::iterator iter=file_imageio.begin(); iter!=file_imageio.end(); ++iter) {
-        filename = iter->first;
-        seconds = int(difftime(now, file_time[filename]));
-#ifdef DEBUG_CACHE
-        printf("clean:       filename: %s, rw: %d, ref: %d, last access: %d, persist: %d\n", filename.c_str(), file_rw[filename], file_ref[filename], seconds, file_persist[filename]);
-#endif
-        if (seconds >= file_persist[filename]) {
-            // printf("clean:      marking to close %s...\n", filename.c_str());
-            toclose.push_back(filename);
-        }
-    }
-    
-    // Close the selected items
-    for(vector<string>::iterator iter=toclose.begin(); iter!=toclose.end(); iter++) {
-        filename = *iter;
-        // printf("clean: closing %s...\n", filename.c_str());        
-        this->delete_imageio(filename);
-    }
-    
-    pthread_mutex_unlock(&mutex);
-}
-
-#endif // IMAGEIO_CACHE
+bool GlobalCache::close_imageio(const string & name, const ImageIO * io)
+{
+	if (!io) return true;
+	string filename = cache_key(name);
 
+	lock();
+	map < const ImageIO*, CacheEntry >::iterator it = inuse.find(io);
+	if (it == inuse.end() || it->second.filename != filename) {
+		unlock();
+		return false;
+	}
+
+	CacheEntry e = it->second;
+	inuse.erase(it);
+
+	// a handle opened before a fork() shares its file offset with the other process, so it is
+	// abandoned rather than closed (closing a stdio stream may reposition the shared offset)
+	if (e.pid != current_pid()) {
+		unlock();
+		return true;
+	}
+	if (max_handles <= 0) {
+		unlock();
+		return false;
+	}
+
+	e.atime = time(0);
+	e.tick = ++tick;
+	idle.insert(std::make_pair(filename, e));
+	evict(max_handles);
+
+	unlock();
+	return true;
+}
+
+void GlobalCache::invalidate(const string & name)
+{
+	string filename = cache_key(name);
+	lock();
+	multimap < string, CacheEntry >::iterator it = idle.find(filename);
+	while (it != idle.end() && it->first == filename) {
+		multimap < string, CacheEntry >::iterator cur = it++;
+		delete_entry(cur);
+	}
+	unlock();
+}
+
+void GlobalCache::delete_entry(multimap < string, CacheEntry >::iterator it)
+{
+	// Lock acquired in caller
+	// handles inherited through fork() are abandoned, see close_imageio
+	if (it->second.pid == current_pid()) delete it->second.io;
+	idle.erase(it);
+}
+
+void GlobalCache::evict(int keep)
+{
+	// Lock acquired in caller
+	// closes the least recently used idle handles until at most keep remain
+	if (keep < 0) keep = 0;
+	while ((int)idle.size() > keep) {
+		multimap < string, CacheEntry >::iterator oldest = idle.begin();
+		for (multimap < string, CacheEntry >::iterator i = idle.begin(); i != idle.end(); ++i) {
+			if (i->second.tick < oldest->second.tick) oldest = i;
+		}
+		nevict++;
+		delete_entry(oldest);
+	}
+}
+
+void GlobalCache::clean(bool all)
+{
+	lock();
+	clean_locked(all);
+	unlock();
+}
+
+void GlobalCache::clean_locked(bool all)
+{
+	// Lock acquired in caller
+	time_t now = time(0);
+	if (!all && now == last_clean) return;
+	last_clean = now;
+
+	long pid = current_pid();
+	multimap < string, CacheEntry >::iterator it = idle.begin();
+	while (it != idle.end()) {
+		multimap < string, CacheEntry >::iterator cur = it++;
+		if (all || cur->second.pid != pid) delete_entry(cur);
+		else if (difftime(now, cur->second.atime) >= idle_timeout) {
+			nexpire++;
+			delete_entry(cur);
+		}
+	}
+}
+
+void GlobalCache::set_params(int maxhandles, int timeout)
+{
+	lock();
+	max_handles = maxhandles;
+	idle_timeout = timeout;
+	evict(max_handles);
+	unlock();
+}
+
+Dict GlobalCache::get_stats()
+{
+	lock();
+	Dict ret;
+	ret["max_handles"] = max_handles;
+	ret["idle_timeout"] = idle_timeout;
+	ret["idle"] = (int)idle.size();
+	ret["in_use"] = (int)inuse.size();
+	ret["hits"] = (int)nhit;
+	ret["misses"] = (int)nmiss;
+	ret["opens"] = (int)nopen;
+	ret["evictions"] = (int)nevict;
+	ret["expired"] = (int)nexpire;
+	ret["stale"] = (int)nstale;
+	ret["open_time"] = open_time;
+	unlock();
+	return ret;
+}
+
+void GlobalCache::reset()
+{
+	lock();
+	clean_locked(true);
+	nhit = nmiss = nopen = nevict = nexpire = nstale = 0;
+	open_time = 0;
+	unlock();
+}
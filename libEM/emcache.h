@@ -34,40 +34,99 @@
  * */
  
 
-#ifdef IMAGEIO_CACHE    
 #ifndef eman__emcache__h__
 #define eman__emcache__h__ 1
 
 #include <cstdlib>
+#include <ctime>
 #include <string>
 #include <map>
+#include "emobject.h"
+#include "util.h"
 using std::string;
 using std::map;
+using std::multimap;
 
 namespace EMAN
 {
 	class ImageIO;
 
-	/* GlobalCache is a Singleton class that handles cache across EMAN. */
+	/** GlobalCache is a Singleton class that keeps recently used read-only ImageIO objects open
+	 * so repeated reads from the same file (of any format, including the files referenced by .lst
+	 * files) don't need to reopen the file and reparse its header each time.
+	 *
+	 * Handles are checked out exclusively by get_imageio() and returned by close_imageio(), so a
+	 * cached handle is never used by two threads at once. At most max_handles idle handles are kept,
+	 * the least recently used being closed first, and idle handles are closed after idle_timeout
+	 * seconds. A cached handle is discarded if the file's size or modification time has changed,
+	 * when the file is opened for writing, and in a child process after fork(). Files are keyed
+	 * by their canonical path, so any spelling of a file's path finds its handles.
+	 */
 	class GlobalCache
 	{
 	  public:
 		static GlobalCache *instance();
+
+		/** Returns an idle cached handle for filename, checked out to the caller, or 0 if
+		 * there is none. Only READ_ONLY handles are cached. */
 		ImageIO *get_imageio(const string & filename, int rw);
-        int contains(const string & filename);
-		void add_imageio(const string & filename, int rw, int persist, ImageIO * io);
-        void close_imageio(const string & filename);
-        void delete_imageio(const string & filename);
-        void clean();
+
+		/** Records a newly opened handle. opentime is the time spent opening it, in seconds. */
+		void add_imageio(const string & filename, int rw, ImageIO * io, double opentime);
+
+		/** Returns a handle to the cache. If this returns false, the handle was not
+		 * cached, and the caller must delete it. */
+		bool close_imageio(const string & filename, const ImageIO * io);
+
+		/** Closes any idle handles for filename, eg - before it is opened for writing. */
+		void invalidate(const string & filename);
+
+		/** Closes idle handles which have timed out, or all idle handles if all is set. */
+		void clean(bool all=false);
+
+		/** Sets the maximum number of idle handles (0 disables caching) and the idle timeout in seconds */
+		void set_params(int maxhandles, int timeout);
+
+		/** Returns a Dict with the current parameters and the hit/miss/open/eviction counters.
+		 * open_time is the total time in seconds spent opening files. */
+		Dict get_stats();
+
+		/** Closes all idle handles and zeroes the counters */
+		void reset();
+
+		/** Used by the fork handlers */
+		void lock();
+		void unlock();
+		void after_fork();
 
 	  private:
-        pthread_mutex_t mutex;          
+		struct CacheEntry {
+			string filename;
+			ImageIO *io;
+			int rw;
+			time_t mtime;
+			long size;
+			time_t atime;
+			unsigned long tick;
+			long pid;
+		};
+
+		MUTEX mutex;
 		static GlobalCache *global_cache;
-		map < string, ImageIO* >file_imageio;
-		map < string, int >file_rw;
-        map < string, int >file_ref;
-        map < string, int >file_time;
-        map < string, int >file_persist;
+		multimap < string, CacheEntry > idle;			// handles available for checkout
+		map < const ImageIO*, CacheEntry > inuse;		// cacheable handles currently checked out
+
+		int max_handles;
+		int idle_timeout;
+		unsigned long tick;
+		time_t last_clean;
+
+		long nhit, nmiss, nopen, nevict, nexpire, nstale;
+		double open_time;
+
+		void delete_entry(multimap < string, CacheEntry >::iterator it);
+		void evict(int keep);
+		void clean_locked(bool all);
 
 		GlobalCache();
 		~GlobalCache();
@@ -77,4 +136,3 @@ namespace EMAN
 }
 
 #endif // Header check
-#endif // IMAGEIO_CACHE
@@ -34,6 +34,7 @@
  * */
 
 #include <iomanip>
+#include <algorithm>
 
 #include "emdata.h"
 #include "all_imageio.h"
@@ -421,19 +422,33 @@ vector < shared_ptr<EMData> > EMData::read_images(const string & filename, vecto
 
 	size_t n = (num_img == 0 ? total_img : num_img);
 
-	vector< shared_ptr<EMData> > v;
+	// Stacks store images in index order, so reading in ascending index order
+	// keeps the file access sequential even when the request is scattered.
+	// Each image is then placed back at its requested position.
+	vector< std::pair<int,size_t> > order(n);
 	for (size_t j = 0; j < n; j++) {
+		order[j] = std::pair<int,size_t>(num_img == 0 ? (int)j : img_indices[j], j);
+	}
+	std::sort(order.begin(), order.end());
+
+	vector< shared_ptr<EMData> > v(n);
+	for (size_t j = 0; j < n; j++) {
+		// repeated indices share a single read
+		if (j > 0 && order[j].first == order[j-1].first) {
+			v[order[j].second] = shared_ptr<EMData>(new EMData(*v[order[j-1].second]));
+			continue;
+		}
+
 		shared_ptr<EMData> d(new EMData());
-		size_t k = (num_img == 0 ? j : img_indices[j]);
 		try {
-			d->read_image(filename, (int)k, header_only);
+			d->read_image(filename, order[j].first, header_only);
 		}
 		catch(E2Exception &e) {
 			throw(e);
 		}
 		if ( d != 0 )
 		{
-			v.push_back(d);
+			v[order[j].second] = d;
 		}
 		else
 			throw ImageReadException(filename, "imageio read data failed");
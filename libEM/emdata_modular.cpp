@@ -39,6 +39,7 @@
 #include "aligner.h"
 #include "projector.h"
 #include "analyzer.h"
+#include "pluginstats.h"
 
 using namespace EMAN;
 
@@ -47,7 +48,10 @@ void EMData::process_inplace(const string & processorname, const Dict & params)
 	ENTERFUNC;
 	Processor *f = Factory < Processor >::get(processorname, params);
 	if (f) {
-		f->process_inplace(this);
+		{
+			PluginTimer timer("processor", f, this);
+			f->process_inplace(this);
+		}
 		if( f )
 		{
 			delete f;
@@ -61,6 +65,7 @@ void EMData::process_inplace(Processor * p)
 {
 	ENTERFUNC;
 	if(p) {
+		PluginTimer timer("processor", p, this);
 		p->process_inplace(this);
 	}
 	EXITFUNC;
@@ -72,7 +77,10 @@ EMData* EMData::process(const string & processorname, const Dict & params) const
 	Processor *f = Factory < Processor >::get(processorname, params);
 	EMData * result = 0;
 	if (f) {
-		result = f->process(this);
+		{
+			PluginTimer timer("processor", f, this);
+			result = f->process(this);
+		}
 		if( f )
 		{
 			delete f;
@@ -88,6 +96,7 @@ EMData * EMData::process(Processor * p) const
 	ENTERFUNC;
 	EMData * result = 0;
 	if(p) {
+		PluginTimer timer("processor", p, this);
 		result = p->process(this);
 	}
 	return result;
@@ -100,7 +109,10 @@ float EMData::cmp(const string & cmpname, EMData * with, const Dict & params)
 	float result = 0;
 	Cmp *c = Factory < Cmp >::get(cmpname, params);
 	if (c) {
-		result = c->cmp(this, with);
+		{
+			PluginTimer timer("cmp", c, this);
+			result = c->cmp(this, with);
+		}
 		if( c )
 		{
 			delete c;
@@ -120,11 +132,14 @@ EMData *EMData::align(const string & aligner_name, EMData * to_img,
 	EMData *result = 0;
 	Aligner *a = Factory < Aligner >::get(aligner_name, params);
 	if (a) {
-		if (cmp_name == "") {
-			result = a->align(this, to_img);
-		}
-		else {
-			result = a->align(this, to_img, cmp_name, cmp_params);
+		{
+			PluginTimer timer("aligner", a, this);
+			if (cmp_name == "") {
+				result = a->align(this, to_img);
+			}
+			else {
+				result = a->align(this, to_img, cmp_name, cmp_params);
+			}
 		}
 		if( a )
 		{
@@ -145,6 +160,7 @@ vector<Dict> EMData::xform_align_nbest(const string & aligner_name, EMData * to_
 	Aligner *a = Factory < Aligner >::get(aligner_name, params);
 	vector<Dict> result;
 	if (a) {
+		PluginTimer timer("aligner", a, this);
 		result = a->xform_align_nbest(this,to_img,nsoln,cmp_name,cmp_params);
 	}
 
@@ -157,7 +173,10 @@ EMData *EMData::project(const string & projector_name, const Dict & params)
 	EMData *result = 0;
 	Projector *p = Factory < Projector >::get(projector_name, params);
 	if (p) {
-		result = p->project3d(this);
+		{
+			PluginTimer timer("projector", p, this);
+			result = p->project3d(this);
+		}
 		if( p )
 		{
 			delete p;
@@ -178,7 +197,10 @@ EMData *EMData::project(const string & projector_name, const Transform & t3d)
 	params["transform"] = (Transform*) &t3d;
 	Projector *p = Factory < Projector >::get(projector_name, params);
 	if (p) {
-		result = p->project3d(this);
+		{
+			PluginTimer timer("projector", p, this);
+			result = p->project3d(this);
+		}
 		if( p )
 		{
 			delete p;
@@ -196,7 +218,10 @@ EMData *EMData::backproject(const string & projector_name, const Dict & params)
 	EMData *result = 0;
 	Projector *p = Factory < Projector >::get(projector_name, params);
 	if (p) {
-		result = p->backproject3d(this);
+		{
+			PluginTimer timer("projector", p, this);
+			result = p->backproject3d(this);
+		}
 		if( p )
 		{
 			delete p;
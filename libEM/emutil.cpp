@@ -38,6 +38,7 @@
 	#define MAXPATHLEN (MAX_PATH*4)
 #else
 #include <sys/param.h>
+#include <sys/time.h>
 #endif	// WIN32
 
 #include "all_imageio.h"
@@ -58,6 +59,18 @@ using boost::shared_ptr;
 
 using namespace EMAN;
 
+// wall clock time in seconds, used to account for time spent opening files
+static double io_wall_time()
+{
+#ifdef WIN32
+	return (double)clock()/CLOCKS_PER_SEC;
+#else
+	struct timeval tv;
+	gettimeofday(&tv, NULL);
+	return tv.tv_sec + tv.tv_usec*1.0e-6;
+#endif
+}
+
 static const int ATTR_NAME_LEN = 128;
 
 EMUtil::ImageType EMUtil::get_image_ext_type(const string & file_ext)
@@ -560,14 +573,19 @@ ImageIO *EMUtil::get_imageio(const string & filename, int rw,
 		   rw == ImageIO::WRITE_ONLY);
 
 	ImageIO *imageio = 0;
-   int persist = 0;
 
-   #ifdef IMAGEIO_CACHE
-   imageio = GlobalCache::instance()->get_imageio(filename, rw);
-   if (imageio) {
-    	return imageio;
-   }
-   #endif
+	if (rw == ImageIO::READ_ONLY) {
+		imageio = GlobalCache::instance()->get_imageio(filename, rw);
+		if (imageio) {
+			return imageio;
+		}
+	}
+	else {
+		// cached readers would not see what is written
+		GlobalCache::instance()->invalidate(filename);
+	}
+
+	double t0 = io_wall_time();
 
 	ImageIO::IOMode rw_mode = static_cast < ImageIO::IOMode > (rw);
 
@@ -610,10 +628,6 @@ ImageIO *EMUtil::get_imageio(const string & filename, int rw,
 #endif
 #ifdef EM_HDF5
 	case IMAGE_HDF:
-        persist = 30;
-        if (rw_mode != ImageIO::READ_ONLY) {
-            persist = 3;
-        }
 		imageio = new HdfIO2(filename, rw_mode);
 		if (((HdfIO2 *)imageio)->init_test()==-1) {
 			delete imageio;
@@ -689,11 +703,7 @@ ImageIO *EMUtil::get_imageio(const string & filename, int rw,
 		break;
 	}
 
-   #ifdef IMAGEIO_CACHE
-	if (persist > 0) {
-		GlobalCache::instance()->add_imageio(filename, rw, persist, imageio);
-	}
-   #endif
+	GlobalCache::instance()->add_imageio(filename, rw, imageio, io_wall_time() - t0);
 
 	EXITFUNC;
 
@@ -702,16 +712,31 @@ ImageIO *EMUtil::get_imageio(const string & filename, int rw,
 
 void EMUtil::close_imageio(const string & filename, const ImageIO * io)
 {
-    //printf("EMUtil::close_imageio\n");
-    #ifdef IMAGEIO_CACHE
-    if (GlobalCache::instance()->contains(filename)) {
-        GlobalCache::instance()->close_imageio(filename);
-    } else {
-        delete io;
-    }
-    #else
-    delete io;
-    #endif
+	// an idle handle must not keep a referenced file open, or invalidate() could
+	// not close that file before it is opened for writing
+	if (io) {
+		const_cast<ImageIO *>(io)->release_refs();
+	}
+
+	// read-only handles go back to the cache, anything else is closed
+	if (!GlobalCache::instance()->close_imageio(filename, io)) {
+		delete io;
+	}
+}
+
+void EMUtil::set_imageio_cache(int max_handles, int idle_timeout)
+{
+	GlobalCache::instance()->set_params(max_handles, idle_timeout);
+}
+
+Dict EMUtil::get_imageio_cache_stats()
+{
+	return GlobalCache::instance()->get_stats();
+}
+
+void EMUtil::reset_imageio_cache()
+{
+	GlobalCache::instance()->reset();
 }
 
 const char *EMUtil::get_imagetype_name(ImageType t)
@@ -1941,6 +1966,9 @@ int EMUtil::write_hdf_attribute(const string & filename, const string & key, EMO
 		throw ImageFormatException("This function only applies to HDF5 file.");
 	}
 
+	// HDF5 refuses to open a file for writing while a cached read-only handle holds it
+	GlobalCache::instance()->invalidate(filename);
+
 	HdfIO2* imageio = new HdfIO2(filename, ImageIO::WRITE_ONLY);
 	imageio->init();
 
@@ -1975,6 +2003,9 @@ int EMUtil::delete_hdf_attribute(const string & filename, const string & key, in
 		throw ImageFormatException("This function only applies to HDF5 file.");
 	}
 
+	// HDF5 refuses to open a file for writing while a cached read-only handle holds it
+	GlobalCache::instance()->invalidate(filename);
+
 	HdfIO2* imageio = new HdfIO2(filename, ImageIO::READ_WRITE);
 	imageio->init();
 
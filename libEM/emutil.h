@@ -183,6 +183,20 @@ namespace EMAN
       /** Ian: Close ImageIO object*/
       static void close_imageio(const string & filename, const ImageIO * io);
 
+		/** Set the size of the ImageIO handle cache. Up to max_handles idle read-only
+		 * handles are kept open, each for at most idle_timeout seconds. max_handles=0
+		 * disables the cache.
+		 */
+		static void set_imageio_cache(int max_handles, int idle_timeout);
+
+		/** Get the ImageIO handle cache parameters and hit/miss/open counters.
+		 * @return A Dict including hits, misses, opens, evictions and open_time (seconds).
+		 */
+		static Dict get_imageio_cache_stats();
+
+		/** Close all idle cached ImageIO handles and zero the counters. */
+		static void reset_imageio_cache();
+
 		/** Give each image type a meaningful name.
 		 * @param type Image format type.
 		 * @return A name for that type.
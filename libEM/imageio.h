@@ -219,6 +219,12 @@ namespace EMAN
 		/** Return the number of images in this image file. */
 		virtual int get_nimg();
 
+		/** Release any other ImageIO held by this one, eg - the file referenced
+		 * by an .lst file. Called before a handle is returned to the ImageIO
+		 * cache, so an idle cached handle never keeps another file open.
+		 */
+		virtual void release_refs() {}
+
 		/** Is this an complex image or not. */
 		virtual bool is_complex_mode() = 0;
 
@@ -71,11 +71,24 @@ LstFastIO::~LstFastIO()
 		fclose(lst_file);
 		lst_file = 0;
 	}
-	ref_filename = "";
 	if(imageio) {
-		delete imageio;
+		EMUtil::close_imageio(ref_filename, imageio);
+		imageio = 0;
+	}
+	ref_filename = "";
+}
+
+void LstFastIO::release_refs()
+{
+	if (imageio) {
+		EMUtil::close_imageio(ref_filename, imageio);
 		imageio = 0;
 	}
+	ref_filename = "";
+
+	// the next read must look up its record and reopen the referenced file
+	last_lst_index = -1;
+	last_ref_index = -1;
 }
 
 void LstFastIO::init()
@@ -182,9 +195,16 @@ int LstFastIO::calc_ref_image_index(int image_index)
 // 			}
 // 		}
 
-		ref_filename = string(fullpath);
-		if (!Util::is_file_exist(ref_filename)) throw FileAccessException(ref_filename);
-		imageio = EMUtil::get_imageio(ref_filename, rw_mode);
+		// consecutive records usually reference the same file, so keep its ImageIO open
+		if (!imageio || ref_filename != string(fullpath)) {
+			if (imageio) {
+				EMUtil::close_imageio(ref_filename, imageio);
+				imageio = 0;
+			}
+			ref_filename = string(fullpath);
+			if (!Util::is_file_exist(ref_filename)) throw FileAccessException(ref_filename);
+			imageio = EMUtil::get_imageio(ref_filename, rw_mode);
+		}
 
 		last_ref_index = ref_image_index;
 	}
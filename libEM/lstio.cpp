@@ -71,11 +71,27 @@ LstIO::~LstIO()
 		fclose(lst_file);
 		lst_file = 0;
 	}
-	ref_filename = "";
 	if(imageio) {
-		delete imageio;
+		EMUtil::close_imageio(ref_filename, imageio);
+		imageio = 0;
+	}
+	ref_filename = "";
+}
+
+void LstIO::release_refs()
+{
+	if (imageio) {
+		EMUtil::close_imageio(ref_filename, imageio);
 		imageio = 0;
 	}
+	ref_filename = "";
+
+	// the next read must look up its record and reopen the referenced file
+	if (last_lst_index != -1 && lst_file) {
+		rewind(lst_file);		// calc_ref_image_index reads forward from the last record
+	}
+	last_lst_index = -1;
+	last_ref_index = -1;
 }
 
 void LstIO::init()
@@ -190,8 +206,15 @@ int LstIO::calc_ref_image_index(int image_index)
 // 			}
 // 		}
 
-		ref_filename = string(fullpath);
-		imageio = EMUtil::get_imageio(ref_filename, rw_mode);
+		// consecutive records usually reference the same file, so keep its ImageIO open
+		if (!imageio || ref_filename != string(fullpath)) {
+			if (imageio) {
+				EMUtil::close_imageio(ref_filename, imageio);
+				imageio = 0;
+			}
+			ref_filename = string(fullpath);
+			imageio = EMUtil::get_imageio(ref_filename, rw_mode);
+		}
 
 		last_ref_index = ref_image_index;
 	}
@@ -60,6 +60,7 @@ namespace EMAN
 			return false;
 		}
 		int get_nimg();
+		void release_refs();
 	  private:
 		string filename;
 		IOMode rw_mode;
@@ -0,0 +1,195 @@
+/**
+ * $Id$
+ */
+ 
+/*
+ * Plugin call statistics, added 10/19/2026
+ * Copyright (c) 2026 Baylor College of Medicine
+ * 
+ * This software is issued under a joint BSD/GNU license. You may use the
+ * source code in this file under either license. However, note that the
+ * complete EMAN2 and SPARX software packages have some GPL dependencies,
+ * so you are responsible for compliance with the licenses of these packages
+ * if you opt to use BSD licensing. The warranty disclaimer below holds
+ * in either instance.
+ * 
+ * This complete copyright notice must be included in any revised version of the
+ * source code. Additional authorship citations may be added, but existing
+ * author citations must be preserved.
+ * 
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ * 
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+ * 
+ * */
+ 
+#include "pluginstats.h"
+#include "emdata.h"
+#include "util.h"
+#include <map>
+#include <algorithm>
+#include <cstdlib>
+#include <ctime>
+#ifndef WIN32
+#include <sys/time.h>
+#endif
+using namespace EMAN;
+using std::map;
+
+bool PluginStats::enabled = (getenv("EMAN2PLUGINSTATS") != 0);
+
+namespace {
+	struct CallStats {
+		string kind;
+		string name;
+		string params;
+		long calls;
+		double total;
+		double max;
+		double voxels;
+		int nx, ny, nz;
+
+		CallStats() : calls(0), total(0), max(0), voxels(0), nx(0), ny(0), nz(0) {}
+	};
+
+	map<string, CallStats> stats;
+	map<string, int> parmsets;		// number of distinct parameter sets seen for each kind/name
+	MUTEX stats_mutex;
+
+	// initialized when the library is loaded, before any threads can record
+	struct MutexInit {
+		MutexInit() { Util::MUTEX_INIT(&stats_mutex); }
+	} mutex_init;
+
+	string parm_string(const Dict & params)
+	{
+		string ret;
+		vector<string> keys = params.keys();
+		for (size_t i = 0; i < keys.size(); i++) {
+			EMObject val = params[keys[i]];
+			if (i > 0) ret += ",";
+			ret += keys[i] + "=";
+			switch (val.get_type()) {
+			case EMObject::BOOL:
+			case EMObject::SHORT:
+			case EMObject::UNSIGNEDINT:
+			case EMObject::INT:
+			case EMObject::FLOAT:
+			case EMObject::DOUBLE:
+			case EMObject::STRING:
+				ret += val.to_str();
+				break;
+			default:
+				ret += "<" + EMObject::get_object_type_name(val.get_type()) + ">";
+			}
+		}
+		return ret;
+	}
+
+	bool by_total(const CallStats *a, const CallStats *b)
+	{
+		return a->total > b->total;
+	}
+}
+
+double PluginStats::now()
+{
+#ifdef WIN32
+	return (double)clock()/CLOCKS_PER_SEC;
+#else
+	struct timeval tv;
+	gettimeofday(&tv, NULL);
+	return tv.tv_sec + tv.tv_usec*1.0e-6;
+#endif
+}
+
+void PluginStats::record(const char *kind, const string & name, const Dict & params, const EMData * image, double seconds)
+{
+	string pstr = parm_string(params);
+	string pname = string(kind) + ":" + name;
+	string key = pname + ":" + pstr;
+
+	Util::MUTEX_LOCK(&stats_mutex);
+	map<string, CallStats>::iterator it = stats.find(key);
+	if (it == stats.end()) {
+		if (parmsets[pname] >= MAX_PARMSETS) {
+			pstr = "...";
+			key = pname + ":" + pstr;
+			it = stats.find(key);
+		}
+		else parmsets[pname]++;
+		if (it == stats.end()) {
+			CallStats cs;
+			cs.kind = kind;
+			cs.name = name;
+			cs.params = pstr;
+			it = stats.insert(std::make_pair(key, cs)).first;
+		}
+	}
+
+	CallStats & cs = it->second;
+	cs.calls++;
+	cs.total += seconds;
+	if (seconds > cs.max) cs.max = seconds;
+	if (image) {
+		double vox = (double)image->get_xsize()*image->get_ysize()*image->get_zsize();
+		cs.voxels += vox;
+		if (vox > (double)cs.nx*cs.ny*cs.nz) {
+			cs.nx = image->get_xsize();
+			cs.ny = image->get_ysize();
+			cs.nz = image->get_zsize();
+		}
+	}
+	Util::MUTEX_UNLOCK(&stats_mutex);
+}
+
+vector<Dict> PluginStats::get()
+{
+	vector<Dict> ret;
+	Util::MUTEX_LOCK(&stats_mutex);
+	vector<const CallStats *> srt;
+	for (map<string, CallStats>::const_iterator it = stats.begin(); it != stats.end(); ++it) srt.push_back(&it->second);
+	std::sort(srt.begin(), srt.end(), by_total);
+
+	for (size_t i = 0; i < srt.size(); i++) {
+		const CallStats & cs = *srt[i];
+		Dict d;
+		d["kind"] = cs.kind;
+		d["name"] = cs.name;
+		d["params"] = cs.params;
+		d["calls"] = (int)cs.calls;
+		d["total"] = cs.total;
+		d["mean"] = cs.total/cs.calls;
+		d["max"] = cs.max;
+		d["nx"] = cs.nx;
+		d["ny"] = cs.ny;
+		d["nz"] = cs.nz;
+		d["mean_voxels"] = cs.voxels/cs.calls;
+		ret.push_back(d);
+	}
+	Util::MUTEX_UNLOCK(&stats_mutex);
+	return ret;
+}
+
+void PluginStats::reset()
+{
+	Util::MUTEX_LOCK(&stats_mutex);
+	stats.clear();
+	parmsets.clear();
+	Util::MUTEX_UNLOCK(&stats_mutex);
+}
+
+void PluginStats::set_enabled(bool enable)
+{
+	enabled = enable;
+}
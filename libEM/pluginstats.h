@@ -0,0 +1,119 @@
+/**
+ * $Id$
+ */
+ 
+/*
+ * Plugin call statistics, added 10/19/2026
+ * Copyright (c) 2026 Baylor College of Medicine
+ * 
+ * This software is issued under a joint BSD/GNU license. You may use the
+ * source code in this file under either license. However, note that the
+ * complete EMAN2 and SPARX software packages have some GPL dependencies,
+ * so you are responsible for compliance with the licenses of these packages
+ * if you opt to use BSD licensing. The warranty disclaimer below holds
+ * in either instance.
+ * 
+ * This complete copyright notice must be included in any revised version of the
+ * source code. Additional authorship citations may be added, but existing
+ * author citations must be preserved.
+ * 
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ * 
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+ * 
+ * */
+ 
+
+#ifndef eman__pluginstats__h__
+#define eman__pluginstats__h__ 1
+
+#include <string>
+#include <vector>
+#include "emobject.h"
+using std::string;
+using std::vector;
+
+namespace EMAN
+{
+	class EMData;
+	class Averager;
+
+	/** PluginStats keeps optional per-call statistics for Processor, Aligner, Cmp, Projector,
+	 * Averager and Reconstructor calls, keyed by plugin type, name and parameters. For each key it
+	 * records the number of calls, total and maximum time, and the size of the images processed.
+	 * Times are inclusive, so an aligner's time includes any processors and comparators it calls.
+	 *
+	 * Collection is disabled by default, in which case the only cost is a test of a static flag
+	 * per call. It is enabled with Util::set_plugin_stats(true), or by setting the EMAN2PLUGINSTATS
+	 * environment variable. Parameters which are objects (images, transforms, ...) are recorded
+	 * by type only, and at most MAX_PARMSETS parameter sets are kept separately for any one
+	 * plugin; further sets are combined under the parameter string "...".
+	 */
+	class PluginStats
+	{
+	  public:
+		static bool enabled;
+
+		/** Records one call. params is formatted as a parameter string. */
+		static void record(const char *kind, const string & name, const Dict & params, const EMData * image, double seconds);
+
+		/** Returns one Dict per key with kind, name, params, calls, total, mean, max (times in seconds),
+		 * nx, ny, nz (largest image) and mean_voxels, sorted by decreasing total time. */
+		static vector<Dict> get();
+
+		static void reset();
+
+		static void set_enabled(bool enable);
+
+		/** Wall clock time in seconds */
+		static double now();
+
+		static const int MAX_PARMSETS = 32;
+	};
+
+	inline Dict plugin_params(const Averager *) { return Dict(); }		// Averager parameters aren't public
+	template <class T> inline Dict plugin_params(const T *plugin) { return plugin->get_params(); }
+
+	/** Records the time from construction to destruction for PluginStats when collection is enabled.
+	 * Usage: { PluginTimer timer("processor",f,image); f->process_inplace(image); } */
+	class PluginTimer
+	{
+	  public:
+		template <class T> PluginTimer(const char *kind, const T *plugin, const EMData *image)
+			: kind(kind), image(image), t0(-1.0)
+		{
+			if (PluginStats::enabled && plugin) {
+				name = plugin->get_name();
+				params = plugin_params(plugin);
+				t0 = PluginStats::now();
+			}
+		}
+
+		~PluginTimer()
+		{
+			if (t0 >= 0) PluginStats::record(kind, name, params, image, PluginStats::now() - t0);
+		}
+
+	  private:
+		PluginTimer(const PluginTimer &);
+		PluginTimer & operator=(const PluginTimer &);
+
+		const char *kind;
+		const EMData *image;
+		double t0;
+		string name;
+		Dict params;
+	};
+}
+
+#endif	//eman__pluginstats__h__
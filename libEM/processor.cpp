@@ -99,6 +99,7 @@ const string WatershedProcessor::NAME = "segment.watershed";
 const string SegmentSubunitProcessor::NAME = "segment.subunit";
 const string RecipCarefullyProcessor::NAME = "math.reciprocal";
 const string SubtractOptProcessor::NAME = "math.sub.optimal";
+const string DarkGainCorrectProcessor::NAME = "math.darkgain";
 const string ValuePowProcessor::NAME = "math.pow";
 const string ValueSquaredProcessor::NAME = "math.squared";
 const string ValueSqrtProcessor::NAME = "math.sqrt";
@@ -345,6 +346,7 @@ template <> Factory < Processor >::Factory()
 	force_add<IntTranslateProcessor>();
 	force_add<RecipCarefullyProcessor>();
 	force_add<SubtractOptProcessor>();
+	force_add<DarkGainCorrectProcessor>();
 
 	force_add<ClampingProcessor>();
 	force_add<NSigmaClampingProcessor>();
@@ -4575,6 +4577,47 @@ void SubtractOptProcessor::process_inplace(EMData * image)
 }
 
 
+void DarkGainCorrectProcessor::process_inplace(EMData * image)
+{
+	if (!image) {
+		LOGWARN("NULL image");
+		return;
+	}
+	if (image->is_complex()) throw ImageFormatException("Error: math.darkgain processor does not work on complex images");
+
+	EMData *dark=params.set_default("dark",(EMData *)NULL);
+	EMData *gain=params.set_default("gain",(EMData *)NULL);
+	float nsigma=params.set_default("nsigma",0.0f);
+
+	size_t size = image->get_size();
+	if ((dark && dark->get_size()!=size) || (gain && gain->get_size()!=size)) throw ImageDimensionException("math.darkgain: dark/gain reference size does not match image");
+
+	float *data=image->get_data();
+	float *dd=dark?dark->get_data():NULL;
+	float *gd=gain?gain->get_data():NULL;
+
+	double sum=0,sum2=0;
+	for (size_t i=0; i<size; i++) {
+		float v=data[i];
+		if (dd) v-=dd[i];
+		if (gd) v*=gd[i];
+		data[i]=v;
+		sum+=v;
+		sum2+=v*v;
+	}
+
+	if (nsigma>0) {
+		double mean=sum/size;
+		double sigma=sqrt(std::max(0.0,sum2/size-mean*mean));
+		float max=(float)(mean+sigma*nsigma);
+		for (size_t i=0; i<size; i++) {
+			if (data[i]<0 || data[i]>max) data[i]=0;
+		}
+	}
+
+	image->update();
+}
+
 void NormalizeToLeastSquareProcessor::process_inplace(EMData * image)
 {
 	if (!image) {
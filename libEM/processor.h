@@ -5695,6 +5695,45 @@ width is also anisotropic and relative to the radii, with 1 being equal to the r
 	};
 
 
+	/**Fused dark/gain correction for direct detector movie frames. Computes (image-dark)*gain in a single pass, accumulating
+	 * statistics as it goes, then (optionally) clamps the result to [0,mean+nsigma*sigma], setting outliers to zero. Equivalent to
+	 * sub(dark), mult(gain) followed by threshold.clampminmax with tozero, but touches the data twice rather than four times.
+	 * @param dark Dark reference to subtract (optional)
+	 * @param gain Gain reference to multiply by, after dark subtraction (optional)
+	 * @param nsigma If >0, values outside [0,mean+nsigma*sigma] of the corrected image are set to zero
+	 */
+	class DarkGainCorrectProcessor:public Processor
+	{
+	  public:
+		virtual void process_inplace(EMData *image);
+
+		string get_name() const
+		{
+			return NAME;
+		}
+
+		static Processor *NEW()
+		{
+			return new DarkGainCorrectProcessor();
+		}
+
+		TypeDict get_param_types() const
+		{
+			TypeDict d;
+			d.put("dark", EMObject::EMDATA, "Dark reference to subtract");
+			d.put("gain", EMObject::EMDATA, "Gain reference to multiply by, after dark subtraction");
+			d.put("nsigma", EMObject::FLOAT, "If >0, values outside [0,mean+nsigma*sigma] of the corrected image are set to zero. Default 0.");
+			return d;
+		}
+
+		string get_desc() const
+		{
+			return "Fused dark/gain correction for movie frames: (image-dark)*gain, optionally followed by zeroing values outside [0,mean+nsigma*sigma].";
+		}
+
+		static const string NAME;
+	};
+
 	/**use least square method to normalize
 	 * @param to reference image normalize to
 	 * @param low_threshold only take into account the reference image's pixel value between high and low threshold (zero is ignored)
@@ -39,6 +39,7 @@
 #include "util.h"
 #include "marchingcubes.h"
 #include "randnum.h"
+#include "pluginstats.h"
 
 #include <fcntl.h>
 #include <iomanip>
@@ -1233,6 +1234,21 @@ string Util::get_time_label()
 	return string(label);
 }
 
+void Util::set_plugin_stats(bool enable)
+{
+	PluginStats::set_enabled(enable);
+}
+
+vector<Dict> Util::get_plugin_stats()
+{
+	return PluginStats::get();
+}
+
+void Util::reset_plugin_stats()
+{
+	PluginStats::reset();
+}
+
 
 void Util::set_log_level(int argc, char *argv[])
 {
@@ -1049,6 +1049,21 @@ namespace EMAN
 		 */
 		static string get_time_label();
 
+		/** Enable or disable collection of per-call Processor/Aligner/Cmp/Projector/Averager/Reconstructor
+		 * statistics (see PluginStats). Disabled by default unless EMAN2PLUGINSTATS is set.
+		 * @param enable Whether to collect statistics
+		 */
+		static void set_plugin_stats(bool enable);
+
+		/** Get the plugin call statistics collected so far, one Dict per plugin type/name/parameter set,
+		 * sorted by decreasing total time.
+		 * @return list of Dicts with kind, name, params, calls, total, mean, max, nx, ny, nz, mean_voxels
+		 */
+		static vector<Dict> get_plugin_stats();
+
+		/** Discard all plugin call statistics */
+		static void reset_plugin_stats();
+
 		/** Set program logging level through command line option "-v N",
 		 * where N is the level.
 		 *
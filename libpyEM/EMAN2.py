@@ -39,8 +39,12 @@ import shelve
 import re
 import cPickle
 import zlib
+import hashlib
 import socket
 import subprocess
+import json
+try: import fcntl
+except: fcntl=None		# no file locking on Windows
 from EMAN2_cppwrap import *
 from pyemtbx.imagetypes import *
 from pyemtbx.box import *
@@ -119,6 +123,235 @@ def timer(fn,n=1):
 	for i in range(n): fn()
 	print time.time()-a
 
+# Opt-in profiling. Enabled by the --profile option of EMArgumentParser or by setting the EMAN2PROFILE environment
+# variable to an output directory (which is inherited by child processes). When enabled, each process writes
+# <dir>/[<tag>_]<program>_<pid>.json on exit, where tag is the value of EMAN2PROFILETAG, if set, when the process started.
+E2PROFILE=None
+
+class E2Profiler:
+	"""Collects timing for named regions, counts and time of Processor/Aligner/Cmp/Reconstructor/Averager/Projector calls
+by name, and image I/O per file. Normally used through profile_start(), profile_region() and profile_merge() rather than
+directly. Image I/O byte counts are the in-memory (float) size of the images read or written."""
+
+	def __init__(self,outdir):
+		self.outdir=outdir
+		self.tag=os.getenv("EMAN2PROFILETAG","")
+		self.lock=threading.Lock()
+		self.start=time.time()
+		self.regions={}
+		self.calls={}
+		self.io={}
+
+	def add_region(self,name,dt):
+		with self.lock:
+			r=self.regions.setdefault(name,[0,0.0])
+			r[0]+=1
+			r[1]+=dt
+
+	def add_call(self,kind,name,dt):
+		with self.lock:
+			r=self.calls.setdefault(kind,{}).setdefault(name,[0,0.0])
+			r[0]+=1
+			r[1]+=dt
+
+	def add_io(self,filename,write,nbytes,dt):
+		with self.lock:
+			r=self.io.setdefault(filename,[0,0,0.0,0,0,0.0])		# reads, read bytes, read time, writes, write bytes, write time
+			k=3 if write else 0
+			r[k]+=1
+			r[k+1]+=nbytes
+			r[k+2]+=dt
+
+	def result(self):
+		"""Returns the profile as a dictionary suitable for JSON"""
+		import resource
+		ru=resource.getrusage(resource.RUSAGE_SELF)
+		rss=ru.ru_maxrss
+		if get_platform()=="Darwin" : rss/=1024		# Mac reports bytes, Linux kB
+		with self.lock:
+			return {"program":os.path.basename(sys.argv[0]),"argv":sys.argv,"pid":os.getpid(),"ppid":os.getppid(),"host":socket.gethostname(),
+				"tag":self.tag,"start":self.start,"end":time.time(),"wall":time.time()-self.start,
+				"cpu_user":ru.ru_utime,"cpu_sys":ru.ru_stime,"maxrss_kb":rss,
+				"regions":dict((k,{"n":v[0],"time":v[1]}) for k,v in self.regions.items()),
+				"calls":dict((kind,dict((k,{"n":v[0],"time":v[1]}) for k,v in d.items())) for kind,d in self.calls.items()),
+				"io":dict((k,{"reads":v[0],"read_bytes":v[1],"read_time":v[2],"writes":v[3],"write_bytes":v[4],"write_time":v[5]}) for k,v in self.io.items()),
+				"plugins":[dict(d) for d in Util.get_plugin_stats()]}
+
+	def write(self):
+		"""Writes the profile for this process. Called automatically at exit."""
+		import json
+		tag=self.tag+"_" if self.tag else ""
+		try:
+			if not os.path.isdir(self.outdir) : os.makedirs(self.outdir)
+		except: pass
+		try:
+			out=file("{}/{}{}_{}.json".format(self.outdir,tag,os.path.basename(sys.argv[0]),os.getpid()),"w")
+			json.dump(self.result(),out,indent=1,sort_keys=True)
+			out.close()
+		except:
+			print "Warning: unable to write profile to ",self.outdir
+
+def _profile_call(kind,meth,nameof):
+	"""Wraps a method so each call is recorded in E2PROFILE under kind. nameof(self,args) returns the algorithm name."""
+	def wrapped(self,*args,**kwargs):
+		t0=time.time()
+		try: return meth(self,*args,**kwargs)
+		finally:
+			try: E2PROFILE.add_call(kind,nameof(self,args),time.time()-t0)
+			except: pass
+	wrapped.__doc__=meth.__doc__
+	return wrapped
+
+def _profile_io(meth,write,fnarg=0):
+	"""Wraps an EMData image read/write method so each call is recorded in E2PROFILE. Bytes are the image size
+unless only the header was read/written."""
+	def wrapped(self,*args,**kwargs):
+		t0=time.time()
+		ret=meth(self,*args,**kwargs)
+		try:
+			if len(args)>fnarg and isinstance(args[fnarg],str):
+				hdronly=(len(args)>fnarg+2 and args[fnarg+2]) if not write else (len(args)>fnarg+3 and args[fnarg+3])
+				E2PROFILE.add_io(args[fnarg],write,0 if hdronly else self.get_size()*4,time.time()-t0)
+		except: pass
+		return ret
+	wrapped.__doc__=meth.__doc__
+	return wrapped
+
+def _profile_read_images(meth):
+	def wrapped(filename,*args):
+		t0=time.time()
+		ret=meth(filename,*args)
+		try: E2PROFILE.add_io(filename,False,0 if (len(args)>1 and args[1]) else sum(i.get_size()*4 for i in ret),time.time()-t0)
+		except: pass
+		return ret
+	wrapped.__doc__=meth.__doc__
+	return wrapped
+
+def _profile_factory(factory,kind,methods):
+	"""Wraps factory.get so the named methods of the returned objects are recorded. The methods are patched on the
+returned object's class the first time it is seen."""
+	get=factory.get
+	patched=set()
+	def wrapped(*args):
+		obj=get(*args)
+		cls=type(obj)
+		if cls not in patched:
+			patched.add(cls)
+			for m in methods:
+				if hasattr(cls,m) : setattr(cls,m,_profile_call(kind,getattr(cls,m),lambda self,args:self.get_name()))
+		return obj
+	factory.get=staticmethod(wrapped)
+
+def _algname(self,args):
+	if isinstance(args[0],str) : return args[0]
+	return args[0].get_name()
+
+def profile_start(outdir=None):
+	"""Enables profiling for this process and any child processes it launches. outdir is where per-process profiles are
+written. If not specified, $EMAN2PROFILE is used, or 'eman2profile' in the current directory. Calling this again
+only changes the output directory."""
+	global E2PROFILE
+	if outdir==None : outdir=os.getenv("EMAN2PROFILE","eman2profile")
+	outdir=os.path.abspath(outdir)
+	os.environ["EMAN2PROFILE"]=outdir
+	if E2PROFILE!=None :
+		E2PROFILE.outdir=outdir
+		return
+
+	E2PROFILE=E2Profiler(outdir)
+	Util.set_plugin_stats(True)		# per-call statistics from within C++, including calls made by other algorithms
+
+	EMData.process=_profile_call("processor",EMData.process,_algname)
+	EMData.process_inplace=_profile_call("processor",EMData.process_inplace,_algname)
+	EMData.align=_profile_call("aligner",EMData.align,_algname)
+	EMData.cmp=_profile_call("cmp",EMData.cmp,_algname)
+	EMData.project=_profile_call("projector",EMData.project,_algname)
+	_profile_factory(Processors,"processor",("process","process_inplace"))
+	_profile_factory(Aligners,"aligner",("align","xform_align_nbest"))
+	_profile_factory(Cmps,"cmp",("cmp",))
+	_profile_factory(Reconstructors,"reconstructor",("setup","insert_slice","determine_slice_agreement","finish"))
+	_profile_factory(Averagers,"averager",("add_image","finish"))
+	_profile_factory(Projectors,"projector",("project3d",))
+
+	EMData.__init__=_profile_io(EMData.__init__,False)
+	EMData.read_image=_profile_io(EMData.read_image,False)
+	EMData.write_image=_profile_io(EMData.write_image,True)
+	EMData.read_images=staticmethod(_profile_read_images(EMData.read_images))
+
+	import atexit
+	atexit.register(E2PROFILE.write)
+
+def profile_enabled():
+	"""Returns True if profiling is enabled for this process (see profile_start())"""
+	return E2PROFILE!=None
+
+class profile_region:
+	"""Times a named region of code when profiling is enabled, and does nothing otherwise. Use as:
+with profile_region("alignment"):
+	..."""
+	def __init__(self,name):
+		self.name=name
+
+	def __enter__(self):
+		self.t0=time.time()
+		return self
+
+	def __exit__(self,typ,value,tb):
+		if E2PROFILE!=None : E2PROFILE.add_region(self.name,time.time()-self.t0)
+		return False
+
+def profile_merge(files):
+	"""Combines a list of per-process profile files (or dictionaries) into one dictionary with the same layout. Times,
+counts and bytes are summed, maxrss_kb is the largest of any process, and 'programs' gives the number of runs, wall and
+cpu time for each program. 'plugins' combines the Util.get_plugin_stats() results with the same kind, name and params."""
+	import json
+	ret={"regions":{},"calls":{},"io":{},"programs":{},"wall":0.0,"cpu_user":0.0,"cpu_sys":0.0,"maxrss_kb":0}
+	plugins={}
+	for f in files:
+		if isinstance(f,dict) : p=f
+		else:
+			try: p=json.load(file(f,"r"))
+			except: continue
+
+		for k in ("wall","cpu_user","cpu_sys"): ret[k]+=p[k]
+		ret["maxrss_kb"]=max(ret["maxrss_kb"],p["maxrss_kb"])
+		if p.has_key("programs"):
+			progs=p["programs"]
+		else:
+			progs={p["program"]:{"n":1,"wall":p["wall"],"cpu":p["cpu_user"]+p["cpu_sys"],"maxrss_kb":p["maxrss_kb"]}}
+		for k,v in progs.items():
+			r=ret["programs"].setdefault(k,{"n":0,"wall":0.0,"cpu":0.0,"maxrss_kb":0})
+			for kk in ("n","wall","cpu"): r[kk]+=v[kk]
+			r["maxrss_kb"]=max(r["maxrss_kb"],v["maxrss_kb"])
+
+		for k,v in p["regions"].items():
+			r=ret["regions"].setdefault(k,{"n":0,"time":0.0})
+			for kk in r: r[kk]+=v[kk]
+		for kind,d in p["calls"].items():
+			for k,v in d.items():
+				r=ret["calls"].setdefault(kind,{}).setdefault(k,{"n":0,"time":0.0})
+				for kk in r: r[kk]+=v[kk]
+		for k,v in p["io"].items():
+			r=ret["io"].setdefault(k,{"reads":0,"read_bytes":0,"read_time":0.0,"writes":0,"write_bytes":0,"write_time":0.0})
+			for kk in r: r[kk]+=v[kk]
+		for v in p.get("plugins",[]):
+			r=plugins.setdefault((v["kind"],v["name"],v["params"]),dict(v,calls=0,total=0.0,max=0.0,voxels=0.0))
+			r["calls"]+=v["calls"]
+			r["total"]+=v["total"]
+			r["max"]=max(r["max"],v["max"])
+			r["voxels"]+=v["mean_voxels"]*v["calls"]
+			if v["nx"]*v["ny"]*v["nz"]>r["nx"]*r["ny"]*r["nz"] : r.update({"nx":v["nx"],"ny":v["ny"],"nz":v["nz"]})
+
+	for r in plugins.values():
+		r["mean"]=r["total"]/max(r["calls"],1)
+		r["mean_voxels"]=r.pop("voxels")/max(r["calls"],1)
+	ret["plugins"]=sorted(plugins.values(),key=lambda x:-x["total"])
+
+	return ret
+
+# child processes inherit profiling through the environment
+if os.getenv("EMAN2PROFILE") : profile_start()
+
 # This is to remove stdio buffering, only line buffering is done. This is what is done for the terminal, but this extends terminal behaviour to redirected stdio
 # try/except is to prevent errors with systems that already redirect stdio
 try: sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
@@ -169,24 +402,116 @@ file_mode_range={
 	int(EMUtil.EMDataType.EM_UINT):(0,4294967295),
 	int(EMUtil.EMDataType.EM_FLOAT):(-3.40282347e+38,3.40282347e+38 )  }
 
+# Job logging. Each directory has an append-only log of JSON records, one per event (start, progress, end),
+# and a small JSON index of running and recently finished jobs so those can be listed without reading the
+# whole log. All writes happen while holding an exclusive lock on the log, so concurrent jobs in the same
+# directory can't interleave or overwrite each other's records. The fixed-format .eman2log.txt is still
+# maintained (under the same lock) for e2projectmanager and other tools which parse it.
+E2LOGTXT=".eman2log.txt"
+E2JOBLOG=".eman2jobs.log"
+E2JOBIDX=".eman2jobs.idx"
+E2PROGRESSINTERVAL=10.0		# minimum time in seconds between logged progress updates for a single job
+E2JOBRECENT=200				# number of finished jobs kept in the index
+
+_E2JOBS={}					# jobs started by this process, keyed by the value returned by E2init
+
+class _E2joblock:
+	"""Holds an exclusive lock on the job log in the current directory for the duration of a 'with' block.
+The log is opened for appending, and the file descriptor is returned by __enter__. On platforms without
+fcntl no locking is done, but each record is still appended with a single write."""
+	def __enter__(self):
+		self.fd=os.open(E2JOBLOG,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0666)
+		if fcntl!=None :
+			try: fcntl.flock(self.fd,fcntl.LOCK_EX)
+			except: pass
+		return self.fd
+
+	def __exit__(self,typ,value,tb):
+		os.close(self.fd)		# also releases the lock
+		return False
+
+def _E2jobalive(job):
+	"""Returns False if job (an index entry) was run on this machine and its process no longer exists"""
+	if job.get("host")!=socket.gethostname() : return True
+	try: return bool(process_running(job["pid"]))
+	except: return True		# eg - no win32api, so we can't tell
+
+def _E2jobindex(rec):
+	"""Applies a single job log record to the index of running/recent jobs. Must be called while holding _E2joblock."""
+	try: idx=json.load(file(E2JOBIDX,"r"))
+	except: idx={"running":{},"recent":[]}
+	running=idx["running"]
+	recent=idx["recent"]
+
+	job=rec["job"]
+	if rec["event"]=="start" :
+		# jobs which died without calling E2end are moved to the recent list when we notice them
+		for k in running.keys():
+			if not _E2jobalive(running[k]) :
+				running[k]["status"]="crashed"
+				recent.append(running.pop(k))
+		running[job]=dict(rec)
+		running[job]["status"]="running"
+		running[job]["progress"]=0.0
+		del running[job]["event"]
+	elif rec["event"]=="progress" :
+		if job in running :
+			running[job]["progress"]=rec["progress"]
+			running[job]["updated"]=rec["time"]
+	elif rec["event"]=="end" :
+		j=running.pop(job,{"job":job})
+		j["status"]="complete"
+		j["end"]=rec["time"]
+		recent.append(j)
+	idx["recent"]=recent[-E2JOBRECENT:]
+
+	# write a new copy and rename it over the old one, so readers never see a partial file
+	tmp="{}.{}".format(E2JOBIDX,os.getpid())
+	out=file(tmp,"w")
+	json.dump(idx,out)
+	out.close()
+	try: os.rename(tmp,E2JOBIDX)
+	except:
+		os.unlink(E2JOBIDX)		# Windows won't rename over an existing file
+		os.rename(tmp,E2JOBIDX)
+
+def _E2joblog(rec,txtpos=-1,txt=None):
+	"""Appends one record to the job log and updates the index. If txt is specified, it is also written to .eman2log.txt,
+at txtpos, or appended if txtpos<0. rec may be None to update only .eman2log.txt. Returns the position txt was written at, or -1 on failure."""
+	try:
+		with _E2joblock() as fd:
+			if rec!=None :
+				os.write(fd,json.dumps(rec)+"\n")
+				try: _E2jobindex(rec)
+				except: pass
+			if txt==None : return 0
+
+			try: hist=file(E2LOGTXT,"r+")
+			except: hist=file(E2LOGTXT,"w")
+			if txtpos<0 : hist.seek(0,os.SEEK_END)
+			else : hist.seek(txtpos)
+			txtpos=hist.tell()
+			hist.write(txt)
+			hist.close()
+			return txtpos
+	except:
+		return -1
+
 def E2init(argv, ppid=-1) :
 	"""E2init(argv)
 This function is called to log information about the current job to the local logfile. The flags stored for each process
 are pid, start, args, progress and end. progress is from 0.0-1.0 and may or may not be updated. end is not set until the process
-is complete. If the process is killed, 'end' may never be set."""
+is complete. If the process is killed, 'end' may never be set. Returns an id to pass to E2progress and E2end, or -1 on failure."""
 
-	# We go to the end of the file. Record the location, then write a fixed length string
-	try:
-		hist=file(".eman2log.txt","r+")
-		hist.seek(0,os.SEEK_END)
-	except:
-		try: hist=file(".eman2log.txt","w")
-		except: return -1
-	n=hist.tell()
-	hist.write("%s\tincomplete         \t%6d/%6d\t%s\t%s\n"%(local_datetime(),os.getpid(),ppid,socket.gethostname()," ".join(argv)))
+	t=time.time()
+	pid=os.getpid()
+	host=socket.gethostname()
+	job="{}:{}:{:.3f}".format(host,pid,t)
+	rec={"event":"start","job":job,"time":t,"pid":pid,"ppid":ppid,"host":host,"cwd":os.getcwd(),"args":list(argv)}
 
-#	hist.flush()
-	hist.close()
+	# .eman2log.txt gets a fixed length status field, which E2progress and E2end overwrite in place
+	n=_E2joblog(rec,-1,"%s\tincomplete         \t%6d/%6d\t%s\t%s\n"%(local_datetime(t),pid,ppid,host," ".join(argv)))
+	if n>=0 : _E2JOBS[n]={"job":job,"last":t}
 
 	#if EMAN2db.BDB_CACHE_DISABLE :
 		#print "Note: Cache disabled"
@@ -195,17 +520,20 @@ is complete. If the process is killed, 'end' may never be set."""
 
 def E2progress(n,progress):
 	"""Updates the progress fraction (0.0-1.0) for a running job. Negative values may optionally be
-set to indicate an error exit."""
+set to indicate an error exit. Updates are only logged every E2PROGRESSINTERVAL seconds, except for
+completion and error values, so this may be called as often as convenient."""
 #	if EMAN2db.BDB_CACHE_DISABLE : return		# THIS MUST REMAIN DISABLED NOW THAT THE CACHE IS DISABLED PERMANENTLY !!!
 
-	try:
-		hist=file(".eman2log.txt","r+")
-		hist.seek(n+20)
-	except:
-		return -1
-	hist.write("%3d%%         "%(int(progress*100.0)))
-#	hist.flush()
-	hist.close()
+	if n<0 : return -1
+	# n may have come from E2init in another process, in which case only .eman2log.txt can be updated
+	job=_E2JOBS.setdefault(n,{"job":None,"last":0})
+
+	t=time.time()
+	if 0<=progress<1.0 and t-job["last"]<E2PROGRESSINTERVAL : return n
+	job["last"]=t
+
+	rec=None if job["job"]==None else {"event":"progress","job":job["job"],"time":t,"progress":progress}
+	if _E2joblog(rec,n+20,"%3d%%         "%(int(progress*100.0)))<0 : return -1
 
 	return n
 
@@ -214,17 +542,52 @@ def E2end(n):
 This function is called to log the end of the current job. n is returned by E2init"""
 #	if EMAN2db.BDB_CACHE_DISABLE : return		# THIS MUST REMAIN DISABLED NOW THAT THE CACHE IS DISABLED PERMANENTLY !!!
 
-	try:
-		hist=file(".eman2log.txt","r+")
-		hist.seek(n+20)
-	except:
-		return -1
-	hist.write("%s"%(local_datetime()))
-#	hist.flush()
-	hist.close()
+	if n<0 : return -1
+	job=_E2JOBS.pop(n,{"job":None})
+
+	t=time.time()
+	rec=None if job["job"]==None else {"event":"end","job":job["job"],"time":t}
+	if _E2joblog(rec,n+20,"%s"%(local_datetime(t)))<0 : return -1
 
 	return n
 
+def E2jobs(running=True,path="."):
+	"""Returns a list of jobs from the job index in path without reading the full job log. Each job is a dictionary
+with job, pid, ppid, host, cwd, args, time (start), status and progress, and end for finished jobs. If running is set,
+only jobs still running are returned, otherwise recently finished (or crashed) jobs are included as well. Jobs on this
+machine whose process no longer exists are reported as crashed."""
+	try: idx=json.load(file(os.path.join(path,E2JOBIDX),"r"))
+	except: return []
+
+	ret=[]
+	for j in sorted(idx["running"].values(),key=lambda x:x["time"]):
+		if not _E2jobalive(j) : j["status"]="crashed"
+		if j["status"]=="running" or not running : ret.append(j)
+	if not running : ret=idx["recent"]+ret
+
+	return ret
+
+def E2jobhistory(path="."):
+	"""Reads the complete job log in path and returns a list of jobs in the order they were started. Each job is a dictionary
+with job, pid, ppid, host, cwd, args and time (start), plus progress and end if they were logged."""
+	try: fin=file(os.path.join(path,E2JOBLOG),"r")
+	except: return []
+
+	jobs={}
+	ret=[]
+	for l in fin:
+		try: rec=json.loads(l)
+		except: continue		# a truncated record, eg - from a full disk
+		if rec["event"]=="start" :
+			jobs[rec["job"]]=dict(rec)
+			del jobs[rec["job"]]["event"]
+			ret.append(jobs[rec["job"]])
+		elif rec["job"] in jobs :
+			if rec["event"]=="progress" : jobs[rec["job"]]["progress"]=rec["progress"]
+			elif rec["event"]=="end" : jobs[rec["job"]]["end"]=rec["time"]
+
+	return ret
+
 def E2saveappwin(app,key,win):
 	"""stores the window geometry using the application default mechanism for later restoration. Note that
 	this will only work with Qt windows"""
@@ -439,6 +802,168 @@ def get_header(filename,i):
 		e.read_image(filename,i,read_header_only)
 		return e.get_attr_dict()
 
+HDRCACHEBLOCK=10000		# number of headers read per call when building a column for get_attr_column
+
+def header_cache_path(filename):
+	"""Returns the path of the on-disk header column cache for an image file, or None if the file can't be cached"""
+	if filename[:4].lower()=="bdb:" : return None
+	return "{}/.eman2/hdrcache/{}.pkl".format(e2gethome(),hashlib.md5(os.path.abspath(filename)).hexdigest())
+
+def get_attr_column(filename,attr,indices=None,default=None):
+	"""Returns the value of a single header attribute for many images in a file with one call. If indices
+is None, all images are included. Images without the attribute return default. If all of the values are
+numbers, the result is a numpy array, otherwise it is a list.
+
+Complete columns are cached on disk (in ~/.eman2/hdrcache) until the modification time or size of the file
+changes, so only the first request for an attribute in a given stack needs to read the headers. Note that
+for .lst files, only changes to the .lst file itself are detected."""
+
+	n=EMUtil.get_image_count(filename)
+	cpath=header_cache_path(filename)
+	try:
+		st=os.stat(filename)
+		stamp=(st.st_mtime,st.st_size,n)
+	except: cpath=None
+
+	cache=None
+	if cpath!=None :
+		try:
+			cache=cPickle.load(file(cpath,"rb"))
+			if cache["stamp"]!=stamp : cache=None
+		except: cache=None
+
+	if cache!=None and attr in cache["cols"] : col=cache["cols"][attr]
+	elif indices!=None and len(indices)*10<n :
+		# for a small subset of a large file, it isn't worth reading every header
+		col={}
+		for i,h in zip(indices,EMData.read_images(filename,list(indices),True)):
+			if h.has_attr(attr) : col[i]=h[attr]
+			else : col[i]=None
+	else:
+		# read the headers in blocks, we may have millions of them
+		col=[]
+		for i in xrange(0,n,HDRCACHEBLOCK):
+			for h in EMData.read_images(filename,range(i,min(n,i+HDRCACHEBLOCK)),True):
+				if h.has_attr(attr) : col.append(h[attr])
+				else : col.append(None)
+
+		if cpath!=None :
+			tmp="{}.{}".format(cpath,os.getpid())
+			lockf=None
+			try:
+				try: os.makedirs(os.path.dirname(cpath))
+				except: pass
+				# the cache is re-read and merged under the lock, so concurrent writers of different columns keep each other's work
+				lockf=open(cpath+".lock","a")
+				if fcntl!=None : fcntl.flock(lockf,fcntl.LOCK_EX)
+				try:
+					cache=cPickle.load(file(cpath,"rb"))
+					if cache["stamp"]!=stamp : cache=None
+				except: cache=None
+				if cache==None : cache={"stamp":stamp,"cols":{}}
+				cache["cols"][attr]=col
+				out=file(tmp,"wb")
+				cPickle.dump(cache,out,-1)
+				out.close()
+				os.rename(tmp,cpath)		# atomic, so readers that don't lock never see a partial file
+			except: pass
+			finally:
+				if lockf!=None : lockf.close()		# also releases the lock
+				if os.path.exists(tmp) :
+					try: os.unlink(tmp)
+					except: pass
+
+	if indices!=None : col=[col[i] for i in indices]
+	col=[default if v is None else v for v in col]
+
+	for v in col:
+		if isinstance(v,bool) or not isinstance(v,(int,long,float)) : return col
+
+	import numpy
+	return numpy.array(col)
+
+EMUtil.get_attr_column=staticmethod(get_attr_column)
+
+BULKREADBLOCK=256		# default number of images per block in iter_images_bulk
+
+def read_images_bulk(filename,indices=None,header_only=False):
+	"""Reads many images from a file with one call, returning them in the order given in indices (all images if None).
+Unlike repeated EMData(filename,n) calls, each underlying file is opened once and read in on-disk order. For #LSX
+files, the records are resolved first and grouped by referenced file, so each referenced stack is read with a single
+EMData.read_images call. As with EMData.read_image on a .lst file, source_path/source_n refer to the .lst file and
+data_source/data_n to the referenced image. The LSX comment, if any, is stored in lst_comment."""
+
+	if indices==None : indices=range(EMUtil.get_image_count(filename))
+	else : indices=list(indices)
+	if len(indices)==0 : return []
+
+	try:
+		fin=file(filename,"r")
+		if fin.readline()!="#LSX\n" : fin=None
+	except: fin=None
+	if fin==None : return EMData.read_images(filename,indices,header_only)		# C++ already reads in on-disk order
+
+	# same layout as LSXFile, but opened read-only, and the records are read in file order
+	fin.readline()
+	linelen=int(fin.readline()[1:])
+	seekbase=fin.tell()
+	nrec=(os.fstat(fin.fileno()).st_size-seekbase)/linelen
+
+	groups={}
+	for i,j in sorted((i,j) for j,i in enumerate(indices)):
+		if i<0 or i>=nrec : raise Exception,"Attempt to read record {} from #LSX {} with {} records".format(i,filename,nrec)
+		fin.seek(seekbase+linelen*i)
+		ln=fin.readline().strip().split("\t")
+		if len(ln)==2 : ln.append(None)
+		try: groups[ln[1]].append((int(ln[0]),j,i,ln[2]))
+		except: groups[ln[1]]=[(int(ln[0]),j,i,ln[2])]
+	fin.close()
+
+	ret=[None]*len(indices)
+	for fsp,recs in groups.items():
+		for im,(n,j,i,cmt) in zip(EMData.read_images(fsp,[r[0] for r in recs],header_only),recs):
+			im["source_path"]=filename
+			im["source_n"]=i
+			im["data_source"]=fsp
+			im["data_n"]=n
+			if cmt!=None and len(cmt)>0 : im["lst_comment"]=cmt
+			ret[j]=im
+
+	return ret
+
+def iter_images_bulk(filename,indices=None,header_only=False,blocksize=BULKREADBLOCK,prefetch=True):
+	"""Generator yielding images from filename in the order given in indices (all images if None). Images are read
+blocksize at a time with read_images_bulk. If prefetch is set, the next block is read in a background thread while
+the caller is processing the current one, so only about 2 blocks are in memory at once. Reads hold the GIL, so
+they overlap with processing which releases it (alignment, most processors) rather than with pure Python code."""
+
+	if indices==None : indices=range(EMUtil.get_image_count(filename))
+	else : indices=list(indices)
+	blocks=[indices[i:i+blocksize] for i in xrange(0,len(indices),blocksize)]
+
+	if not prefetch or len(blocks)<2 :
+		for b in blocks:
+			for im in read_images_bulk(filename,b,header_only): yield im
+		return
+
+	from Queue import Queue
+	blockq=Queue(1)
+
+	def reader():
+		try:
+			for b in blocks: blockq.put(read_images_bulk(filename,b,header_only))
+		except Exception,e:
+			blockq.put(e)
+
+	thr=threading.Thread(target=reader)
+	thr.daemon=True			# in case the caller abandons the generator
+	thr.start()
+
+	for b in blocks:
+		ims=blockq.get()
+		if isinstance(ims,Exception) : raise ims
+		for im in ims: yield im
+
 def remove_image(fsp):
 	"""This will remove the image file pointed to by fsp. The reason for this function
 	to exist is formats like IMAGIC which store data in two files. This insures that
@@ -496,11 +1021,13 @@ class EMArgumentParser(argparse.ArgumentParser):
 		# This stuff is to make argparser masquerade as optparser
 		if version:
 			self.add_argument('--version', action='version', version=version)
+		self.add_argument("--profile", action="store_true", default=False, help="Record region timing, algorithm call counts/times, image I/O and peak memory for this program and any it launches. Written to $EMAN2PROFILE if set, otherwise eman2profile/")
 		self.add_argument("postionalargs", nargs="*")
 
 	def parse_args(self):
 		""" Masquerade as optpaser parse options """
 		parsedargs = argparse.ArgumentParser.parse_args(self)
+		if parsedargs.profile : profile_start()
 		return (parsedargs, parsedargs.postionalargs)
 
 	def add_pos_argument(self, **kwargs):
@@ -920,6 +1447,11 @@ def process_running(pid):
 		try:
 			os.kill(pid,0)
 			return 1
+		except OSError,e:
+			# the process exists, but belongs to another user
+			import errno
+			if e.errno==errno.EPERM : return 1
+			return 0
 		except:
 			return 0
 
@@ -2044,6 +2576,15 @@ but this method prevents multiple open/close operations on the #LSX file."""
 
 		return ret
 
+	def read_images(self,nlist=None,header_only=False):
+		"""Reads the images referenced by a list of records in the #LSX file (all records if None), returned in
+the order of nlist. Records are grouped by referenced file, so this is much faster than calling read_image
+repeatedly. See read_images_bulk()."""
+
+		self.ptr.flush()
+		if nlist==None : nlist=range(self.n)
+		return read_images_bulk(self.path,nlist,header_only)
+
 	def __len__(self): return self.n
 
 	def normalize(self):
@@ -36,53 +36,145 @@ depending on the initial guess used as a starting point.
 """
 
 import math
-import copy
 import sys
+import time
+import numpy as np
 
 class Simplex:
-    def __init__(self, testfunc, guess, increments, kR = -1, kE = 2, kC = 0.5, data=None):
+    def __init__(self, testfunc, guess, increments, kR = -1, kE = 2, kC = 0.5, data=None, hook=None, _defer=False):
         """Initializes the simplex.
         INPUTS
         ------
-        testfunc      the function to minimize
+        testfunc      the function to minimize, called as testfunc(point,data)
         guess[]       an list containing initial guesses
         increments[]  an list containing increments, perturbation size
         kR            reflection constant  (alpha =-1.0)
         kE            expansion constant   (gamma = 2.0)
         kC            contraction constant (beta  = 0.5)
+        hook          if set, called as hook(npoints,seconds) after each call to testfunc, for profiling
+
+        After minimize(), nevals is the number of function evaluations and evaltime is the total
+        time (in seconds) spent in testfunc.
         """
         self.testfunc = testfunc
         self.guess = guess
         self.increments = increments
         self.data=data
+        self.hook=hook
         self.kR = kR
         self.kE = kE
         self.kC = kC
         self.numvars = len(self.guess)
-        self.simplex = []
+        self.nevals = 0
+        self.evaltime = 0.0
+        self.iters = 0
 
         self.lowest = -1
         self.highest = -1
         self.secondhighest = -1
 
-        self.errors = []
-        self.currenterror = 0
-
         # Initialize vertices
         # MV: the first vertex is just the initial guess
         #     the other N vertices are the initial guess plus the individual increments
-        #     the last two vertices will store the centroid and the reflected point
-        #     the compute errors at the ... vertices
+        # The vertices are the rows of an (N+1,N) array, with their errors in a matching vector
         
-        for vertex in range(0, self.numvars + 3):
-            self.simplex.append(copy.copy(self.guess))
+        self.simplex = np.array([guess]*(self.numvars + 1),dtype=float)
+        for vertex in range(1, self.numvars + 1):
+            self.simplex[vertex][vertex-1] += increments[vertex-1]
+
+        # MultiSimplex evaluates the initial vertices of many simplices together
+        if _defer : self.errors = None
+        else : self.errors = self.evaluate(self.simplex)
+
+    def evaluate(self, points):
+        """Evaluates testfunc at each row of points, returning an array of errors"""
+        t0=time.time()
+        ret = np.array([self.testfunc(list(p),self.data) for p in points],dtype=float)
+        dt=time.time()-t0
+        self.nevals += len(points)
+        self.evaltime += dt
+        if self.hook != None : self.hook(len(points),dt)
+        return ret
+
+    def steps(self, epsilon, maxiters, monitor):
+        """Generator performing the Nelder-Mead iterations. Each time it needs function values it yields
+        an array of points (one per row), and must be sent back an array containing their errors. This
+        permits many simplices to be evaluated together (see MultiSimplex)."""
+        n = self.numvars
+        if self.errors is None : self.errors = np.array((yield self.simplex.copy()),dtype=float)
+        s = self.simplex
+        e = self.errors
+        
+        for iter in range(0, maxiters):
+            self.iters = iter
 
-        for vertex in range(0, self.numvars + 1):
-            for x in range(0, self.numvars):
-                if x == (vertex - 1):
-                    self.simplex[vertex][x] = self.guess[x] + self.increments[x]
-            self.errors.append(0)
-        self.calculate_errors_at_vertices()
+            # Identify highest, lowest and second highest vertices
+            self.highest = int(e.argmax())
+            self.lowest = int(e.argmin())
+            others = [v for v in range(n + 1) if v != self.highest]
+            self.secondhighest = others[int(e[others].argmax())]
+
+            # Test for convergence: the std deviation of the merit figures
+            T = math.sqrt(((e - e.mean())**2).sum() / n)
+            
+            # Optionally, print progress information
+
+            if monitor:
+                print '\r' + 72 * ' ',
+                print '\rIteration = %d   Best = %f   Worst = %f' % \
+                      (iter,e[self.lowest],e[self.highest]),
+                sys.stdout.flush()
+                
+            if T <= epsilon:
+                # We converged!  Break out of loop!
+                break
+
+            # Calculate centroid of simplex, excluding highest vertex
+            centroid = (s.sum(0) - s[self.highest]) / n
+
+            # reflect: if P is vertex and Q is centroid, reflection is Q + (Q-P) = 2Q - P,
+            #          which is achieved for kR = -1 (default value); agrees with NR
+            point = self.kR * s[self.highest] + (1 - self.kR) * centroid
+            err = (yield point[None])[0]
+
+            if err < e[self.highest]:
+                s[self.highest] = point
+                e[self.highest] = err
+
+            if err <= e[self.lowest]:
+                # expand: if P is vertex and Q is centroid, alpha-expansion is Q + alpha*(P-Q),
+                #         or (1 - alpha)*Q + alpha*P; default alpha is 2.0; agrees with NR
+                point = self.kE * point + (1 - self.kE) * centroid
+                err = (yield point[None])[0]
+
+                # at this point we can assume that the highest
+                # value has already been replaced once
+                if err < e[self.highest]:
+                    s[self.highest] = point
+                    e[self.highest] = err
+            elif err >= e[self.secondhighest]:
+                # worse than the second-highest, so look for
+                # intermediate lower point. Same as expand, but with alpha < 1; kC = 0.5 fine with NR
+                point = self.kC * s[self.highest] + (1 - self.kC) * centroid
+                err = (yield point[None])[0]
+
+                if err < e[self.highest]:
+                    s[self.highest] = point
+                    e[self.highest] = err
+                else:
+                    # multiple contraction: around the lowest point; agrees with NR
+                    others = [v for v in range(n + 1) if v != self.lowest]
+                    s[others] = 0.5 * (s[others] + s[self.lowest])
+                    e[others] = (yield s[others].copy())
+
+        self.lowest = int(e.argmin())
+
+    def result(self):
+        """Returns (best point, its error, iterations) after the iterations are complete. The best point
+        is also copied into the original guess list."""
+        for x in range(0, self.numvars):
+            self.guess[x] = float(self.simplex[self.lowest][x])
+        return self.guess, float(self.errors[self.lowest]), self.iters
 
     def minimize(self, epsilon = 0.0001, maxiters = 250, monitor = 1):
         """Walks to the simplex down to a local minima.
@@ -99,174 +191,84 @@ class Simplex:
         number of iterations taken to get here
         """
         
-        iter = 0
-        
-        for iter in range(0, maxiters):
-            # Identify highest and lowest vertices
-            
-            self.highest = 0
-            self.lowest = 0
-            for vertex in range(1, self.numvars + 1):
-                if self.errors[vertex] > self.errors[self.highest]:
-                    self.highest = vertex
-                if self.errors[vertex] < self.errors[self.lowest]:
-                    self.lowest = vertex
-
-            # Identify second-highest vertex
-
-            self.secondhighest = self.lowest
-            for vertex in range(0, self.numvars + 1):
-                if vertex == self.highest:
-                    continue
-                elif vertex == self.secondhighest:
-                    continue
-                elif self.errors[vertex] > self.errors[self.secondhighest]:
-                    self.secondhighest = vertex
-
-            # Test for convergence:
-            #   compute the average merit figure (ugly)
-
-            S = 0.0
-            for vertex in range(0, self.numvars + 1):
-                S = S + self.errors[vertex]
-            F2 = S / (self.numvars + 1)
-
-            #   compute the std deviation of the merit figures (ugly)
-
-            S1 = 0.0
-            for vertex in range(0, self.numvars + 1):
-                S1 = S1 + (self.errors[vertex] - F2)**2
-            T = math.sqrt(S1 / self.numvars)
-            
-            # Optionally, print progress information
+        search = self.steps(epsilon, maxiters, monitor)
+        try:
+            points = search.next()
+            while True:
+                points = search.send(self.evaluate(points))
+        except StopIteration:
+            pass
 
-            if monitor:
-                print '\r' + 72 * ' ',
-                print '\rIteration = %d   Best = %f   Worst = %f' % \
-                      (iter,self.errors[self.lowest],self.errors[self.highest]),
-                sys.stdout.flush()
-                
-            if T <= epsilon:
-                # We converged!  Break out of loop!
-                
-                break;
-            else:
-                # Didn't converge.  Keep crunching.
-                
-                # Calculate centroid of simplex, excluding highest vertex
-                # store centroid in element N+1
-
-                # loop over coordinates
-                for x in range(0, self.numvars):
-                    S = 0.0
-                    for vertex in range(0, self.numvars + 1):
-                        if vertex == self.highest:
-                            continue
-                        S = S + self.simplex[vertex][x]
-                    self.simplex[self.numvars + 1][x] = S / self.numvars
-
-                # reflect the simplex across the centroid
-                # store reflected point in elem. N + 2 (and self.guess)
-                
-                self.reflect_simplex()
-                self.currenterror = self.testfunc(self.guess,self.data)
-
-                if self.currenterror < self.errors[self.highest]:
-                    self.accept_reflected_point()
-
-                if self.currenterror <= self.errors[self.lowest]:
-                    self.expand_simplex()
-                    self.currenterror = self.testfunc(self.guess,self.data)
-
-                    # at this point we can assume that the highest
-                    # value has already been replaced once
-                    if self.currenterror < self.errors[self.highest]:
-                        self.accept_expanded_point()
-                elif self.currenterror >= self.errors[self.secondhighest]:
-                    # worse than the second-highest, so look for
-                    # intermediate lower point
-
-                    self.contract_simplex()
-                    self.currenterror = self.testfunc(self.guess,self.data)
-
-                    if self.currenterror < self.errors[self.highest]:
-                        self.accept_contracted_point()
-                    else:
-                        self.multiple_contract_simplex()
-                        
         # Either converged or reached the maximum number of iterations.
-        # Return the lowest vertex and the currenterror.
+        # Return the lowest vertex and its error.
+        return self.result()
 
-        for x in range(0, self.numvars):
-            self.guess[x] = self.simplex[self.lowest][x]
-        self.currenterror = self.errors[self.lowest]
-        return self.guess, self.currenterror, iter
-
-    # same as expand, but with alpha < 1; kC = 0.5 fine with NR
-
-    def contract_simplex(self):
-        for x in range(0, self.numvars):
-            self.guess[x] = self.kC * self.simplex[self.highest][x] + (1 - self.kC) * self.simplex[self.numvars + 1][x]
-        return
+class MultiSimplex:
+    def __init__(self, testfunc, guesses, increments, kR = -1, kE = 2, kC = 0.5, data=None, batch=False, hook=None):
+        """Runs independent simplex minimizations from several starting points in lock-step, so all of the
+        points needed at each step can be evaluated together.
+        INPUTS
+        ------
+        testfunc      the function to minimize. If batch is set, it is called as testfunc(points,data) with a
+                      list of points, and must return a sequence of errors, one per point. Otherwise it is
+                      called once per point, as for Simplex.
+        guesses[]     a list of initial guesses, one per simplex
+        increments[]  an list containing increments, perturbation size
+        kR,kE,kC      as for Simplex
+        hook          if set, called as hook(npoints,seconds) after each call to testfunc, for profiling
+        """
+        self.testfunc = testfunc
+        self.data = data
+        self.batch = batch
+        self.hook = hook
+        self.nevals = 0
+        self.evaltime = 0.0
+        self.simplices = [Simplex(testfunc, guess, increments, kR, kE, kC, data, _defer=True) for guess in guesses]
+        self.results = []
+
+    def evaluate(self, points):
+        """Evaluates testfunc at each row of points, returning an array of errors"""
+        t0=time.time()
+        if self.batch : ret = np.array(self.testfunc([list(p) for p in points],self.data),dtype=float)
+        else : ret = np.array([self.testfunc(list(p),self.data) for p in points],dtype=float)
+        dt=time.time()-t0
+        self.nevals += len(points)
+        self.evaltime += dt
+        if self.hook != None : self.hook(len(points),dt)
+        return ret
+
+    def minimize(self, epsilon = 0.0001, maxiters = 250, monitor = 0):
+        """Minimizes all of the simplices. Returns the best (values, error, iterations) found by any of them.
+        The results for every starting point, sorted by error, are left in self.results."""
+
+        searches = [s.steps(epsilon, maxiters, 0) for s in self.simplices]
+        pending = {}
+        for i, search in enumerate(searches):
+            try: pending[i] = search.next()
+            except StopIteration: pass
 
-    # expand: if P is vertex and Q is centroid, alpha-expansion is Q + alpha*(P-Q),
-    #         or (1 - alpha)*Q + alpha*P; default alpha is 2.0; agrees with NR
-    def expand_simplex(self):
-        for x in range(0, self.numvars):
-            self.guess[x] = self.kE * self.guess[x]                 + (1 - self.kE) * self.simplex[self.numvars + 1][x]
-        return
+        iter = 0
+        while len(pending) > 0:
+            active = sorted(pending.keys())
+            errors = self.evaluate(np.concatenate([pending[i] for i in active]))
+            if monitor:
+                print '\r' + 72 * ' ',
+                print '\rStep = %d   Active = %d   Evaluations = %d' % (iter, len(active), self.nevals),
+                sys.stdout.flush()
+            iter += 1
 
-    # reflect: if P is vertex and Q is centroid, reflection is Q + (Q-P) = 2Q - P,
-    #          which is achieved for kR = -1 (default value); agrees with NR
-    def reflect_simplex(self):
-        # loop over variables
-        for x in range(0, self.numvars):
-            self.guess[x] = self.kR * self.simplex[self.highest][x] + (1 - self.kR) * self.simplex[self.numvars + 1][x]
-            # store reflected point in elem. N + 2
-            self.simplex[self.numvars + 2][x] = self.guess[x]
-        return
-
-    # multiple contraction: around the lowest point; agrees with NR
-
-    def multiple_contract_simplex(self):
-        for vertex in range(0, self.numvars + 1):
-            if vertex == self.lowest:
-                continue
-            for x in range(0, self.numvars):
-                self.simplex[vertex][x] = 0.5 * (self.simplex[vertex][x] + self.simplex[self.lowest][x])
-        self.calculate_errors_at_vertices()
-        return
-
-    def accept_contracted_point(self):
-        self.errors[self.highest] = self.currenterror
-        for x in range(0, self.numvars):
-            self.simplex[self.highest][x] = self.guess[x]
-        return
+            j = 0
+            for i in active:
+                n = len(pending[i])
+                try: pending[i] = searches[i].send(errors[j:j+n])
+                except StopIteration: del pending[i]
+                j += n
 
-    def accept_expanded_point(self):
-        self.errors[self.highest] = self.currenterror
-        for x in range(0, self.numvars):
-            self.simplex[self.highest][x] = self.guess[x]
-        return
+        self.results = [s.result() for s in self.simplices]
+        self.results.sort(key=lambda x:x[1])
+        return self.results[0]
 
-    def accept_reflected_point(self):
-        self.errors[self.highest] = self.currenterror
-        for x in range(0, self.numvars):
-            self.simplex[self.highest][x] = self.simplex[self.numvars + 2][x]
-        return
-
-    def calculate_errors_at_vertices(self):
-        for vertex in range(0, self.numvars + 1):
-            if vertex == self.lowest:
-                # compute the error unless we're the lowest vertex
-                continue
-            for x in range(0, self.numvars):
-                self.guess[x] = self.simplex[vertex][x]
-            self.currenterror = self.testfunc(self.guess,self.data)
-            self.errors[vertex] = self.currenterror
-        return
-
-def myfunc(args):
+def myfunc(args, data=None):
     return abs(args[0] * args[0] * args[0] * 5 - args[1] * args[1] * 7 + math.sqrt(abs(args[0])) - 118)
 
 def main():
@@ -275,6 +277,7 @@ def main():
     print 'args = ', values
     print 'error = ', err
     print 'iterations = ', iter
+    print 'evaluations = ', s.nevals
 
 if __name__ == '__main__':
     main()
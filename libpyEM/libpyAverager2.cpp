@@ -40,6 +40,7 @@
 #include <averager.h>
 #include <emdata.h>
 #include <emobject.h>
+#include <pluginstats.h>
 
 // Using =======================================================================
 using namespace boost::python;
@@ -115,7 +116,8 @@ struct EMAN_Averager_Wrapper: EMAN::Averager
 
 void averager_add_image_wrapper(EMAN::Averager &ths, EMAN::EMData *img) {
 	GILRelease rel;
-	
+	EMAN::PluginTimer timer("averager", &ths, img);
+
 	ths.add_image(img);
 }
 
@@ -40,6 +40,7 @@
 #include <emdata.h>
 #include <emobject.h>
 #include <reconstructor.h>
+#include <pluginstats.h>
 
 // Using =======================================================================
 using namespace boost::python;
@@ -55,8 +56,11 @@ using namespace EMAN;
 	int reconstructor_insert_slice2(Reconstructor &self, const EMData* slice, const Transform& euler) {
 		int ret;
 		Py_BEGIN_ALLOW_THREADS
-//		printf("wrapper1\n");
-		ret=self.insert_slice(slice,euler);
+		{
+			PluginTimer timer("reconstructor", &self, slice);
+//			printf("wrapper1\n");
+			ret=self.insert_slice(slice,euler);
+		}
 //		ret=call_method< int >(py_self, "insert_slice", slice,euler,1.0f);
 		Py_END_ALLOW_THREADS
 		return ret;
@@ -65,8 +69,11 @@ using namespace EMAN;
  	int reconstructor_insert_slice3(Reconstructor &self, const EMData* slice, const Transform& euler,float weight) {
 		int ret;
 		Py_BEGIN_ALLOW_THREADS
-//		printf("wrapper2 %p %p %f\n",&self,slice,weight);
-		ret=self.insert_slice(slice,euler,weight);
+		{
+			PluginTimer timer("reconstructor", &self, slice);
+//			printf("wrapper2 %p %p %f\n",&self,slice,weight);
+			ret=self.insert_slice(slice,euler,weight);
+		}
 // 		ret=call_method< int >(py_self, "insert_slice", slice,euler,weight);
 		Py_END_ALLOW_THREADS
 		return ret;
@@ -75,11 +82,19 @@ using namespace EMAN;
 	int reconstructor_determine_slice_agreement(Reconstructor &self, EMData* slice, const Transform &euler, const float weight=1.0, bool sub=true) {
 		int ret;
 		Py_BEGIN_ALLOW_THREADS
-		ret=self.determine_slice_agreement(slice,euler,weight,sub);
+		{
+			PluginTimer timer("reconstructor", &self, slice);
+			ret=self.determine_slice_agreement(slice,euler,weight,sub);
+		}
 		Py_END_ALLOW_THREADS
 		return ret;
 	}
 
+	EMData *reconstructor_finish(Reconstructor &self, bool doift) {
+		PluginTimer timer("reconstructor", &self, 0);
+		return self.finish(doift);
+	}
+
 struct EMAN_Reconstructor_Wrapper: EMAN::Reconstructor
 {
 //     EMAN_Reconstructor_Wrapper(PyObject* py_self_, const EMAN::Reconstructor& p0):
@@ -200,7 +215,7 @@ BOOST_PYTHON_MODULE(libpyReconstructor2)
 		.def("determine_slice_agreement", &reconstructor_determine_slice_agreement)
 //		.def("determine_slice_agreement", (int (EMAN::Reconstructor::*)(EMAN::EMData* , const EMAN::Transform&, const float, bool))&EMAN::Reconstructor::determine_slice_agreement)
         .def("preprocess_slice", (EMAN::EMData* (EMAN::Reconstructor::*)(const EMAN::EMData* const, const EMAN::Transform&))&EMAN::Reconstructor::preprocess_slice, return_value_policy< manage_new_object >())
-        .def("finish", (EMAN::EMData* (EMAN::Reconstructor::*)(bool))&EMAN::Reconstructor::finish, return_value_policy< manage_new_object >())
+        .def("finish", &reconstructor_finish, return_value_policy< manage_new_object >())
         .def("get_name", pure_virtual(&EMAN::Reconstructor::get_name))
         .def("get_desc", pure_virtual(&EMAN::Reconstructor::get_desc))
 // 		.def("get_emdata", (&EMAN::Reconstructor::get_emdata),  return_internal_reference< 1 >())
@@ -724,6 +724,9 @@ hyb -- y- mesh spacing above f0\nhya -- y- mesh spacing below f0\n \nInterpolant
 		.def("recv_broadcast", &EMAN::Util::recv_broadcast, args("port"), "")
 #endif	//_WIN32
 		.def("get_time_label", &EMAN::Util::get_time_label, "Get the current time in a string with format 'mm/dd/yyyy hh:mm'.\n \nreturn The current time string.")
+		.def("set_plugin_stats", &EMAN::Util::set_plugin_stats, args("enable"), "Enable or disable collection of per-call processor/aligner/cmp/projector/averager/reconstructor statistics. Disabled by default unless EMAN2PLUGINSTATS is set.\n \nenable - True to collect statistics.")
+		.def("get_plugin_stats", &EMAN::Util::get_plugin_stats, "Get the plugin call statistics collected so far, one dictionary per plugin type, name and parameter set, sorted by decreasing total time.\n \nreturn A list of dictionaries with kind, name, params, calls, total, mean, max (seconds), nx, ny, nz (largest image) and mean_voxels.")
+		.def("reset_plugin_stats", &EMAN::Util::reset_plugin_stats, "Discard all plugin call statistics.")
 		.def("eman_copysign", &EMAN::Util::eman_copysign, args("a", "b"), "copy sign of a number. return a value whose absolute value\nmatches that of 'a', but whose sign matches that of 'b'.  If 'a'\nis a NaN, then a NaN with the sign of 'b' is returned.\nIt is exactly copysign() on non-Windows system.\n \na - The first number.\nb - The second number.\n \nreturn Copy sign of a number.")
 		.def("eman_erfc", &EMAN::Util::eman_erfc, args("x"), "complementary error function. It is exactly erfc() on\nnon-Windows system. On Windows, it tries to simulate erfc().\n \nThe erf() function returns the error function of x; defined as\nerf(x) = 2/sqrt(pi)* integral from 0 to x of exp(-t*t) dt\n \nThe erfc() function returns the complementary error function of x, that\nis 1.0 - erf(x).\n \nx - A float number.\n \nreturn The complementary error function of x.")
 		.def("twoD_fine_ali", &EMAN::Util::twoD_fine_ali, args("image", "refim", "mask", "ang", "sxs", "sys"), "")
@@ -819,6 +822,9 @@ hyb -- y- mesh spacing above f0\nhya -- y- mesh spacing below f0\n \nInterpolant
 		.staticmethod("square_sum")
 		.staticmethod("Polar2D")
 		.staticmethod("get_time_label")
+		.staticmethod("set_plugin_stats")
+		.staticmethod("get_plugin_stats")
+		.staticmethod("reset_plugin_stats")
 		.staticmethod("get_max")
 		.staticmethod("mul_img")
 		.staticmethod("mul_img_tabularized")
@@ -1134,6 +1140,9 @@ hyb -- y- mesh spacing above f0\nhya -- y- mesh spacing below f0\n \nInterpolant
         .def("get_image_type", &EMAN::EMUtil::get_image_type, args("filename"), "Get an image's format type by processing the first 1K of the image.\n \nfilename - Image file name.\n \nreturn image format type.")
         .def("get_image_count", &EMAN::EMUtil::get_image_count, args("filename"), "Get the number of images in an image file.\n \nfilename Image file name.\n \nreturn Number of images in the given file.")
         .def("get_imageio", &EMAN::EMUtil::get_imageio, EMAN_EMUtil_get_imageio_overloads_2_3(args("filename", "rw_mode", "image_type"), "Get an ImageIO object. It may be a newly created\nobject. Or an object stored in the cache.\n \nfilename - Image file name.\nrw_mode - ImageIO read/write mode.\nimage_type - Image format type.(default=IMAGE_UNKNOWN)\n \nreturn An ImageIO object.")[ return_internal_reference< 1 >() ])
+        .def("set_imageio_cache", &EMAN::EMUtil::set_imageio_cache, args("max_handles", "idle_timeout"), "Set the size of the ImageIO handle cache. Up to max_handles idle read-only handles are kept open, each for at most idle_timeout seconds. max_handles=0 disables the cache.")
+        .def("get_imageio_cache_stats", &EMAN::EMUtil::get_imageio_cache_stats, "Get the ImageIO handle cache parameters and counters.\n \nreturn A dictionary including hits, misses, opens, evictions, expired, stale and open_time (seconds).")
+        .def("reset_imageio_cache", &EMAN::EMUtil::reset_imageio_cache, "Close all idle cached ImageIO handles and zero the counters.")
         .def("get_imagetype_name", &EMAN::EMUtil::get_imagetype_name, args("type"), "Give each image type a meaningful name.\n \ntype - Image format type.\n \nreturn A name for that type.")
         .def("get_datatype_string", &EMAN::EMUtil::get_datatype_string, args("type"), "Give each data type a meaningful name\n \ntype - the EMDataType\n \nreturn a name for that data type")
         .def("process_ascii_region_io", &EMAN::EMUtil::process_ascii_region_io, args("data", "file", "rw_mode", "image_index", "mode_size", "nx", "ny", "nz", "area", "has_index_line", "nitems_per_line", "outformat"), "Works for regions that are outside the image data dimension area.\nThe only function that calls this is in xplorio.cpp - that function\nthrows if the region is invalid.")
@@ -1159,6 +1168,9 @@ hyb -- y- mesh spacing above f0\nhya -- y- mesh spacing below f0\n \nInterpolant
         .staticmethod("dump_dict")
         .staticmethod("get_all_attributes")
         .staticmethod("get_imageio")
+        .staticmethod("set_imageio_cache")
+        .staticmethod("get_imageio_cache_stats")
+        .staticmethod("reset_imageio_cache")
         .staticmethod("get_image_count")
         .staticmethod("get_imagetype_name")
         .staticmethod("get_image_type")
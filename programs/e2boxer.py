@@ -36,6 +36,8 @@ from EMAN2jsondb import *
 import numpy as np
 import threading
 import Queue
+import hashlib
+import traceback
 import os,sys
 
 class nothing:
@@ -81,6 +83,101 @@ def load_micrograph(filename):
 	if invert_on_read : img.mult(-1.0)
 	return img
 
+def save_autoboxes(fsp,newboxes):
+	"""Replaces any existing boxes from the same picking mode in the info file for fsp with newboxes.
+	If newboxes is empty, the current results are left alone."""
+	if len(newboxes)==0 : return
+
+	# read the existing box list and update
+	db=js_open_dict(info_name(fsp))
+	try: 
+		boxes=db["boxes"]
+		# Filter out all existing boxes for this picking mode
+		bname=newboxes[0][2]
+		boxes=[b for b in boxes if b[2]!=bname]
+	except:
+		boxes=[]
+		
+	boxes.extend(newboxes)
+	
+	db["boxes"]=boxes
+	db.close()
+
+def record_autopick(mode,fsps):
+	"""Adds fsps to the micrographs recorded as completely autopicked in mode (in info/autopick.json), which
+	--resume skips. Existing records are kept."""
+	if mode==None or len(fsps)==0 : return
+	pdb=js_open_dict("info/autopick.json")
+	try: done=set(pdb[mode])
+	except: done=set()
+	done.update(fsps)
+	pdb[mode]=sorted(done)
+	pdb.close()
+
+PICKBATCH=16		# number of micrographs autopicked between metadata commits in autopick_all
+
+autopick_setup=None		# (autopicker,goodrefs,badrefs,apix,nthreads,params), set in autopick_all worker processes by autopick_init
+def autopick_init(setup):
+	"""Pool initializer for autopick_all, so the worker processes get the setup without relying on fork()"""
+	global autopick_setup
+	autopick_setup=setup
+
+def autopick_one(fsp):
+	"""Autopicks a single micrograph using autopick_setup. Used by autopick_all, normally in a worker process.
+	Returns (fsp,boxes), boxes is None on failure"""
+	try:
+		pcl,goodrefs,badrefs,apix,nthreads,params=autopick_setup
+		micrograph=load_micrograph(fsp)
+		newboxes=pcl.do_autobox(micrograph,goodrefs,badrefs,apix,nthreads,params,None)
+	except:
+		traceback.print_exc()
+		newboxes=None
+
+	return (fsp,newboxes)
+
+def autopick_all(fsps,mode,pcl,goodrefs,badrefs,apix,nprocs,nthreads,params,resume=False):
+	"""Autopicks a list of micrographs, distributing whole micrographs over a pool of nprocs processes, each
+	using nthreads threads. Only this process writes metadata. Boxes and the list of completed micrographs
+	(in info/autopick.json) are committed every PICKBATCH micrographs. If resume is set, micrographs already
+	completed in this mode are skipped."""
+
+	if resume :
+		pdb=js_open_dict("info/autopick.json")
+		try: done=set(pdb[mode])
+		except: done=set()
+		pdb.close()
+		fsps=[f for f in fsps if f not in done]
+		print "Resuming, {} micrographs already picked, {} remaining".format(len(done),len(fsps))
+	if len(fsps)==0 : return
+
+	setup=(pcl,goodrefs,badrefs,apix,nthreads,params)
+	if nprocs>1 :
+		from multiprocessing import Pool
+		pool=Pool(min(nprocs,len(fsps)),autopick_init,(setup,))
+		results=pool.imap_unordered(autopick_one,fsps)
+	else:
+		pool=None
+		autopick_init(setup)
+		results=(autopick_one(f) for f in fsps)
+
+	pending=[]
+	for i,(fsp,newboxes) in enumerate(results):
+		if newboxes==None :
+			print "{}) autopicking failed -> {}".format(i,fsp)
+		else:
+			print "{}) {} boxes -> {}".format(i,len(newboxes),fsp)
+			pending.append((fsp,newboxes))
+
+		if len(pending)>=PICKBATCH or i==len(fsps)-1 :
+			for fsp,newboxes in pending:
+				save_autoboxes(fsp,newboxes)
+			record_autopick(mode,[fsp for fsp,newboxes in pending])
+			pending=[]
+
+	if pool!=None :
+		pool.close()
+		pool.join()
+
 def main():
 	progname = os.path.basename(sys.argv[0])
 	usage = """prog [options] <image> <image2>....
@@ -111,6 +208,8 @@ def main():
 	parser.add_argument("--autopick",type=str,default=None,help="Perform automatic particle picking. Provide mode and parameter string, eg - auto_local:threshold=5.5")
 	parser.add_argument("--gui", action="store_true", default=False, help="Interactive GUI mode", guitype='boolbox', row=4, col=0, rowspan=1, colspan=1, mode="boxing[True]")
 	parser.add_argument("--threads", default=4,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful",guitype='intbox', row=14, col=1, rowspan=1, colspan=1,mode="boxing")
+	parser.add_argument("--pickprocs", default=1,type=int,help="With --autopick, the number of micrographs to pick simultaneously in separate processes. --threads are divided among them.")
+	parser.add_argument("--resume",action="store_true",default=False,help="With --autopick, skip micrographs which were already completed by a previous run in the same mode")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 
@@ -232,30 +331,22 @@ def main():
 			badrefs=EMData.read_images("info/boxrefsbad.hdf")
 		else: badrefs=[]
 		
-		for i,fspi in enumerate(args):
-			fsp=fspi.split()[1]
-			micrograph=load_micrograph(fsp)
+		# distribute whole micrographs over a pool of processes
+		if options.pickprocs>1 or options.resume :
+			nprocs=max(1,options.pickprocs)
+			autopick_all([i.split()[1] for i in args],apick[0],pcl,goodrefs,badrefs,options.apix,nprocs,max(1,options.threads/nprocs),apick[1],options.resume)
+		# let the autoboxer handle the parallelism if it can
+		elif hasattr(pcl,"do_autobox_all") :
+			pcl.do_autobox_all(args,goodrefs,badrefs,options.apix,options.threads,apick[1],None,apick[0])
+		else:
+			for i,fspi in enumerate(args):
+				fsp=fspi.split()[1]
+				micrograph=load_micrograph(fsp)
 
-			newboxes=pcl.do_autobox(micrograph,goodrefs,badrefs,options.apix,options.threads,apick[1],None)
-			print "{}) {} boxes -> {}".format(i,len(newboxes),fsp)
-			
-			# if we got nothing, we just leave the current results alone
-			if len(newboxes)==0 : continue
-		
-			# read the existing box list and update
-			db=js_open_dict(info_name(fsp))
-			try: 
-				boxes=db["boxes"]
-				# Filter out all existing boxes for this picking mode
-				bname=newboxes[0][2]
-				boxes=[b for b in boxes if b[2]!=bname]
-			except:
-				boxes=[]
-				
-			boxes.extend(newboxes)
-			
-			db["boxes"]=boxes
-			db.close()
+				newboxes=pcl.do_autobox(micrograph,goodrefs,badrefs,options.apix,options.threads,apick[1],None)
+				print "{}) {} boxes -> {}".format(i,len(newboxes),fsp)
+				save_autoboxes(fsp,newboxes)
+				record_autopick(apick[0],[fsp])
 
 	if options.gui :
 		if isinstance(QtGui,nothing) :
@@ -342,8 +433,112 @@ class boxerByRef(QtCore.QObject):
 		boxerByRef.threshold=ValSlider(None,(0.1,8),"Threshold",6.0,90)
 		gridlay.addWidget(boxerByRef.threshold,0,0)
 	
+	bankcache={}		# rotated, downsampled templates for the most recently used references and sampling
+	banklock=threading.Lock()
+
 	@staticmethod
-	def do_autobox(micrograph,goodrefs,badrefs,apix,nthreads,params,prog=None):
+	def template_bank(goodrefs,downsample,nthreads):
+		"""Returns a list of (ortid,template), with each reference in 10 degree in-plane rotation steps, downsampled and
+		normalized. The integer portion of ortid is the reference number, the fractional portion is the angle. The bank
+		is cached and reused for as long as the references and downsampling remain the same."""
+
+		key=(tuple(hashlib.md5(ref.numpy().tostring()).hexdigest() for ref in goodrefs),downsample)
+		with boxerByRef.banklock:
+			try: return boxerByRef.bankcache[key]
+			except: pass
+
+		print "Building template bank for {} references".format(len(goodrefs))
+		jobs=Queue.Queue(0)
+		for ri,ref in enumerate(goodrefs): jobs.put((ri,ref))
+		jsd=Queue.Queue(0)
+		thrds=[threading.Thread(target=boxerByRef.banktask,args=(jobs,jsd,downsample)) for i in xrange(max(1,nthreads))]
+		for t in thrds: t.start()
+		for t in thrds: t.join()
+
+		bank=[]
+		while not jsd.empty(): bank.extend(jsd.get())
+		bank.sort(key=lambda x:x[0])
+
+		with boxerByRef.banklock: boxerByRef.bankcache={key:bank}		# we only keep one bank, they can be large
+		return bank
+
+	@staticmethod
+	def banktask(jobs,jsd,downsample):
+		while True:
+			try: ri,ref=jobs.get_nowait()
+			except Queue.Empty: return
+
+			mref=ref.process("mask.soft",{"outer_radius":ref["nx"]/2-4,"width":3})
+			mref.process_inplace("normalize.unitlen")
+
+			ret=[]
+			for ang in xrange(0,360,10):
+				dsref=mref.process("xform",{"transform":Transform({"type":"2d","alpha":ang})})
+				# don't downsample until after rotation
+				dsref.process_inplace("math.fft.resample",{"n":downsample})
+				dsref.process_inplace("normalize")
+				ret.append((ri+ang/360.0,dsref))			# integer portion is projection number, fractional portion is angle, should be enough precision with the ~100 references we're using
+			jsd.put(ret)
+
+	@staticmethod
+	def prep_micrograph(micrograph,apix):
+		"""Downsamples and FFTs a micrograph for do_autobox. Returns (downsample,good_size,fft)"""
+		downsample=10.0/apix			# we downsample to 10 A/pix
+		microdown=micrograph.process("normalize.edgemean").process("math.fft.resample",{"n":downsample})
+		gs=good_size(max(microdown["nx"],microdown["ny"]))
+		microf=microdown.get_clip(Region(0,0,gs,gs)).do_fft()
+		print "downsample by ",downsample,"  Good size:",gs
+		return (downsample,gs,microf)
+
+	@staticmethod
+	def do_autobox_all(filenames,goodrefs,badrefs,apix,nthreads,params,prog=None,mode=None):
+		"""Autoboxes a list of micrographs, reading and preparing the next micrograph while the current one is picked.
+		Boxes are written to each micrograph's info file as it completes, and if mode is set, its completion is recorded
+		with record_autopick."""
+		if len(goodrefs)<1 :
+			print 'Box reference images ("Good Refs") required for autopicking'
+			return
+
+		def prefetch(mq):
+			# a micrograph which can't be read or prepared is passed on as its exception, so it is reported and skipped
+			try:
+				for i,fspl in enumerate(filenames):
+					fsp=fspl.split()[1]
+					try:
+						micrograph=load_micrograph(fsp)
+						mq.put((i,fsp,micrograph,boxerByRef.prep_micrograph(micrograph,apix)))
+					except Exception as e:
+						mq.put((i,fsp,None,e))
+			finally:
+				mq.put(None)
+
+		mq=Queue.Queue(2)
+		thr=threading.Thread(target=prefetch,args=(mq,))
+		thr.daemon=True		# so an abort doesn't leave us waiting for the reader
+		thr.start()
+
+		while True:
+			job=mq.get()
+			if job==None : break
+			i,fsp,micrograph,prepped=job
+			if micrograph is None :
+				print "{}) Error reading {}, skipped: {}".format(i,fsp,prepped)
+				continue
+
+			newboxes=boxerByRef.do_autobox(micrograph,goodrefs,badrefs,apix,nthreads,params,prog,prepped)
+			if newboxes==None : break
+			print "{}) {} boxes -> {}".format(i,len(newboxes),fsp)
+			save_autoboxes(fsp,newboxes)
+			record_autopick(mode,[fsp])
+
+			if prog!=None :
+				prog.setValue(i+1)
+				if prog.wasCanceled() :
+					print "Autoboxing Aborted!"
+					break
+
+	@staticmethod
+	def do_autobox(micrograph,goodrefs,badrefs,apix,nthreads,params,prog=None,prepped=None):
 		# If parameters are provided via params (as if used from command-line) we use those values,
 		# if that fails, we check the GUI widgets, which were presumably created in this case
 		if len(goodrefs)<1 :
@@ -356,66 +551,43 @@ class boxerByRef(QtCore.QObject):
 				print "Error, no threshold (0.1-2) specified"
 				return
 		
-		downsample=10.0/apix			# we downsample to 10 A/pix
-		microdown=micrograph.process("normalize.edgemean").process("math.fft.resample",{"n":downsample})
-		gs=good_size(max(microdown["nx"],microdown["ny"]))
-		microf=microdown.get_clip(Region(0,0,gs,gs)).do_fft()
-		print "downsample by ",downsample,"  Good size:",gs
-	
-		## Here we precompute a normalization image to deal with local standard deviation variation
-		#nx=goodrefs[0]["nx"]/downsample
-		#circle=EMData(gs,gs,1)
-		#circle.to_one()
-		#circle.process_inplace("mask.sharp",{"outer_radius":nx/2})
-##		circle.process_inplace("normalize.unitlen")
-		#circle.process_inplace("xform.phaseorigin.tocorner")
-		#circlef=circle.do_fft()
-		
-		#ccfc=microf.calc_ccf(circlef)
-		#ccfc.mult(1.0/(nx*nx))
-		#ccfc.process_inplace("math.squared")
-		
-		#md2=microdown.process("math.squared")
-		#md2f=md2.get_clip(Region(0,0,gs,gs)).do_fft()
-		#norm=md2f.calc_ccf(circlef)
-		#norm.mult(1.0/(nx*nx))
-	
-		## Norm should now be the variance
-		#norm.sub(ccfc)
+		# prepped is (downsample,good_size,fft) from prep_micrograph, if already computed
+		if prepped==None : prepped=boxerByRef.prep_micrograph(micrograph,apix)
+		downsample,gs,microf=prepped
+		nthreads=max(1,nthreads)
 	
 		# Iterate over refs
 		owner=EMData(gs,gs,1)
 		maxav=Averagers.get("minmax",{"max":1,"owner":owner})
 		
-		# Iterate over in-plane rotation for each ref
-		jsd=Queue.Queue(0)
-		thrds=[threading.Thread(target=boxerByRef.ccftask,args=(jsd,ref,downsample,gs,microf,ri)) for ri,ref in enumerate(goodrefs)]
-
-		n=-1
+		# Iterate over in-plane rotation for each ref, using the cached template bank
+		bank=boxerByRef.template_bank(goodrefs,downsample,nthreads)
+		jobs=Queue.Queue(0)
+		for t in bank: jobs.put(t)
+		jsd=Queue.Queue(nthreads*2)		# bounded, so only a few full size CCFs are ever waiting for the averager
+		thrds=[threading.Thread(target=boxerByRef.ccftask,args=(jobs,jsd,gs,microf)) for i in xrange(nthreads)]
 
 		# here we run the threads and save the results, no actual alignment done here
 		print len(thrds)," threads"
-		thrtolaunch=0
-		while thrtolaunch<len(thrds) or threading.active_count()>1:
-			# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-			# note that it's ok that we wait here forever, since there can't be new results if an existing
-			# thread hasn't finished.
-			if thrtolaunch<len(thrds) and threading.active_count()!=nthreads:
-#				print "Starting thread {}/{}".format(thrtolaunch,len(thrds))
-				thrds[thrtolaunch].start()
-				thrtolaunch+=1
-			else: 
-				time.sleep(0.05)
+		for t in thrds: t.start()
+
+		nccf=len(bank)
+		while nccf>0:
+			try: ccf=jsd.get(True,0.05)
+			except Queue.Empty:
 				if prog!=None : 
 					prog.setValue(prog.value())
-					if prog.wasCanceled() : break
-		
-			while not jsd.empty():
-				# add each ccf image to our maxval image as it comes in
-				ccf=jsd.get()
-				maxav.add_image(ccf)
-				sys.stdout.flush()
-		print ""
+					if prog.wasCanceled() :
+						# drop the remaining templates, but still collect the CCFs already in progress
+						while True:
+							try: jobs.get_nowait()
+							except Queue.Empty: break
+							nccf-=1
+				continue
+			
+			# add each ccf image to our maxval image as it comes in
+			maxav.add_image(ccf)
+			nccf-=1
 
 		for t in thrds:
 			t.join()
@@ -441,8 +613,8 @@ class boxerByRef(QtCore.QObject):
 		final.process_inplace("normalize.edgemean")
 #		final.process_inplace("threshold.belowtozero",{"minval":threshold})
 
-		final.write_image("final.hdf",0)
-		owner.write_image("final.hdf",1)
+#		final.write_image("final.hdf",0)
+#		owner.write_image("final.hdf",1)
 		#norm.write_image("final.hdf",2)
 #		display(final)
 		
@@ -483,25 +655,20 @@ class boxerByRef(QtCore.QObject):
 
 
 	@staticmethod
-	def ccftask(jsd,ref,downsample,gs,microf,ri):
+	def ccftask(jobs,jsd,gs,microf):
+
+		while True:
+			try: ortid,dsref=jobs.get_nowait()
+			except Queue.Empty: return
 
-		mref=ref.process("mask.soft",{"outer_radius":ref["nx"]/2-4,"width":3})
-		mref.process_inplace("normalize.unitlen")
-		
-		for ang in xrange(0,360,10):
-			dsref=mref.process("xform",{"transform":Transform({"type":"2d","alpha":ang})})
-			# don't downsample until after rotation
-			dsref.process_inplace("math.fft.resample",{"n":downsample})
-			dsref.process_inplace("normalize")
 			diff=(gs-dsref["nx"])/2
 			dsref=dsref.get_clip(Region(-diff,-diff,gs,gs))
 			dsref.process_inplace("xform.phaseorigin.tocorner")
 			ccf=microf.calc_ccf(dsref)
 			#ccf.process_inplace("normalize")
-			ccf["ortid"]=ri+ang/360.0			# integer portion is projection number, fractional portion is angle, should be enough precision with the ~100 references we're using
+			ccf["ortid"]=ortid
 
 			jsd.put(ccf)
-		sys.stdout.write("*")
 		
 class boxerLocal(QtCore.QObject):
 	"""Reference based search by downsampling and 2-D alignment to references"""
@@ -590,9 +757,9 @@ class boxerLocal(QtCore.QObject):
 #		final.process_inplace("normalize.edgemean")
 #		final.process_inplace("threshold.belowtozero",{"minval":threshold})
 
-		microdown.write_image("final.hdf",0)
-		final.write_image("final.hdf",1)
-		owner.write_image("final.hdf",2)
+#		microdown.write_image("final.hdf",0)
+#		final.write_image("final.hdf",1)
+#		owner.write_image("final.hdf",2)
 		#norm.write_image("final.hdf",2)
 #		display(final)
 		
@@ -985,7 +1152,7 @@ class boxerConvNet(QtCore.QObject):
 		return boxes
 	
 	@staticmethod
-	def do_autobox_all(filenames,goodrefs,badrefs,apix,nthreads,params,prog=None):
+	def do_autobox_all(filenames,goodrefs,badrefs,apix,nthreads,params,prog=None,mode=None):
 		jobs=[]
 		
 		#### get some parameters...
@@ -1034,23 +1201,8 @@ class boxerConvNet(QtCore.QObject):
 				idx, fsp, newboxes=jsd.get()
 				print "{}) {} boxes -> {}".format(i,len(newboxes),fsp)
 		
-				# if we got nothing, we just leave the current results alone
-				if len(newboxes)==0 : continue
-			
-				# read the existing box list and update
-				db=js_open_dict(info_name(fsp))
-				try: 
-					boxes=db["boxes"]
-					# Filter out all existing boxes for this picking mode
-					bname=newboxes[0][2]
-					boxes=[b for b in boxes if b[2]!=bname]
-				except:
-					boxes=[]
-					
-				boxes.extend(newboxes)
-				
-				db["boxes"]=boxes
-				db.close()
+				save_autoboxes(fsp,newboxes)
+				record_autopick(mode,[fsp])
 				if prog:
 					prog.setValue(thrtolaunch-threading.active_count())
 				
@@ -1775,7 +1927,7 @@ class GUIBoxer(QtGui.QWidget):
 
 		#### let the autoboxer handle the parallelism if they can...
 		if hasattr(cls, "do_autobox_all"):
-			cls.do_autobox_all(self.filenames,self.goodrefs,self.badrefs,self.vbbapix.getValue(),self.vbthreads.getValue(),{},prog)
+			cls.do_autobox_all(self.filenames,self.goodrefs,self.badrefs,self.vbbapix.getValue(),self.vbthreads.getValue(),{},prog,bname)
 			self.restore_boxes()
 			return
 		
@@ -1792,23 +1944,11 @@ class GUIBoxer(QtGui.QWidget):
 			newboxes=cls.do_autobox(micrograph,self.goodrefs,self.badrefs,self.vbbapix.getValue(),self.vbthreads.getValue(),{},prog)
 			print "{}) {} boxes -> {}".format(i,len(newboxes),fsp)
 			
-			# if we got nothing, we just leave the current results alone
+			# if we got nothing, save_autoboxes leaves the current results alone
+			save_autoboxes(fsp,newboxes)
+			record_autopick(bname,[fsp])
 			if len(newboxes)==0 : continue
 		
-			# read the existing box list and update
-			db=js_open_dict(info_name(fsp))
-			try: 
-				boxes=db["boxes"]
-				# Filter out all existing boxes for this picking mode
-				bname=newboxes[0][2]
-				boxes=[b for b in boxes if b[2]!=bname]
-			except:
-				boxes=[]
-				
-			boxes.extend(newboxes)
-			
-			db["boxes"]=boxes
-			db.close()
 			self.setlist.setCurrentRow(i)
 #			self.__updateBoxes()
 			
@@ -40,9 +40,13 @@ import sys
 import random
 from random import choice
 import traceback
+import numpy as np
 
 READ_HEADER_ONLY = True
 
+# particles are held in memory (normalized) across class_average iterations when the class fits within this many bytes
+CACHE_MAX_BYTES = 2.0e9
+
 from EMAN2jsondb import JSTask,jsonclasses
 
 def main():
@@ -435,6 +439,77 @@ def align_one(ptcl,ref,prefilt,align,aligncmp,ralign,raligncmp):
 
 	return ali
 
+def iter_images(images,normproc=("normalize.edgemean",{})):
+	"""Generator yielding each image from an images descriptor (as provided to class_average) in order, as get_image()
+	would. File-based images are read in blocks, with the next block prefetched while the current one is processed."""
+
+	if isinstance(images[0],EMData) : src=(i.copy() for i in images)
+	else : src=iter_images_bulk(images[0],images[1:])
+
+	for im in src:
+		if normproc!=None : im.process_inplace(normproc[0],normproc[1])
+		yield im
+
+def cache_images(images,normproc=("normalize.edgemean",{}),maxbytes=CACHE_MAX_BYTES):
+	"""Reads and normalizes every image in an images descriptor (as provided to class_average) once, returning
+	a list of EMData objects which may be reused for each iteration. If the set would exceed maxbytes
+	of memory, returns None, and the caller should fall back to reading via get_image()"""
+
+	if isinstance(images[0],EMData) : nimg=len(images)
+	else : nimg=len(images)-1
+
+	if isinstance(images[0],EMData) : hdr=images[0]
+	else : hdr=EMData(images[0],images[1],True)
+	if nimg*hdr["nx"]*hdr["ny"]*hdr["nz"]*4>maxbytes : return None
+
+	if isinstance(images[0],EMData) : ret=[i.copy() for i in images]
+	else : ret=read_images_bulk(images[0],images[1:])
+
+	if normproc!=None :
+		for im in ret: im.process_inplace(normproc[0],normproc[1])
+
+	return ret
+
+def align_all(ptcls,ref,prefilt,align,aligncmp,ralign,raligncmp,scmp):
+	"""Aligns a sequence of (pre-normalized) particles to a single reference. This is a generator yielding
+	(aligned particle, similarity to reference) for each particle in turn, so aligned images need not all be held in memory"""
+
+	for ptcl in ptcls:
+		ali=align_one(ptcl,ref,prefilt,align,aligncmp,ralign,raligncmp)
+		yield ali,ali.cmp(scmp[0],ref,scmp[1])		# compare similarity to reference (may use a different cmp() than the aligner)
+
+def keep_mask(sims,keep,keepsig,verbose=0):
+	"""Given a numpy array of similarity values (smaller is better), returns (use,mean,sigma) where use is an integer array
+	of 1/0 flags for particles to include/exclude. keep and keepsig are as described in class_average"""
+
+	mean=sims.mean()
+	sigma=sqrt(max(0.0,(sims**2).mean()-mean**2))
+
+	# set a threshold based on statistics and options
+	if keepsig:					# keep a relative fraction based on the standard deviation of the similarity values
+		thresh=mean+sigma*keep
+		if verbose>1 : print "mean = %f\tsigma = %f\tthresh=%f"%(mean,sigma,thresh)
+	else:						# keep an absolute fraction of the total
+		l=np.sort(sims)
+		try: thresh=l[int(len(l)*keep)]
+		except:
+			if verbose: print "Keeping all particles"
+			thresh=l[-1]+1.0
+
+	if verbose:
+		print "Threshold = %1.4f   Quality: min=%f max=%f mean=%f sigma=%f"%(thresh,sims.min(),sims.max(),mean,sigma)
+
+	use=(sims<=thresh).astype(int)
+	nex=len(use)-use.sum()
+	if verbose : print "%d/%d particles excluded"%(nex,len(use))
+
+	# if all of the particles were thrown out for some reason, we keep the best one
+	if nex==len(use) :
+		use[np.argmin(sims)]=1
+		if verbose : print "Best particle reinstated"
+
+	return use,mean,sigma
+
 def class_average_withali(images,ptcl_info,xform,ref,averager=("mean",{}),normproc=("normalize.edgemean",{}),setsfref=0,verbose=0):
 	"""This will generate a final class-average, given a ptcl_info list as returned by class_average,
 	and a final transform to be applied to each of the relative transforms in ptcl_info. ptcl_info will
@@ -522,19 +597,26 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 		sim=ali.cmp(scmp[0],ref,scmp[1])			# compare similarity to reference (may use a different cmp() than the aligner)
 		return (ali,[(sim,ali["xform.align2d"],1)])
 
+	# Particles are read and normalized only once for all iterations if they will fit in memory
+	ptcls=cache_images(images,normproc)
+	if verbose and ptcls==None : print "Class too large to cache in memory, rereading particles each iteration"
+
 	# If we don't have a reference image, we need to make one
 	if ref==None :
 		if verbose : print "Generating reference"
 #		sigs=[(get_image(i)["sigma"],i) for i in range(nimg)]		# sigma for each input image, inefficient
 #		ref=get_image(images,max(sigs)[1])
-		ref=get_image(images,0,normproc)										# just start with the first, as EMAN1
+		if ptcls!=None : ref=ptcls[0].copy()
+		else : ref=get_image(images,0,normproc)										# just start with the first, as EMAN1
 
 		# now align and average the set to the gradually improving average
 		for i in range(1,nimg):
 			if verbose>1 :
 				print ".",
 				sys.stdout.flush()
-			ali=align_one(get_image(images,i,normproc),ref,prefilt,align,aligncmp,ralign,raligncmp)
+			if ptcls!=None : ptcl=ptcls[i]
+			else : ptcl=get_image(images,i,normproc)
+			ali=align_one(ptcl,ref,prefilt,align,aligncmp,ralign,raligncmp)
 			ref.add(ali)
 
 		# A little masking and centering
@@ -568,6 +650,7 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 
 	# Iterative alignment
 	ptcl_info=[None]*nimg		# empty list of particle info
+	use=np.ones(nimg,dtype=int)
 
 	# This is really niter+1 1/2 iterations. It gets terminated 1/2 way through the final loop
 	for it in range(niter+2):
@@ -578,60 +661,21 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 
 		# Evaluate quality from last iteration, and set a threshold for keeping particles
 		if it>0:
-			# measure statistics of quality values
-			mean,sigma=0,0
-			for sim,xf,use in ptcl_info:
-				mean+=sim
-				sigma+=sim**2
-			mean/=len(ptcl_info)
-			sigma=sqrt(sigma/len(ptcl_info)-mean**2)
-
-			# set a threshold based on statistics and options
-			if keepsig:					# keep a relative fraction based on the standard deviation of the similarity values
-				thresh=mean+sigma*keep
-				if verbose>1 : print "mean = %f\tsigma = %f\tthresh=%f"%(mean,sigma,thresh)
-			else:						# keep an absolute fraction of the total
-				l=[i[0] for i in ptcl_info]
-				l.sort()
-				try: thresh=l[int(len(l)*keep)]
-				except:
-					if verbose: print "Keeping all particles"
-					thresh=l[-1]+1.0
-
-			if verbose:
-				print "Threshold = %1.4f   Quality: min=%f max=%f mean=%f sigma=%f"%(thresh,min(ptcl_info)[0],max(ptcl_info)[0],mean,sigma)
-
-			# mark the particles to keep and exclude
-			nex=0
-			for i,pi in enumerate(ptcl_info):
-				if pi[0]>thresh :
-					nex+=1
-					ptcl_info[i]=(pi[0],pi[1],0)
-				elif pi[2]==0:
-					ptcl_info[i]=(pi[0],pi[1],1)
-
-			if verbose : print "%d/%d particles excluded"%(nex,len(ptcl_info))
-
-			# if all of the particles were thrown out for some reason, we keep the best one
-			if nex==len(ptcl_info) :
-				best=ptcl_info.index(min(ptcl_info))
-				ptcl_info[best]=(ptcl_info[best][0],ptcl_info[best][1],1)
-				if verbose : print "Best particle reinstated"
+			use,mean,sigma=keep_mask(np.array([pi[0] for pi in ptcl_info]),keep,keepsig,verbose)
+			ptcl_info=[(pi[0],pi[1],int(use[i])) for i,pi in enumerate(ptcl_info)]
 
 		if it==niter+1 : break		# This is where the loop actually terminates. This makes sure that inclusion/exclusion is updated at the end
 
 		# Now align and average
+		if ptcls!=None : src=ptcls
+		else : src=iter_images(images,normproc)
+
 		avgr=Averagers.get(averager[0], averager[1])
-		for i in range(nimg):
-			if callback!=None and nimg%10==9 : callback(int((it+i/float(nimg))*100/(niter+2.0)))
-			ptcl=get_image(images,i,normproc)					# get the particle to align
-			ali=align_one(ptcl,ref,prefilt,align,aligncmp,ralign,raligncmp)  # align to reference
-			sim=ali.cmp(scmp[0],ref,scmp[1])			# compare similarity to reference (may use a different cmp() than the aligner)
+		for i,(ali,sim) in enumerate(align_all(src,ref,prefilt,align,aligncmp,ralign,raligncmp,scmp)):
+			if callback!=None and i%10==9 : callback(int((it+i/float(nimg))*100/(niter+2.0)))
 			if saveali and it==niter : ali.write_image("aligned.hdf",-1)
 
-			try: use=ptcl_info[i][2]
-			except: use=1
-			if use :
+			if use[i] :
 				avgr.add_image(ali)				# only include the particle if we've tagged it as good
 				if verbose>1 :
 					sys.stdout.write(".")
@@ -639,7 +683,7 @@ def class_average(images,ref=None,niter=1,normproc=("normalize.edgemean",{}),pre
 			elif verbose>1:
 				sys.stdout.write("X")
 				sys.stdout.flush()
-			ptcl_info[i]=(sim,ali["xform.align2d"],use)
+			ptcl_info[i]=(sim,ali["xform.align2d"],int(use[i]))
 
 		if verbose>1 : print ""
 
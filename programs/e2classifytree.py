@@ -76,16 +76,11 @@ def main():
 	ptcl=args[1]
 	npj=EMUtil.get_image_count(projs)
 	npt=EMUtil.get_image_count(ptcl)
-	if options.parallel==None:
-		par="thread:{:d}".format(options.threads)
-	else:
-		par=options.parallel
-		
 	### Build tree
 	### always overwrite the tree here now
 	#if not os.path.isfile(options.nodes):
 	print "Building binary tree..."
-	buildtree(projs,par,options.nodes,options.incomplete,options.verbose)
+	buildtree(projs,options.parallel,options.nodes,options.incomplete,options.verbose,options.threads)
 	#else:
 		#print "Using existing tree..."
 	
@@ -182,15 +177,21 @@ def main():
 	
 
 	
-def buildtree(projs,par,nodes,incomplete,verbose):
+### Alignment and comparison used between nodes when building the tree. The same values are used for the
+### e2simmx.py runs and for the in-process comparisons of new nodes on later levels
+TREEALIGN=("rotate_translate_flip","sqeuclidean:normto=1","refine","frc:maxres=10.0","frc:maxres=10.0")
+
+def buildtree(projs,parallel,nodes,incomplete,verbose,threads=1):
+	"""Builds the binary tree of the projections in nodes. If parallel is None, the comparisons for the new nodes on
+	each level are done in-process with threads, otherwise every level is run through e2simmx.py with --parallel."""
 	simxorder={0:"tx",1:"ty",2:"alpha",3:"mirror",4:"scale"}
 	nodepath= os.path.abspath(os.path.dirname(nodes))
 	tmpsim='/'.join([nodepath,"tmp_simmix.hdf"])
-	tmplist='/'.join([nodepath,"tmplist.lst"])
-	par="--parallel "+par
+	if parallel==None: par="--parallel thread:{:d}".format(threads)
+	else: par="--parallel "+parallel
 	### Building the similarity matrix for all projections
 	#cmd="e2simmx.py {pj} {pj} {smx} --align=rotate_translate_flip --aligncmp=sqeuclidean:normto=1 --cmp=sqeuclidean --saveali -v {vb:d} --force {parallel}".format(pj=projs,smx=tmpsim, parallel=par, vb=verbose-1)
-	cmd="e2simmx.py {pj} {pj} {smx} --align=rotate_translate_flip --aligncmp=sqeuclidean:normto=1 --cmp=frc:maxres=10.0 --ralign=refine --raligncmp=frc:maxres=10.0 --saveali -v {vb:d} --force {parallel}".format(pj=projs,smx=tmpsim, parallel=par, vb=verbose-1)
+	cmd="e2simmx.py {pj} {pj} {smx} --align={al} --aligncmp={alc} --cmp={c} --ralign={ral} --raligncmp={ralc} --saveali -v {vb:d} --force {parallel}".format(pj=projs,smx=tmpsim,al=TREEALIGN[0],alc=TREEALIGN[1],ral=TREEALIGN[2],ralc=TREEALIGN[3],c=TREEALIGN[4],parallel=par, vb=verbose-1)
 	print cmd
 	launch_childprocess(cmd)
 	
@@ -200,101 +201,168 @@ def buildtree(projs,par,nodes,incomplete,verbose):
 	
 	tr=Transform()
 	npj=EMUtil.get_image_count(projs)
+	imgs={}			# images of the nodes which have not been merged yet, by index in "nodes.hdf"
 	for i in range(npj):
 		pj=EMData(projs,i)
 		pj.process_inplace("normalize.edgemean")
 		pj["tree_children"]=[-1,-1]
 		pj["tree_transform"]=tr
 		pj.write_image(nodes,i)
+		imgs[i]=pj
 		
 	simmx=EMData(tmpsim,0)
 	dst=EMNumPy.em2numpy(simmx)
 	epms=[EMData(tmpsim,i+1) for i in range(5)]
 	pms=[EMNumPy.em2numpy(i) for i in epms]
 	ai =range(dst[0].size)		# index of each node in "nodes.hdf"
-	big=(dst.max()+1)
+	nn=npj						# index of the next new node
 	
-
-	dst+=np.identity(dst[0].size)*big
-	om=0
-	
-	for k in range(dst[0].size-1):
-		#print len(ai),dst[0].size-om 
-
-		### Finish one level, move to next
-		if (dst[0].size-om < 2+incomplete):
-			#omat.fill(0)
-			#print ar
-			om=0
-			if os.path.isfile(tmplist): os.remove(tmplist)
-			rr=LSXFile(tmplist)
-			
-			## FIXME I do not know why I need to write twice here, but e2simmx reads one less line if I don't
-			for r,a in enumerate(ai):
-				rr.write(r,a,nodes)
-				#rr.write(r,a,nodes)
-			rr=None
-			#print len(ai)
-			if len(ai)<10:
-				par=""
-			cmd="e2simmx.py {lst} {lst} {sim} --align=rotate_translate_flip --aligncmp=sqeuclidean:normto=1  --ralign=refine --raligncmp=frc:maxres=10.0 --cmp=frc:maxres=10.0 --saveali -v {vb:d} --force {parallel}".format(lst=tmplist, sim=tmpsim, parallel=par, vb=verbose-1)
-			launch_childprocess(cmd)
-			#launch_childprocess("e2simmx.py {lst} {lst} {sim} --align=rotate_translate_flip --aligncmp=sqeuclidean:normto=1 --cmp=sqeuclidean --saveali -v {vb:d} --force {parallel}".format(lst=tmplist, sim=tmpsim, parallel=par, vb=verbose-1))
-			simmx=EMData(tmpsim,0)
-			dst=EMNumPy.em2numpy(simmx)
-			#print dst
-			dst+=np.identity(dst[0].size)*big
-			epms=[EMData(tmpsim,i+1) for i in range(5)]
-			#print 'size',epms[0]['nx'],epms[0]['ny']
-			pms=[EMNumPy.em2numpy(i) for i in epms]
+	while len(ai)>1:
 		
-		### Find the two children
-		x,y = np.where(dst == np.min(dst))
-		x=x[0]
-		y=y[0]
+		### Find the pairs to merge on this level
+		pairs=pairlevel(dst,incomplete)
+		if verbose>0: print "{} nodes on this level, merging {} pairs".format(len(ai),len(pairs))
 		
-		### Do averaging
-		if verbose>0: print "Averaging ",ai[x],ai[y]," to ",npj+k
+		newai=list(ai)
+		for x,y in pairs:
+			
+			### Do averaging
+			if verbose>0: print "Averaging ",ai[x],ai[y]," to ",nn
+			
+			alipm=[a[x,y] for a in pms]
+			alidict={"type":"2d"}
+			for i,a in simxorder.items():
+				alidict[a]=float(alipm[i])
+			alidict["mirror"]=int(alidict["mirror"])
+			tr=Transform(alidict)
+			img1=imgs.pop(ai[x])
+			img2=imgs.pop(ai[y])
+			img1["tree_transform"]=tr
+			img1.write_image(nodes,ai[x])
+			img1.process_inplace("xform",{"transform":tr})
+			img1.add(img2)
+			img1.div(2)
+			#img1.process_inplace("normalize.edgemean")
+			img1["tree_children"]=[ai[x],ai[y]]
+			img1.write_image(nodes,-1)
+			imgs[nn]=img1
+			
+			newai[x]=nn
+			newai[y]=None
+			nn+=1
 		
-		alipm=[a[x,y] for a in pms]
-		alidict={"type":"2d"}
-		for i,a in simxorder.items():
-			alidict[a]=float(alipm[i])
-		alidict["mirror"]=int(alidict["mirror"])
-		#print x,y,alipm,alidict
-		tr=Transform(alidict)
-		img1=EMData(nodes,ai[x])
-		img2=EMData(nodes,ai[y])
-		img1["tree_transform"]=tr
-		img1.write_image(nodes,ai[x])
-		img1.process_inplace("xform",{"transform":tr})
-		img1.add(img2)
-		img1.div(2)
-		#img1.process_inplace("normalize.edgemean")
-		img1["tree_children"]=[ai[x],ai[y]]
-		img1.write_image(nodes,-1)
-		om+=1
+		### Distance matrix for the next level. Pairs of nodes left over from this level are unchanged
+		### in dst (only the rows and columns of merged nodes are overwritten), everything else is new
+		old=dict((a,i) for i,a in enumerate(ai))
+		ai=[a for a in newai if a!=None]
+		if len(ai)<2 : break
 		
+		ndst=np.zeros((len(ai),len(ai)),dtype=np.float32)
+		npms=[np.zeros((len(ai),len(ai)),dtype=np.float32) for i in range(5)]
+		keep=[i for i in range(len(ai)) if ai[i]<nn-len(pairs)]
+		new=[i for i in range(len(ai)) if ai[i]>=nn-len(pairs)]
+		if len(keep)>0:
+			oi=np.array([old[ai[i]] for i in keep])
+			ndst[np.ix_(keep,keep)]=dst[np.ix_(oi,oi)]
+			for nrw in range(5): npms[nrw][np.ix_(keep,keep)]=pms[nrw][np.ix_(oi,oi)]
 		
-		### Update the distance matrix
-		for nrw in range(5):
-			pms[nrw][x,:]=0
-			pms[nrw][:,x]=0
-			pms[nrw]=np.delete(pms[nrw],y,0)
-			pms[nrw]=np.delete(pms[nrw],y,1)
-			
-		dst[x,:]=big
-		dst[:,x]=big
-		dst=np.delete(dst,y,0)
-		dst=np.delete(dst,y,1)
-		
-		ai[x]=npj+k
-		del ai[y]
+		if parallel==None:
+			nodesimmx(imgs,ai,new,ndst,npms,threads)
+		else:
+			simmxlevel(nodes,ai,new,ndst,npms,tmpsim,par,verbose)
+		dst=ndst
+		pms=npms
 	
 	os.remove(tmpsim)
-	os.remove(tmplist)
 	return 	
 
+def pairlevel(dst,incomplete):
+	"""Greedily pairs the nodes on one level of the tree, closest pair first, as long as at least 2+incomplete nodes
+	are left unpaired (the first pair is always made). dst is the full (not necessarily symmetric) distance matrix. The
+	rows and columns of paired nodes are overwritten in place. Returns the list of (x,y) pairs in the order merged.
+	The nearest remaining neighbor of each row is cached, and only rows whose neighbor was just paired are rescanned,
+	so a level costs O(n^2) rather than a full-matrix search per merge."""
+	
+	n=len(dst)
+	dst[np.arange(n),np.arange(n)]=np.inf
+	nbr=np.argmin(dst,1)
+	nbrd=dst[np.arange(n),nbr]
+	
+	pairs=[]
+	nleft=n
+	while len(pairs)==0 or nleft>=2+incomplete:
+		x=np.argmin(nbrd)
+		y=nbr[x]
+		pairs.append((x,y))
+		nleft-=2
+		
+		### x and y are no longer available on this level
+		dst[:,x]=np.inf
+		dst[:,y]=np.inf
+		nbrd[x]=np.inf
+		nbrd[y]=np.inf
+		redo=np.where(((nbr==x)|(nbr==y))&(nbrd<np.inf))[0]
+		if len(redo)>0 :
+			nbr[redo]=np.argmin(dst[redo],1)
+			nbrd[redo]=dst[redo,nbr[redo]]
+	
+	return pairs
+
+def nodesimmx(imgs,ai,new,dst,pms,threads):
+	"""Aligns and compares node images in-process with TREEALIGN, as e2simmx.py would. ai is the list of node indices
+	on the level and new the positions in ai of the new nodes. Every pair (i,j) with i or j new is filled in dst and
+	pms from compare(imgs[ai[j]],imgs[ai[i]]), ie - ai[i] aligned to ai[j]. The pairs are generated as the threads
+	ask for them rather than listed up front."""
+	
+	isnew=set(new)
+	jobs=((i,j) for i in xrange(len(ai)) for j in (xrange(len(ai)) if i in isnew else new) if i!=j)
+	jlock=threading.Lock()
+	
+	def cmpthread():
+		### each thread has its own options, compare() modifies the refine aligner parameters
+		options={"align":parsemodopt(TREEALIGN[0]), "alicmp":parsemodopt(TREEALIGN[1]), "ralign":parsemodopt(TREEALIGN[2]), "alircmp":parsemodopt(TREEALIGN[3]), "cmp":parsemodopt(TREEALIGN[4])}
+		while 1:
+			with jlock:
+				try: i,j=jobs.next()
+				except StopIteration: return
+			### aligners may cache data in the images, so the shared images are not used directly
+			s=compare(imgs[ai[j]].copy(),imgs[ai[i]].copy(),options)
+			dst[i,j]=s[0]
+			for nrw in range(5): pms[nrw][i,j]=s[nrw+2]
+	
+	thrds=[threading.Thread(target=cmpthread) for i in range(max(1,threads))]
+	for t in thrds: t.start()
+	for t in thrds: t.join()
+
+def simmxlevel(nodes,ai,new,dst,pms,tmpsim,par,verbose):
+	"""Fills the same entries of dst and pms as nodesimmx, using e2simmx.py with the given --parallel option. The
+	new nodes are compared against all nodes on the level in both directions, in two runs."""
+	
+	nodepath= os.path.abspath(os.path.dirname(nodes))
+	alllst='/'.join([nodepath,"tmp_tree_all.lst"])
+	newlst='/'.join([nodepath,"tmp_tree_new.lst"])
+	for lst,idx in ((alllst,ai),(newlst,[ai[i] for i in new])):
+		if os.path.isfile(lst): os.remove(lst)
+		rr=LSXFile(lst)
+		for r,a in enumerate(idx):
+			rr.write(r,a,nodes)
+		rr=None
+	
+	### in the e2simmx.py output, columns are the first input (references) and rows the second
+	for c,r in ((newlst,alllst),(alllst,newlst)):
+		cmd="e2simmx.py {c} {r} {sim} --align={al} --aligncmp={alc} --cmp={cm} --ralign={ral} --raligncmp={ralc} --saveali -v {vb:d} --force {parallel}".format(c=c,r=r,sim=tmpsim,al=TREEALIGN[0],alc=TREEALIGN[1],ral=TREEALIGN[2],ralc=TREEALIGN[3],cm=TREEALIGN[4],parallel=par, vb=verbose-1)
+		launch_childprocess(cmd)
+		mx=[EMNumPy.em2numpy(EMData(tmpsim,i)) for i in range(6)]
+		if c==newlst:
+			dst[:,new]=mx[0]
+			for nrw in range(5): pms[nrw][:,new]=mx[nrw+1]
+		else:
+			dst[new,:]=mx[0]
+			for nrw in range(5): pms[nrw][new,:]=mx[nrw+1]
+	
+	os.remove(alllst)
+	os.remove(newlst)
+
 ### Do ref-target comparison
 def compare(ref,target,options):
 	
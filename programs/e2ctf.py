@@ -45,6 +45,7 @@ import traceback
 from numpy import array,arange
 import numpy
 import threading
+import Queue
 
 from Simplex import Simplex
 
@@ -224,21 +225,12 @@ NOTE: This program should be run from the project directory, not from within the
 	options.filenames = args
 
 	### Power spectrum and CTF fitting
-	if nthreads>1:
-		print "Fitting in parallel with ",nthreads," threads"
-		chunksize=int(ceil(float(len(args))/nthreads))
-#		print " ".join(sys.argv+["--chunk={},{}".format(chunksize,0)])
-		threads=[threading.Thread(target=os.system,args=[" ".join(sys.argv+["--chunk={},{}".format(chunksize,i)])]) for i in xrange(nthreads)]
-		for t in threads: t.start()
-		for t in threads: t.join()
-		print "Parallel fitting complete"
-	else:
-		img_sets=None
-		if options.autofit:
-			img_sets=pspec_and_ctf_fit(options,debug) # converted to a function so to work with the workflow
-
-			if options.constbfactor>0:
-				for i in img_sets: i[1].bfactor=options.constbfactor
+	img_sets=None
+	if options.autofit:
+		img_sets=pspec_and_ctf_fit(options,debug,nthreads) # converted to a function so to work with the workflow
+
+		if options.constbfactor>0:
+			for i in img_sets: i[1].bfactor=options.constbfactor
 
 	### GUI - user can update CTF parameters interactively
 	if options.gui :
@@ -535,112 +527,167 @@ def fixnegbg(bg_1d,im_1d,ds):
 	print "BG correction ratio %1.4f"%ratio
 	return [i*ratio for i in bg_1d]
 
-def pspec_and_ctf_fit(options,debug=False):
-	"""Power spectrum and CTF fitting. Returns an 'image sets' list. Each item in this list contains
-	filename,EMAN2CTF,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d/None"""
-	global logid
-	img_sets=[]
-	#db_parms=db_open_dict("bdb:e2ctf.parms")
-	#db_im2d=db_open_dict("bdb:e2ctf.im2d")
-	#db_bg2d=db_open_dict("bdb:e2ctf.bg2d")
-
-	for i,filename in enumerate(options.filenames):
-		name=base_name(filename)
-		try : js_parms=js_open_dict(info_name(filename))
-		except :
-			print "ERROR: Cannot open {} for metadata storage. Exiting.".format(info_name(filename))
-			sys.exit(1)
+def fit_micrograph(options,filename,debug=False):
+	"""Computes the power spectra and fits the CTF for a single particle stack. Nothing is written to disk, so this
+	may be called from multiple threads at once. Returns (img_sets,parms), where img_sets is a list of 'image sets'
+	(see pspec_and_ctf_fit) and parms is a dictionary of values to store in the stack's info file. Returns None on failure."""
 
-		# compute the power spectra
-		if options.verbose or debug : print "Processing ",filename
-		apix=options.apix
-		if apix<=0 : apix=EMData(filename,0,1)["apix_x"]
+	try : js_parms=js_open_dict(info_name(filename))
+	except :
+		print "ERROR: Cannot open {} for metadata storage.".format(info_name(filename))
+		return None
+
+	# compute the power spectra
+	if options.verbose or debug : print "Processing ",filename
+	apix=options.apix
+	if apix<=0 : apix=EMData(filename,0,1)["apix_x"]
+
+	# After this, PS contains a list of (im_1d,bg_1d,im_2d,bg_2d,bg_1d_low) tuples. If classify is <2 then this list will have only 1 tuple in it
+	if options.classify>1 : ps=split_powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,nclasses=options.classify,zero_ok=options.zerook)
+	else: ps=list((powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,zero_ok=options.zerook,wholeimage=options.wholeimage,highdensity=options.highdensity),))
+	# im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d/none
+	if ps==None :
+		print "Error fitting CTF on ",filename
+		return None
+	try: ds=1.0/(apix*ps[0][2].get_ysize())
+	except:
+		print "Error fitting CTF (ds) on ",filename
+		return None
 
-		# After this, PS contains a list of (im_1d,bg_1d,im_2d,bg_2d,bg_1d_low) tuples. If classify is <2 then this list will have only 1 tuple in it
-		if options.classify>1 : ps=split_powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,nclasses=options.classify,zero_ok=options.zerook)
-		else: ps=list((powspec_with_bg(filename,options.source_image,radius=options.bgmask,edgenorm=not options.nonorm,oversamp=options.oversamp,apix=apix,zero_ok=options.zerook,wholeimage=options.wholeimage,highdensity=options.highdensity),))
-		# im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d/none
-		if ps==None :
-			print "Error fitting CTF on ",filename
-			continue
-		try: ds=1.0/(apix*ps[0][2].get_ysize())
+	img_sets=[]
+	parms={"apix":apix}
+	for j,p in enumerate(ps):
+		try: im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d=p
 		except:
-			print "Error fitting CTF (ds) on ",filename
-			continue
+			im_1d,bg_1d,im_2d,bg_2d,bg_1d_low=p
+			micro_1d=None
+		if not options.nosmooth : bg_1d=smooth_bg(bg_1d,ds)
+		if options.fixnegbg :
+			bg_1d=fixnegbg(bg_1d,im_1d,ds)		# This insures that we don't have unreasonable negative values
 
-		for j,p in enumerate(ps):
-			try: im_1d,bg_1d,im_2d,bg_2d,bg_1d_low,micro_1d=p
-			except:
-				im_1d,bg_1d,im_2d,bg_2d,bg_1d_low=p
-				micro_1d=None
-			if not options.nosmooth : bg_1d=smooth_bg(bg_1d,ds)
-			if options.fixnegbg :
-				bg_1d=fixnegbg(bg_1d,im_1d,ds)		# This insures that we don't have unreasonable negative values
-
-			if debug: Util.save_data(0,ds,bg_1d,"ctf.bgb4.txt")
+		if debug: Util.save_data(0,ds,bg_1d,"ctf.bgb4.txt")
 
-			# Fit the CTF parameters
-			if debug : print "Fit CTF"
-			if options.curdefocushint or options.curdefocusfix:
+		# Fit the CTF parameters
+		if debug : print "Fit CTF"
+		if options.curdefocushint or options.curdefocusfix:
+			try:
+				if options.useframedf : raise Exception		# a bit of a hack...
+				ctf=js_parms["ctf"][0]
+				curdf=ctf.defocus
+				curdfdiff=ctf.dfdiff
+				curdfang=ctf.dfang
+				if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
+				else: dfhint=(curdf-.001,curdf+.001)
+				print "Using existing defocus as hint :",dfhint
+			except :
 				try:
-					if options.useframedf : raise Exception		# a bit of a hack...
-					ctf=js_parms["ctf"][0]
+					ctf=js_parms["ctf_frame"][1]
 					curdf=ctf.defocus
 					curdfdiff=ctf.dfdiff
 					curdfang=ctf.dfang
 					if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
 					else: dfhint=(curdf-.001,curdf+.001)
-					print "Using existing defocus as hint :",dfhint
-				except :
-					try:
-						ctf=js_parms["ctf_frame"][1]
-						curdf=ctf.defocus
-						curdfdiff=ctf.dfdiff
-						curdfang=ctf.dfang
-						if options.curdefocushint: dfhint=(curdf-0.1,curdf+0.1)
-						else: dfhint=(curdf-.001,curdf+.001)
-						print "Using existing defocus from frame as hint :",dfhint
-					except:
-						dfhint=None
-						print "No existing defocus to start with"
-			else: dfhint=(options.defocusmin,options.defocusmax)
-			ctf=ctf_fit(im_1d,bg_1d,bg_1d_low,im_2d,bg_2d,options.voltage,max(options.cs,0.01),options.ac,apix,bgadj=not options.nosmooth,autohp=options.autohp,dfhint=dfhint,highdensity=options.highdensity,verbose=options.verbose)
-			if options.astigmatism and not options.curdefocusfix : ctf_fit_stig(im_2d,bg_2d,ctf,verbose=1)
-			elif options.astigmatism:
-				ctf.dfdiff=curdfdiff
-				ctf.dfang=curdfang
-
-			im_1d,bg_1d=calc_1dfrom2d(ctf,im_2d,bg_2d)
-			if options.constbfactor>0 : ctf.bfactor=options.constbfactor
-			else: ctf.bfactor=ctf_fit_bfactor(list(array(im_1d)-array(bg_1d)),ds,ctf)
-
-
-			if debug:
-				Util.save_data(0,ds,im_1d,"ctf.fg.txt")
-				Util.save_data(0,ds,bg_1d,"ctf.bg.txt")
-				Util.save_data(0,ds,ctf.snr,"ctf.snr.txt")
-
-			try : qual=js_parms["quality"]
-			except :
-				qual=5
-				js_parms["quality"]=5
-			if j==0: img_sets.append([filename,ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
-			else: img_sets.append([filename+"_"+str(j),ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
-
-		# store the results back in the database. We omit the filename, quality and bg_1d_low (which can be easily recomputed)
-		if img_sets[-1][-1]==None: js_parms.delete("ctf_microbox")
-		else: js_parms["ctf_microbox"]=img_sets[-1][-1]
-		js_parms["ctf"]=img_sets[-1][1:4]
-		js_parms["ctf_im2d"]=img_sets[-1][4]
-		js_parms["ctf_bg2d"]=img_sets[-1][5]
-		js_parms.close()
+					print "Using existing defocus from frame as hint :",dfhint
+				except:
+					dfhint=None
+					print "No existing defocus to start with"
+		else: dfhint=(options.defocusmin,options.defocusmax)
+		ctf=ctf_fit(im_1d,bg_1d,bg_1d_low,im_2d,bg_2d,options.voltage,max(options.cs,0.01),options.ac,apix,bgadj=not options.nosmooth,autohp=options.autohp,dfhint=dfhint,highdensity=options.highdensity,verbose=options.verbose)
+		if options.astigmatism and not options.curdefocusfix : ctf_fit_stig(im_2d,bg_2d,ctf,verbose=1)
+		elif options.astigmatism:
+			ctf.dfdiff=curdfdiff
+			ctf.dfang=curdfang
+
+		im_1d,bg_1d=calc_1dfrom2d(ctf,im_2d,bg_2d)
+		if options.constbfactor>0 : ctf.bfactor=options.constbfactor
+		else: ctf.bfactor=ctf_fit_bfactor(list(array(im_1d)-array(bg_1d)),ds,ctf)
+
+
+		if debug:
+			Util.save_data(0,ds,im_1d,"ctf.fg.txt")
+			Util.save_data(0,ds,bg_1d,"ctf.bg.txt")
+			Util.save_data(0,ds,ctf.snr,"ctf.snr.txt")
+
+		try : qual=js_parms["quality"]
+		except :
+			qual=5
+			parms["quality"]=5
+		if j==0: img_sets.append([filename,ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
+		else: img_sets.append([filename+"_"+str(j),ctf,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d])
 
-		if logid : E2progress(logid,float(i+1)/len(options.filenames))
+	# the results to store back in the database. We omit the filename, quality and bg_1d_low (which can be easily recomputed)
+	parms["ctf_microbox"]=img_sets[-1][-1]
+	parms["ctf"]=img_sets[-1][1:4]
+	parms["ctf_im2d"]=img_sets[-1][4]
+	parms["ctf_bg2d"]=img_sets[-1][5]
+
+	return img_sets,parms
+
+def fit_micrograph_thread(options,jobs,results,debug=False):
+	"""Worker thread for pspec_and_ctf_fit. Pulls (n,filename) from the jobs queue until it is empty, and puts
+	(n,filename,result) on the results queue"""
+
+	while True:
+		try: i,filename=jobs.get_nowait()
+		except Queue.Empty: return
+
+		try: ret=fit_micrograph(options,filename,debug)
+		except:
+			traceback.print_exc()
+			print "Error fitting CTF on ",filename
+			ret=None
+		results.put((i,filename,ret))
+
+def store_ctf_parms(filename,parms):
+	"""Writes the dictionary produced by fit_micrograph to the stack's info file in a single transaction"""
+
+	js_parms=js_open_dict(info_name(filename))
+	for k,v in parms.items():
+		if k=="apix" : continue
+		if v==None : js_parms.delete(k,True)
+		else: js_parms.setval(k,v,True)
+	js_parms.sync()
+	js_parms.close()
+
+def pspec_and_ctf_fit(options,debug=False,nthreads=1):
+	"""Power spectrum and CTF fitting. Returns an 'image sets' list. Each item in this list contains
+	filename,EMAN2CTF,im_1d,bg_1d,im_2d,bg_2d,qual,bg_1d_low,micro_1d/None
+
+	If nthreads>1, micrographs are fit by a pool of threads which share the structure factor and mask
+	caches. Each thread takes the next unprocessed micrograph when it finishes one, and all metadata
+	is written by the calling thread as results arrive."""
+	global logid
+
+	jobs=Queue.Queue(0)
+	for i,filename in enumerate(options.filenames): jobs.put((i,filename))
+	results=Queue.Queue(0)
+
+	nthreads=max(1,min(nthreads,len(options.filenames)))
+	if nthreads>1 : print "Fitting in parallel with ",nthreads," threads"
+	thrds=[threading.Thread(target=fit_micrograph_thread,args=(options,jobs,results,debug)) for i in xrange(nthreads)]
+	for t in thrds: t.start()
+
+	fits={}
+	apix=None
+	for n in xrange(len(options.filenames)):
+		i,filename,ret=results.get()
+		if ret!=None :
+			fits[i],parms=ret
+			apix=parms["apix"]
+			store_ctf_parms(filename,parms)
+
+		if logid : E2progress(logid,float(n+1)/len(options.filenames))
+
+	for t in thrds: t.join()
+
+	# keep the results in the same order as the input files
+	img_sets=[]
+	for i in sorted(fits): img_sets.extend(fits[i])
 
 	project_db = js_open_dict("info/project.json")
-	try: project_db.update({ "global.microscope_voltage":options.voltage, "global.microscope_cs":options.cs, "global.apix":apix })
-	except:
+	if apix==None :
 		print "ERROR: apix not found. This probably means that no CTF curves were sucessfully fit !"
+	else: project_db.update({ "global.microscope_voltage":options.voltage, "global.microscope_cs":options.cs, "global.apix":apix })
 
 	return img_sets
 
@@ -960,24 +1007,17 @@ def powspec(stackfile,source_image=None,mask=None,edgenorm=True):
 	Results returned as a 2-D FFT intensity/0 image"""
 
 	n=EMUtil.get_image_count(stackfile)
-
-	for i in range(n):
-		if source_image!=None :
-			im1=EMData()
-			im1.read_image(stackfile,i,True)
-			try:
-				if im1["ptcl_source_image"]!=source_image : continue
-			except:
-				print "Image %d doesn't have the ptcl_source_image parameter. Skipping."%i
-				continue
-
-		im=EMData(stackfile,i)
-		if edgenorm : im.process_inplace("normalize.edgemean")
-		if mask : im*=mask
-		imf=im.do_fft()
-		imf.ri2inten()
-		if i==0: av=imf
-		else: av+=imf
+	if source_image!=None : ptclns=source_image_ptcls(stackfile,source_image)
+	else : ptclns=range(n)
+	ys=EMData(stackfile,0,True)["ny"]
+
+	av=0
+	for blk in read_ptcl_blocks(stackfile,ptclns,ys):
+		ims=[im for i,im in blk]
+		if edgenorm :
+			for im in ims: im.process_inplace("normalize.edgemean")
+		av=av+inten_sums(ims,(mask,))[0]
+	av=inten_image(av)
 
 	av/=(float(n)*av.get_ysize()*av.get_ysize())
 	av.set_value_at(0,0,0.0)
@@ -989,34 +1029,77 @@ def powspec(stackfile,source_image=None,mask=None,edgenorm=True):
 	#db_close_dict(stackfile)		# safe for non bdb urls
 	return av
 
-masks={}		# mask cache for background/foreground masking
-def powspec_with_bg(stackfile,source_image=None,radius=0,edgenorm=True,oversamp=1,apix=2,ptclns=None,zero_ok=False,wholeimage=False,highdensity=False):
-	"""This routine will read the images from the specified file, optionally edgenormalize,
-	then apply a gaussian mask with the specified radius then compute the average 2-D power
-	spectrum for the stack. It will also compute the average 2-D power spectrum using 1-mask + edge
-	apotization to get an appoximate 'background' power spectrum. 2-D results returned as a 2-D FFT
-	intensity/0 image. 1-D results returned as a list of floats. If source_image is provided, then it
-	will only read particles with ptcl_source_image set to the specified value.
+PSBLOCKPIX=1<<22	# number of pixels in each block of particles read and transformed together for power spectra
 
-	At present, highdensity does nothing here, that is implemented in ctf_fit
+srcindex={}		# per-stack cache of particle numbers for each ptcl_source_image, with the file modification time
+srcindexlock=threading.Lock()
+def source_image_ptcls(stackfile,source_image):
+	"""Returns a list of the particle numbers in stackfile with ptcl_source_image set to source_image. The index
+	is built from one bulk header column read, and is reused until the file is modified."""
 
-	returns a 5-tuple with spectra for (1d particle,1d background,2d particle,2d background,1d background non-convex,1d foreground from wholeimage or None)
-	"""
+	try: mtime=os.stat(stackfile).st_mtime
+	except: mtime=None
 
-	global masks
+	with srcindexlock:
+		if stackfile in srcindex and srcindex[stackfile][0]==mtime : return srcindex[stackfile][1].get(source_image,[])
 
-	im=EMData(stackfile,0)
-	ys=im.get_ysize()*oversamp
-	ys2=im.get_ysize()
-	if radius<=0 : radius=ys2/2.6
-	n=EMUtil.get_image_count(stackfile)
-	nn=0
-	ds=1.0/(apix*ys)	# oversampled ds
+	idx={}
+	for i,src in enumerate(get_attr_column(stackfile,"ptcl_source_image")):
+		if src==None : print "Image %d doesn't have the ptcl_source_image parameter. Skipping."%i
+		else : idx.setdefault(src,[]).append(i)
+
+	with srcindexlock: srcindex[stackfile]=(mtime,idx)
+	return idx.get(source_image,[])
+
+def read_ptcl_blocks(stackfile,ptclns,ys):
+	"""Generator returning the specified particles from stackfile as lists of (n,EMData). Particles are read
+	in blocks of about PSBLOCKPIX pixels."""
+
+	bs=max(1,PSBLOCKPIX/(ys*ys))
+	for j in xrange(0,len(ptclns),bs):
+		ns=ptclns[j:j+bs]
+		yield zip(ns,EMData.read_images(stackfile,ns))
+
+def ptcl_intens(a,mask=None):
+	"""Given a (n,ny,nx) numpy array of real-space images and an optional EMData mask, returns a (n,ny,nx/2+1)
+	array containing the Fourier intensities of each masked image. All of the FFTs in a block share a single plan."""
+
+	if mask is not None : a=a*mask.numpy()
+	f=numpy.fft.rfft2(a,axes=(1,2))
+	return f.real**2+f.imag**2
+
+def inten_sums(ims,masks):
+	"""Returns a list with one numpy array for each mask (or None) in masks, containing the sum of the Fourier
+	intensities of all of the masked images in ims"""
+
+	a=numpy.array([im.numpy() for im in ims])
+	return [ptcl_intens(a,m).sum(0) for m in masks]
+
+def inten_image(a):
+	"""Converts a numpy array of Fourier intensities from ptcl_intens/inten_sums into a complex EMData
+	intensity image of the sort produced by ri2inten()"""
+
+	ny,nx=a.shape
+	av=EMData(nx*2,ny,1)
+	av.set_complex(True)
+	av.to_zero()
+	av.numpy()[:,::2]=a
+	av.update()
+	av["is_intensity"]=1
+	return av
+
+masks={}		# mask cache for background/foreground masking
+masklock=threading.Lock()
+def bg_masks(ys2,oversamp,radius):
+	"""Returns (mask1,ratio1,mask2,ratio2), the inner Gaussian (particle) and outer (background) masks used by
+	powspec_with_bg and split_powspec_with_bg. Masks are cached, and the cache may be shared among threads.
+	The returned masks must not be modified."""
+
+	ys=ys2*oversamp
+	with masklock:
+		try: return masks[(ys,radius)]
+		except: pass
 
-	# set up the inner and outer Gaussian masks
-	try:
-		mask1,ratio1,mask2,ratio2=masks[(ys,radius)]
-	except:
 		# Mask 1 is an "inner" Gaussian to extract primarily the particle from the middle of the image
 		mask1=EMData(ys2,ys2,1)
 		mask1.to_one()
@@ -1034,60 +1117,69 @@ def powspec_with_bg(stackfile,source_image=None,radius=0,edgenorm=True,oversamp=
 		masks[(ys,radius)]=(mask1,ratio1,mask2,ratio2)
 #		display((mask1,mask2))
 
-	av1,av2=None,None
-	for i in range(n):
-		if ptclns!=None and i not in ptclns :continue
-		im1 = EMData()
-		if source_image!=None :
-			im1.read_image(stackfile,i,True)
-			try:
-				if im1["ptcl_source_image"]!=source_image : continue
-			except:
-				print "Image %d doesn't have the ptcl_source_image parameter. Skipping."%i
-				continue
-
-		im1.read_image(stackfile,i)
+	return masks[(ys,radius)]
 
-		# Images with flat edges due to boxing too close to the edge can adversely impact the power spectrum
-		if not zero_ok :
-			im1.process_inplace("mask.zeroedgefill",{"nonzero":1})		# This tries to deal with particles that were boxed off the edge of the micrograph
-			if im1.has_attr("hadzeroedge") and im1["hadzeroedge"]!=0:
-				print "Skipped particle with bad edge ({}:{})".format(stackfile,i)
-				continue
+def powspec_with_bg(stackfile,source_image=None,radius=0,edgenorm=True,oversamp=1,apix=2,ptclns=None,zero_ok=False,wholeimage=False,highdensity=False):
+	"""This routine will read the images from the specified file, optionally edgenormalize,
+	then apply a gaussian mask with the specified radius then compute the average 2-D power
+	spectrum for the stack. It will also compute the average 2-D power spectrum using 1-mask + edge
+	apotization to get an appoximate 'background' power spectrum. 2-D results returned as a 2-D FFT
+	intensity/0 image. 1-D results returned as a list of floats. If source_image is provided, then it
+	will only read particles with ptcl_source_image set to the specified value.
 
-		nn+=1
-#		im1=EMData(stackfile,i)
+	At present, highdensity does nothing here, that is implemented in ctf_fit
 
-		if edgenorm : im1.process_inplace("normalize.edgemean")
-		if oversamp>1 :
-#			print Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys)
-			im1.clip_inplace(Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys))
+	returns a 5-tuple with spectra for (1d particle,1d background,2d particle,2d background,1d background non-convex,1d foreground from wholeimage or None)
+	"""
 
-		im2=im1.copy()
+	im=EMData(stackfile,0)
+	ys=im.get_ysize()*oversamp
+	ys2=im.get_ysize()
+	if radius<=0 : radius=ys2/2.6
+	n=EMUtil.get_image_count(stackfile)
+	nn=0
+	ds=1.0/(apix*ys)	# oversampled ds
 
-#		print im2.get_size(), im1.get_size()
+	# set up the inner and outer Gaussian masks
+	mask1,ratio1,mask2,ratio2=bg_masks(ys2,oversamp,radius)
+
+	if source_image!=None :
+		ptcls=source_image_ptcls(stackfile,source_image)
+		if ptclns!=None :
+			ptclns=set(ptclns)
+			ptcls=[i for i in ptcls if i in ptclns]
+	elif ptclns!=None : ptcls=sorted(ptclns)
+	else: ptcls=range(n)
+
+	# Particles are read in blocks, and the foreground and background power spectra for each block are computed together
+	# sum1/2 contain the incoherent summed power spectra (intensity sum)
+	sum1,sum2=0,0
+	for blk in read_ptcl_blocks(stackfile,ptcls,ys2):
+		ims=[]
+		for i,im1 in blk:
+			# Images with flat edges due to boxing too close to the edge can adversely impact the power spectrum
+			if not zero_ok :
+				im1.process_inplace("mask.zeroedgefill",{"nonzero":1})		# This tries to deal with particles that were boxed off the edge of the micrograph
+				if im1.has_attr("hadzeroedge") and im1["hadzeroedge"]!=0:
+					print "Skipped particle with bad edge ({}:{})".format(stackfile,i)
+					continue
+
+			if edgenorm : im1.process_inplace("normalize.edgemean")
+			if oversamp>1 :
+				im1.clip_inplace(Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys))
+			ims.append(im1)
+
+		if len(ims)==0 : continue
+		nn+=len(ims)
 
 		# now we compute power spectra for the 2 regions defined by the masks
-		# av1/2 contain the incoherent averaged power spectra (intensity average)
-		im1*=mask1
-		imf=im1.do_fft()
-		imf.ri2inten()
-		if av1==None:
-			av1=EMData(imf["nx"],imf["ny"],imf["nz"])	# we make a new object to avoid copying the header of imf
-			av1.set_complex(True)
-			av1.to_zero()
-		av1+=imf
-
-		im2*=mask2
-		imf=im2.do_fft()
-		imf.ri2inten()
-		if av2==None:
-			av2=EMData(imf["nx"],imf["ny"],imf["nz"])
-			av2.set_complex(True)
-			av2.to_zero()
-		av2+=imf
+		s1,s2=inten_sums(ims,(mask1,mask2))
+		sum1=sum1+s1
+		sum2=sum2+s2
 
 	if nn==0 : return None
+	av1=inten_image(sum1)
+	av2=inten_image(sum2)
 
 	# normalize the 2 curves
 	av1/=(float(nn)*av1.get_ysize()*av1.get_ysize()*ratio1)
@@ -1174,8 +1266,6 @@ def split_powspec_with_bg(stackfile,source_image=None,radius=0,edgenorm=True,ove
 Rather than returning a single tuple, returns a list of nclasses tuples.
 	"""
 
-	global masks
-
 	im=EMData(stackfile,0)
 	ys=im.get_ysize()*oversamp
 	ys2=im.get_ysize()
@@ -1185,66 +1275,31 @@ Rather than returning a single tuple, returns a list of nclasses tuples.
 	ds=1.0/(apix*ys)	# oversampled ds
 
 	# set up the inner and outer Gaussian masks
-	try:
-		mask1,ratio1,mask2,ratio2=masks[(ys,radius)]
-	except:
-		mask1=EMData(ys2,ys2,1)
-		mask1.to_one()
-		mask1.process_inplace("mask.gaussian",{"outer_radius":radius,"exponent":4.0})
-		mask2=mask1.copy()*-1+1
-#		mask1.process_inplace("mask.decayedge2d",{"width":4})
-		mask2.process_inplace("mask.decayedge2d",{"width":4})
-		mask1.clip_inplace(Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys))
-		mask2.clip_inplace(Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys))
-		ratio1=mask1.get_attr("square_sum")/(ys*ys)	#/1.035
-		ratio2=mask2.get_attr("square_sum")/(ys*ys)
-		masks[(ys,radius)]=(mask1,ratio1,mask2,ratio2)
-#		display((mask1,mask2))
+	mask1,ratio1,mask2,ratio2=bg_masks(ys2,oversamp,radius)
 
-	av_1d_n=[]
-	for i in range(n):
-		im1 = EMData()
-		if source_image!=None :
-			im1.read_image(stackfile,i,True)
-			try:
-				if im1["ptcl_source_image"]!=source_image : continue
-			except:
-				print "Image %d doesn't have the ptcl_source_image parameter. Skipping."%i
-				continue
-
-		im1.read_image(stackfile,i)
-		nn+=1
-#		im1=EMData(stackfile,i)
+	if source_image!=None : ptcls=source_image_ptcls(stackfile,source_image)
+	else: ptcls=range(n)
 
-		if edgenorm : im1.process_inplace("normalize.edgemean")
-		if oversamp>1 :
-#			print Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys)
-			im1.clip_inplace(Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys))
-
-		im2=im1.copy()
-
-#		print im2.get_size(), im1.get_size()
-
-		im1*=mask1
-		imf=im1.do_fft()
-		imf.ri2inten()
-		if i==0:
-			av1=EMData(imf["nx"],imf["ny"],imf["nz"])	# we make a new object to avoid copying the header of imf
-			av1.set_complex(True)
-			av1.to_zero()
-
-		av_1d=imf.calc_radial_dist(av1.get_ysize()/2,0.0,1.0,1)
-		av_1d_n.append(av_1d)
-		av1+=imf
+	av_1d_n=[]
+	sum1,sum2=0,0
+	for blk in read_ptcl_blocks(stackfile,ptcls,ys2):
+		ims=[im1 for i,im1 in blk]
+		nn+=len(ims)
+		for im1 in ims:
+			if edgenorm : im1.process_inplace("normalize.edgemean")
+			if oversamp>1 :
+				im1.clip_inplace(Region(-(ys2*(oversamp-1)/2),-(ys2*(oversamp-1)/2),ys,ys))
+
+		# we need the individual foreground spectra for classification, but only the summed background
+		a=numpy.array([im1.numpy() for im1 in ims])
+		fg=ptcl_intens(a,mask1)
+		for f in fg: av_1d_n.append(inten_image(f).calc_radial_dist(ys/2,0.0,1.0,1))
+		sum1=sum1+fg.sum(0)
+		sum2=sum2+ptcl_intens(a,mask2).sum(0)
 
-		im2*=mask2
-		imf=im2.do_fft()
-		imf.ri2inten()
-		if i==0:
-			av2=EMData(imf["nx"],imf["ny"],imf["nz"])
-			av2.set_complex(True)
-			av2.to_zero()
-		av2+=imf
+	if nn==0 : return None
+	av1=inten_image(sum1)
+	av2=inten_image(sum2)
 
 
 	av1/=(float(nn)*av1.get_ysize()*av1.get_ysize()*ratio1)
@@ -1273,7 +1328,7 @@ Rather than returning a single tuple, returns a list of nclasses tuples.
 #	pca=Analyzers.get("pca_large",{"mask":mask,"nvec":nvec})
 
 	# now BG subtract each particle 1-D average
-	for j in range(n):
+	for j in range(nn):
 		# converts each list of radial values into an image
 		im=EMData(nxl,1,1)
 		for i in xrange(n0,len(av2_1d)): im[i-n0]=av_1d_n[j][i]/(av1["ny"]*av1["ny"]*ratio1)
@@ -1311,7 +1366,7 @@ Rather than returning a single tuple, returns a list of nclasses tuples.
 
 	# project into the subspace
 	prj_1d=[]
-	for j in range(n):
+	for j in range(nn):
 		im=EMData(nvec,1,1)
 		for k in range(nvec): im[k]=av_1d_n[j].cmp("ccc",result[k])
 		im.write_image("postsub.proj.hdf",j)
@@ -1330,8 +1385,8 @@ Rather than returning a single tuple, returns a list of nclasses tuples.
 
 	plists={}
 	for i,im in enumerate(prj_1d):
-		try: plists[im["class_id"]].append(i)
-		except: plists[im["class_id"]]=[i]
+		try: plists[im["class_id"]].append(ptcls[i])
+		except: plists[im["class_id"]]=[ptcls[i]]
 
 #	print plists
 
@@ -39,6 +39,8 @@ from sys import argv
 from time import sleep,time
 import threading
 import Queue
+import traceback
+import hashlib
 
 
 def main():
@@ -72,6 +74,10 @@ def main():
 	parser.add_argument("--noali", default=False, help="Average of non-aligned frames.",action="store_true", guitype='boolbox', row=8, col=0, rowspan=1, colspan=1, mode='align')
 	parser.add_argument("--ali4to14", default=False, help="Average of frames from 4 to 14.",action="store_true", guitype='boolbox', row=8, col=1, rowspan=1, colspan=1, mode='align')
 	parser.add_argument("--threads", default=1,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful", guitype='intbox', row=9, col=0, rowspan=1, colspan=2, mode="align")
+	parser.add_argument("--moviethreads", default=1,type=int,help="Number of movies to process concurrently. --threads are divided evenly among the concurrent movies. Default=1")
+	parser.add_argument("--movielist",type=str,default=None,help="A text file containing the names of movies to process, one per line, in addition to any specified on the command-line. Useful for processing large numbers of movies with a single dark/gain preparation.")
+	parser.add_argument("--norefcache",action="store_true",default=False,help="Normally prepared dark/gain references are cached in movies/ and reused when the source references are unchanged. This disables the cache.")
+	parser.add_argument("--framewindow", default=0,type=int,help="Maximum number of uncorrected frames held in memory while waiting for gain/dark correction. Default (0) is 2x the number of threads")
 
 	parser.add_header(name="orblock3", help='Just a visual separation', title="Optional: ", row=10, col=0, rowspan=1, colspan=3, mode="align")
 	parser.add_argument("--optbox", type=int,help="Box size to use during alignment optimization. Default is 256.",default=256, guitype='intbox', row=11, col=0, rowspan=1, colspan=1, mode="align")
@@ -79,6 +85,9 @@ def main():
 	parser.add_argument("--step",type=str,default="0,1",help="Specify <first>,<step>,[last]. Processes only a subset of the input data. ie- 0,2 would process all even particles. Same step used for all input files. [last] is exclusive. Default= 0,1",guitype='strbox', row=12, col=0, rowspan=1, colspan=1, mode="align")
 	parser.add_argument("--movie", type=int,help="Display an n-frame averaged 'movie' of the stack, specify number of frames to average",default=0)
 	parser.add_argument("--normalize",action="store_true",default=False,help="Apply edgenormalization to input images after dark/gain", guitype='boolbox', row=13, col=0, rowspan=1, colspan=1, mode='align')
+	parser.add_argument("--optband", type=int,help="Only frame pairs separated by at most this many frames are correlated during alignment optimization. Default (0) uses all pairs.",default=0)
+	parser.add_argument("--optshrink", type=int,help="If >1, alignment is first optimized on tiles downsampled by this factor, then refined at full resolution near the coarse optimum. Default=1 (disabled).",default=1)
+	parser.add_argument("--optrefine", type=int,help="In --optshrink mode, the full resolution refinement is restricted to +-this many pixels about the coarse optimum. Default=16.",default=16)
 	parser.add_argument("--optfsc", default=False, help="Specify whether to compute FSC during alignment optimization. Default is False.",action="store_true")
 	parser.add_argument("--frames",action="store_true",default=False,help="Save the dark/gain corrected frames", guitype='boolbox', row=13, col=1, rowspan=1, colspan=1, mode='align')
 	#parser.add_argument("--save_aligned", action="store_true",help="Save dark/gain corrected and optionally aligned stack",default=False, guitype='boolbox', row=14, col=0, rowspan=1, colspan=1, mode='align[True]')
@@ -92,6 +101,9 @@ def main():
 
 	(options, args) = parser.parse_args()
 
+	if options.movielist :
+		args+=[l.strip() for l in open(options.movielist,"r") if len(l.strip())>0 and l[0]!="#"]
+
 	if len(args)<1:
 		print usage
 		parser.error("Specify input DDD stack")
@@ -101,81 +113,11 @@ def main():
 
 	pid=E2init(sys.argv)
 
-	if options.dark :
-		nd=EMUtil.get_image_count(options.dark)
-		dark=EMData(options.dark,0)
-		if nd>1:
-			sigd=dark.copy()
-			sigd.to_zero()
-			a=Averagers.get("mean",{"sigma":sigd,"ignore0":1})
-			print "Summing dark"
-			for i in xrange(0,nd):
-				if options.verbose:
-					print " {}/{}   \r".format(i+1,nd),
-					sys.stdout.flush()
-				t=EMData(options.dark,i)
-				t.process_inplace("threshold.clampminmax",{"minval":0,"maxval":t["mean"]+t["sigma"]*3.5,"tozero":1})
-				a.add_image(t)
-			dark=a.finish()
-			sigd.write_image(options.dark.rsplit(".",1)[0]+"_sig.hdf")
-			if options.fixbadpixels:
-				sigd.process_inplace("threshold.binary",{"value":sigd["sigma"]/10.0})		# Theoretically a "perfect" pixel would have zero sigma, but in reality, the opposite is true
-				dark.mult(sigd)
-			dark.write_image(options.dark.rsplit(".",1)[0]+"_sum.hdf")
-		#else: dark.mult(1.0/99.0)
-		dark.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
-		dark2=dark.process("normalize.unitlen")
-	else : dark=None
-	if options.gain :
-		nd=EMUtil.get_image_count(options.gain)
-		gain=EMData(options.gain,0)
-		if nd>1:
-			sigg=gain.copy()
-			sigg.to_zero()
-			a=Averagers.get("mean",{"sigma":sigg,"ignore0":1})
-			print "Summing gain"
-			for i in xrange(0,nd):
-				if options.verbose:
-					print " {}/{}   \r".format(i+1,nd),
-					sys.stdout.flush()
-				t=EMData(options.gain,i)
-				#t.process_inplace("threshold.clampminmax.nsigma",{"nsigma":4.0,"tozero":1})
-				t.process_inplace("threshold.clampminmax",{"minval":0,"maxval":t["mean"]+t["sigma"]*3.5,"tozero":1})
-				a.add_image(t)
-			gain=a.finish()
-			sigg.write_image(options.gain.rsplit(".",1)[0]+"_sig.hdf")
-			if options.fixbadpixels:
-				sigg.process_inplace("threshold.binary",{"value":sigg["sigma"]/10.0})		# Theoretically a "perfect" pixel would have zero sigma, but in reality, the opposite is true
-				if dark!=None : sigg.mult(sigd)
-				gain.mult(sigg)
-			gain.write_image(options.gain.rsplit(".",1)[0]+"_sum.hdf")
-		#else: gain.mult(1.0/99.0)
-#		gain.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
-
-		if dark!=None : gain.sub(dark)												# dark correct the gain-reference
-		gain.mult(1.0/gain["mean"])									# normalize so gain reference on average multiplies by 1.0
-		gain.process_inplace("math.reciprocal",{"zero_to":0.0})		# setting zero values to zero helps identify bad pixels
-	elif options.gaink2 :
-		gain=EMData(options.gaink2)
-	else : gain=None
-
-	#try: display((dark,gain,sigd,sigg))
-	#except: display((dark,gain))
 	try: os.mkdir("movies")
 	except: pass
-	if gain:
-		gainname="movies/e2ddd_gainref.hdf"
-		gain.write_image(gainname,-1)
-		gainid=EMUtil.get_image_count(gainname)-1
-		gain["filename"]=gainname
-		gain["fileid"]=gainid
-
-	if dark:
-		darkname="movies/e2ddd_darkref.hdf"
-		dark.write_image(darkname,-1)
-		darkid=EMUtil.get_image_count(darkname)-1
-		dark["filename"]=darkname
-		dark["fileid"]=darkid
+
+	# dark/gain references are prepared once and shared by all movies
+	dark,gain=prepare_references(options)
 
 	step = options.step.split(",")
 
@@ -190,10 +132,8 @@ def main():
 	if options.verbose : print "Range = {} - {}, Step = {}".format(first, last, step)
 
 	# the user may provide multiple movies to process at once
-
+	jobs=[]
 	for fsp in args:
-		if options.verbose : print "Processing", fsp
-
 		n = EMUtil.get_image_count(fsp)
 
 		if n < 3 :
@@ -213,44 +153,41 @@ def main():
 		if flast > n :
 			flast = n
 
-		process_movie(fsp, dark, gain, first, flast, step, options)
+		jobs.append((fsp,flast))
+
+	# movies are processed concurrently by a pool of moviethreads threads, each using its share of the frame threads
+	nmovthr=max(1,min(options.moviethreads,len(jobs)))
+	nthreads=max(1,options.threads/nmovthr)
+	movq=Queue.Queue(0)
+	for j in jobs: movq.put(j)
+
+	def movieworker():
+		while True:
+			try: fsp,flast=movq.get_nowait()
+			except Queue.Empty: return
+			if options.verbose : print "Processing", fsp
+			try: process_movie(fsp, dark, gain, first, flast, step, options, nthreads)
+			except:
+				traceback.print_exc()
+				print "ERROR: failed to process {}".format(fsp)
+
+	if nmovthr==1 : movieworker()
+	else:
+		thds=[threading.Thread(target=movieworker) for i in xrange(nmovthr)]
+		for t in thds: t.start()
+		for t in thds: t.join()
 
 	E2end(pid)
 
-def process_movie(fsp,dark,gain,first,flast,step,options):
+def process_movie(fsp,dark,gain,first,flast,step,options,nthreads=None):
 		outname=fsp.rsplit(".",1)[0]+"_proc.hdf"		# always output to an HDF file. Output contents vary with options
 		alioutname="micrographs/"+base_name(fsp)
+		if nthreads==None : nthreads=options.threads
 
-		#if fsp[-4:].lower() in (".mrc","mrcs") :
-		if fsp[-4:].lower() in (".mrc") :
-			hdr=EMData(fsp,0,True)			# read header
-			nx,ny=hdr["nx"],hdr["ny"]
-
-		# bgsub and gain correct the stack
-
-		outim=[]
-		for ii in xrange(first,flast,step):
-			if options.verbose:
-				print " {}/{}   \r".format(ii-first+1,flast-first+1),
-				sys.stdout.flush()
-
-			#if fsp[-4:].lower() in (".mrc","mrcs") :
-			if fsp[-4:].lower() in (".mrc") :
-				im=EMData(fsp,0,False,Region(0,0,ii,nx,ny,1))
-			else: im=EMData(fsp,ii)
-
-			if dark!=None : im.sub(dark)
-			if gain!=None : im.mult(gain)
-			im.process_inplace("threshold.clampminmax",{"minval":0,"maxval":im["mean"]+im["sigma"]*3.5,"tozero":1})
-			if options.fixbadpixels : im.process_inplace("threshold.outlier.localmean",{"sigma":3.5,"fix_zero":1})		# fixes clear outliers as well as values which were exactly zero
-
-			#im.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
-#			im.mult(-1.0)
-			if options.normalize : im.process_inplace("normalize.edgemean")
-
-			if options.frames : im.write_image(outname[:-4]+"_corr.hdf",ii-first)
-			outim.append(im)
-			#im.write_image(outname,ii-first)
+		# bgsub and gain correct the stack, and if aligning, tile/FFT each frame and compute pairwise CCFs as frames become available
+		t0=time()
+		outim,immx,csum2,csumc=process_frames(fsp,dark,gain,first,flast,step,options,nthreads)
+		if options.verbose : print "{} frames preprocessed in {:1.1f} s".format(len(outim),time()-t0)
 
 		nx=outim[0]["nx"]
 		ny=outim[0]["ny"]
@@ -292,8 +229,9 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			print ""
 
 			av=avgr.finish()
-			if first!=1 or flast!=-1 : av.write_image(outname[:-4]+"_{}-{}_mean.hdf".format(first,flast),0)
-			else: av.write_image(outname[:-4]+"_mean.hdf",0)
+			with iolock:
+				if first!=1 or flast!=-1 : av.write_image(outname[:-4]+"_{}-{}_mean.hdf".format(first,flast),0)
+				else: av.write_image(outname[:-4]+"_mean.hdf",0)
 
 		# Generates different possibilites for resolution-weighted, but unaligned, averages
 
@@ -317,7 +255,7 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			print ""
 
 			av=avgr.finish()
-			av.write_image(outname[:-4]+"_a.hdf",0)
+			with iolock: av.write_image(outname[:-4]+"_a.hdf",0)
 #			display(normim)
 
 			# linear weighting with shifting 0 cutoff
@@ -333,7 +271,7 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			print ""
 
 			av=avgr.finish()
-			av.write_image(outname[:-4]+"_b.hdf",0)
+			with iolock: av.write_image(outname[:-4]+"_b.hdf",0)
 
 			# exponential falloff with shifting width
 
@@ -350,7 +288,7 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			print ""
 
 			av=avgr.finish()
-			av.write_image(outname[:-4]+"_c.hdf",0)
+			with iolock: av.write_image(outname[:-4]+"_c.hdf",0)
 
 		if options.align_frames :
 			n=len(outim)
@@ -359,97 +297,9 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			ny=outim[0]["ny"]
 			print("{} frames read {} x {}".format(n,nx,ny))
 
-			ccfs=Queue.Queue(0)
-
-			# prepare image data (outim) by clipping and FFT'ing all tiles
-			# this is threaded as well
-			immx=[0]*n
-			thds = []
-			for i in range(n):
-				thd = threading.Thread(target=split_fft,args=(outim[i],i,options.optbox,options.optstep,ccfs))
-				thds.append(thd)
-			print("Precompute FFTs: {} threads".format(len(thds)))
-			t0=time()
-
-			thrtolaunch=0
-			while thrtolaunch<len(thds) or threading.active_count()>1:
-				if thrtolaunch<len(thds) :
-					while (threading.active_count()==options.threads ) : sleep(.1)
-			#		if options.verbose : print "Starting thread {}/{}".format(thrtolaunch,len(thds))
-					thds[thrtolaunch].start()
-					thrtolaunch+=1
-				else: sleep(1)
-
-				while not ccfs.empty():
-					i,d=ccfs.get()
-					immx[i]=d
-
-			for th in thds: th.join()
-
-			# create threads
-			thds=[]
-			i=0
-			for ima in range(n-1):
-				for imb in range(ima+1,n):
-					thds.append(threading.Thread(target=calc_ccf,args=((ima,imb),options.optbox,options.optstep,immx[ima],immx[imb],ccfs)))
-					i+=1
-
-			print "{:1.1f} s\nCompute ccfs: {} threads".format(time()-t0,len(thds))
 			t0=time()
-
-			# here we run the threads and save the results, no actual alignment done here
-			csum2={}
-			thrtolaunch=0
-			while thrtolaunch<len(thds) or threading.active_count()>1:
-				# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-				# note that it's ok that we wait here forever, since there can't be new results if an existing
-				# thread hasn't finished.
-				if thrtolaunch<len(thds) :
-					while (threading.active_count()==options.threads ) : sleep(.1)
-					#if options.verbose : print "Starting thread {}/{}".format(thrtolaunch,len(thds))
-					thds[thrtolaunch].start()
-					thrtolaunch+=1
-				else:
-					sleep(1)
-
-				while not ccfs.empty():
-					i,d=ccfs.get()
-					csum2[i]=d
-
-				if options.verbose:
-					print "  {}/{} {}\r".format(thrtolaunch,len(thds),threading.active_count()),
-					sys.stdout.flush()
-
-
-			for th in thds: th.join()
-
-			avgr=Averagers.get("minmax",{"max":0})
-			avgr.add_image_list(csum2.values())
-			csum=avgr.finish()
-			#csum=sum(csum2.values())
-			#csum.mult(1.0/len(csum2))
-			#csum.process_inplace("normalize.edgemean")
-			#display(csum)
-			#csum.write_image("a.hdf",0)
-			for i,k in enumerate(sorted(csum2.keys())):
-				im=csum2[k]
-			#	norm=im[BOX/2,BOX/2]/csum[BOX/2,BOX/2]
-			#	norm=im.get_clip(Region(BOX/2-5,BOX/2-5,11,11))["mean"]/csum.get_clip(Region(BOX/2-5,BOX/2-5,11,11))["mean"]
-			#	im.write_image("aa.hdf",i)
-
-			# This has been disabled since it eliminates the peak for zero shift. Instead we try the zero/zero elimination hack
-				norm=1.0
-				im.sub(csum*norm)
-
-				# set the 0,0 peak to the average of neighboring pixels to reduce fixed pattern noise issues (this worked poorly)
-				# im[BOX/2,BOX/2]=(im[BOX/2-1,BOX/2]+im[BOX/2+1,BOX/2]+im[BOX/2,BOX/2+1]+im[BOX/2,BOX/2-1])
-
-			#	s=im.process("math.sub.optimal",{"ref":csum,"ctfweight":0})
-
-			#	im.write_image("a.hdf",i+1)
-				# This is critical. Without this, after filtering we get too many false peaks
-				thr=im["mean"]+im["sigma"]*1.5
-				im.process_inplace("threshold.belowtozero",{"minval":thr})
+			if csumc!=None : ccf_bgsub(csumc)
+			else : ccf_bgsub(csum2)
 
 			#####
 			# Alignment code
@@ -465,27 +315,31 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			t0=time()
 
 			# we start with a heavy filter, optimize, then repeat for successively less filtration
-			for scale in [0.02,0.04,0.07,0.1,0.5]:
-				csum3={k:csum2[k].process("filter.lowpass.gauss",{"cutoff_abs":scale}) for k in csum2.keys()}
-
-				incr=[16]*len(locs)
-				incr[-1]=incr[-2]=4	# if step is zero for last 2, it gets stuck as an outlier, so we just make the starting step smaller
-				simp=Simplex(qual,locs,incr,data=csum3)
-				locs=simp.minimize(maxiters=int(100/scale),epsilon=.01)[0]
-				locs=[int(floor(i*10+.5))/10.0 for i in locs]
-				print locs
-				if options.verbose > 7:
-					out=file("{}_path_{:02d}.txt".format(outname[:-4],int(1.0/scale)),"w")
-					for i in xrange(0,len(locs),2): out.write("%f\t%f\n"%(locs[i],locs[i+1]))
+			scales=[0.02,0.04,0.07,0.1,0.5]
+			if csumc!=None:
+				# coarse search on downsampled CCFs, then refinement at full resolution in a window about the coarse optimum
+				shrink=options.optshrink
+				for scale in scales:
+					locs=optimize_locs(locs,ccf_stack(csumc,n,scale),16.0/shrink,scale)
+					if options.verbose : print "coarse ",locs
+				locs=[i*shrink for i in locs]
+
+				# full resolution CCFs are only computed now, for the same pairs, and only a window about the coarse optimum is searched
+				csum2=refine_ccfs(immx,sorted(csumc.keys()),nthreads)
+				ccf_bgsub(csum2)
+				for scale in [i for i in scales if i>0.5/shrink]:
+					locs=optimize_locs(locs,ccf_stack(csum2,n,scale,locs,options.optrefine),2.0,scale)
+					print locs
+			else:
+				for scale in scales:
+					locs=optimize_locs(locs,ccf_stack(csum2,n,scale),16.0,scale)
+					print locs
+					if options.verbose > 7:
+						out=file("{}_path_{:02d}.txt".format(outname[:-4],int(1.0/scale)),"w")
+						for i in xrange(0,len(locs),2): out.write("%f\t%f\n"%(locs[i],locs[i+1]))
 
 			# compute the quality of each frame
-			quals=[0]*n			# quality of each frame based on its correlation peak summed over all images
-			cen=csum2[(0,1)]["nx"]/2
-			for i in xrange(n-1):
-				for j in xrange(i+1,n):
-					val=csum2[(i,j)].sget_value_at_interp(int(cen+locs[j*2]-locs[i*2]),int(cen+locs[j*2+1]-locs[i*2+1]))*sqrt(float(n-fabs(i-j))/n)
-					quals[i]+=val
-					quals[j]+=val
+			quals=frame_quals(locs,ccf_stack(csum2,n,None))
 
 			# round for integer only shifting
 			#locs=[int(floor(i+.5)) for i in locs]
@@ -497,7 +351,7 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 
 				#write out the unaligned average movie
 				out=qsum(outim)
-				out.write_image("{}__noali.hdf".format(outname[:-4]),0)
+				with iolock: out.write_image("{}__noali.hdf".format(outname[:-4]),0)
 
 			print("Shift images ({})".format(time()-t0))
 			t0=time()
@@ -508,7 +362,7 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 
 			if options.allali:
 				out=qsum(outim)
-				out.write_image("{}__allali.hdf".format(alioutname),0)
+				with iolock: out.write_image("{}__allali.hdf".format(alioutname),0)
 
 			#out=sum(outim[5:15])	# FSC with the earlier frames instead of whole average
 			# compute fsc between each aligned frame and the average
@@ -557,19 +411,19 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 				best=[im for i,im in enumerate(outim) if quals[i]>thr]
 				out=qsum(best)
 				print "Keeping {}/{} frames".format(len(best),len(outim))
-				out.write_image("{}__goodali.hdf".format(alioutname),0)
+				with iolock: out.write_image("{}__goodali.hdf".format(alioutname),0)
 
 			if options.bestali:
 				thr=max(quals)*0.75	# max correlation cutoff for inclusion
 				best=[im for i,im in enumerate(outim) if quals[i]>thr]
 				out=qsum(best)
 				print "Keeping {}/{} frames".format(len(best),len(outim))
-				out.write_image("{}__bestali.hdf".format(alioutname),0)
+				with iolock: out.write_image("{}__bestali.hdf".format(alioutname),0)
 
 			if options.ali4to14:
 				# skip the first 4 frames then keep 10
 				out=qsum(outim[4:14])
-				out.write_image("{}__4-14.hdf".format(alioutname),0)
+				with iolock: out.write_image("{}__4-14.hdf".format(alioutname),0)
 
 			# Write out the translated correlation maps for debugging
 			#cen=csum2[(0,1)]["nx"]/2
@@ -582,25 +436,348 @@ def process_movie(fsp,dark,gain,first,flast,step,options):
 			print "{:1.1f}\nDone".format(time()-t0)
 
 
+def file_checksum(fsp,blocksize=1<<24):
+	"""Returns an md5 hex digest of the contents of a file"""
+
+	md5=hashlib.md5()
+	with open(fsp,"rb") as fin:
+		while True:
+			blk=fin.read(blocksize)
+			if len(blk)==0 : break
+			md5.update(blk)
+
+	return md5.hexdigest()
+
+def prepare_references(options):
+	"""Reads and prepares the dark and gain references specified in options, including averaging of multi-frame references,
+	bad pixel suppression and normalization. Returns (dark,gain), either of which may be None. Unless options.norefcache is set,
+	the prepared references are cached in movies/, keyed by the checksum of the source files and the preparation options, so
+	subsequent runs with the same references skip preparation entirely. The 'filename' and 'fileid' attributes of each returned
+	reference identify where the prepared reference is stored."""
+
+	# cache lookup
+	if not options.norefcache and (options.dark or options.gain or options.gaink2):
+		key=hashlib.md5()
+		for fsp in (options.dark,options.gain,options.gaink2):
+			if fsp : key.update(file_checksum(fsp))
+			key.update("|")
+		key.update(str(options.fixbadpixels))
+		key=key.hexdigest()[:16]
+		cachename="movies/e2ddd_refcache_{}.hdf".format(key)
+		if os.path.isfile(cachename):
+			try: refs=EMData.read_images(cachename)
+			except Exception as e:
+				print "Warning: could not read cached references from {} ({}), preparing them again".format(cachename,e)
+				refs=[]
+			cached={}
+			for i,im in enumerate(refs):
+				im["filename"]=cachename
+				im["fileid"]=i
+				if im.has_attr("ref_type") : cached[im["ref_type"]]=im
+			
+			# a cache missing any of the references we need is incomplete, and is rebuilt
+			expect=[]
+			if options.dark : expect.append("dark")
+			if options.gain or options.gaink2 : expect.append("gain")
+			if len(refs)>0 and all(typ in cached for typ in expect):
+				print "Using cached dark/gain references from ",cachename
+				return cached.get("dark"),cached.get("gain")
+			if len(refs)>0 : print "Cached references in {} are incomplete, preparing them again".format(cachename)
+	else: cachename=None
+
+	sigd=None
+	if options.dark :
+		nd=EMUtil.get_image_count(options.dark)
+		dark=EMData(options.dark,0)
+		if nd>1:
+			sigd=dark.copy()
+			sigd.to_zero()
+			a=Averagers.get("mean",{"sigma":sigd,"ignore0":1})
+			print "Summing dark"
+			for i in xrange(0,nd):
+				if options.verbose:
+					print " {}/{}   \r".format(i+1,nd),
+					sys.stdout.flush()
+				t=EMData(options.dark,i)
+				t.process_inplace("threshold.clampminmax",{"minval":0,"maxval":t["mean"]+t["sigma"]*3.5,"tozero":1})
+				a.add_image(t)
+			dark=a.finish()
+			sigd.write_image(options.dark.rsplit(".",1)[0]+"_sig.hdf")
+			if options.fixbadpixels:
+				sigd.process_inplace("threshold.binary",{"value":sigd["sigma"]/10.0})		# Theoretically a "perfect" pixel would have zero sigma, but in reality, the opposite is true
+				dark.mult(sigd)
+			dark.write_image(options.dark.rsplit(".",1)[0]+"_sum.hdf")
+		#else: dark.mult(1.0/99.0)
+		dark.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
+	else : dark=None
+	if options.gain :
+		nd=EMUtil.get_image_count(options.gain)
+		gain=EMData(options.gain,0)
+		if nd>1:
+			sigg=gain.copy()
+			sigg.to_zero()
+			a=Averagers.get("mean",{"sigma":sigg,"ignore0":1})
+			print "Summing gain"
+			for i in xrange(0,nd):
+				if options.verbose:
+					print " {}/{}   \r".format(i+1,nd),
+					sys.stdout.flush()
+				t=EMData(options.gain,i)
+				#t.process_inplace("threshold.clampminmax.nsigma",{"nsigma":4.0,"tozero":1})
+				t.process_inplace("threshold.clampminmax",{"minval":0,"maxval":t["mean"]+t["sigma"]*3.5,"tozero":1})
+				a.add_image(t)
+			gain=a.finish()
+			sigg.write_image(options.gain.rsplit(".",1)[0]+"_sig.hdf")
+			if options.fixbadpixels:
+				sigg.process_inplace("threshold.binary",{"value":sigg["sigma"]/10.0})		# Theoretically a "perfect" pixel would have zero sigma, but in reality, the opposite is true
+				if sigd!=None : sigg.mult(sigd)
+				gain.mult(sigg)
+			gain.write_image(options.gain.rsplit(".",1)[0]+"_sum.hdf")
+		#else: gain.mult(1.0/99.0)
+#		gain.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
+
+		if dark!=None : gain.sub(dark)												# dark correct the gain-reference
+		gain.mult(1.0/gain["mean"])									# normalize so gain reference on average multiplies by 1.0
+		gain.process_inplace("math.reciprocal",{"zero_to":0.0})		# setting zero values to zero helps identify bad pixels
+	elif options.gaink2 :
+		gain=EMData(options.gaink2)
+	else : gain=None
+
+	#try: display((dark,gain,sigd,sigg))
+	#except: display((dark,gain))
+
+	# store the prepared references, in the cache if possible. The cache is written under a temporary name and renamed
+	# into place, so an interrupted run can't leave a partial cache behind
+	if cachename!=None:
+		tmpname="{}.tmp{}.hdf".format(cachename[:-4],os.getpid())
+		if os.path.isfile(tmpname) : os.unlink(tmpname)
+		i=0
+		for im,typ in ((dark,"dark"),(gain,"gain")):
+			if im==None : continue
+			im["ref_type"]=typ
+			im.write_image(tmpname,i)
+			im["filename"]=cachename
+			im["fileid"]=i
+			i+=1
+		os.rename(tmpname,cachename)
+	else:
+		if gain!=None:
+			gainname="movies/e2ddd_gainref.hdf"
+			gain.write_image(gainname,-1)
+			gain["filename"]=gainname
+			gain["fileid"]=EMUtil.get_image_count(gainname)-1
+
+		if dark!=None:
+			darkname="movies/e2ddd_darkref.hdf"
+			dark.write_image(darkname,-1)
+			dark["filename"]=darkname
+			dark["fileid"]=EMUtil.get_image_count(darkname)-1
+
+	return dark,gain
+
+# serializes image file writes from concurrent movies/frames
+iolock=threading.Lock()
+
+def read_frame(fsp,ii):
+	"""Reads a single frame from a movie, which may be a stack of 2-D images or a 3-D MRC file"""
+
+	#if fsp[-4:].lower() in (".mrc","mrcs") :
+	if fsp[-4:].lower() in (".mrc") :
+		hdr=EMData(fsp,0,True)			# read header
+		return EMData(fsp,0,False,Region(0,0,ii,hdr["nx"],hdr["ny"],1))
+
+	return EMData(fsp,ii)
+
+def correct_frame(im,dark,gain,options):
+	"""Applies dark/gain correction, clamping, outlier removal and (optional) normalization to a single frame in-place"""
+
+	# dark subtraction, gain multiplication and clamping in a single fused operation
+	prm={"nsigma":3.5}
+	if dark!=None : prm["dark"]=dark
+	if gain!=None : prm["gain"]=gain
+	im.process_inplace("math.darkgain",prm)
+	if options.fixbadpixels : im.process_inplace("threshold.outlier.localmean",{"sigma":3.5,"fix_zero":1})		# fixes clear outliers as well as values which were exactly zero
+
+	#im.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
+#	im.mult(-1.0)
+	if options.normalize : im.process_inplace("normalize.edgemean")
+
+	return im
+
+def process_frames(fsp,dark,gain,first,flast,step,options,nthreads):
+	"""Reads, corrects and (if options.align_frames) tiles/FFTs every frame of a movie, computing the summed tile CCF for each
+	pair of frames as soon as both are available. The stages overlap: a single reader thread feeds a bounded window of raw
+	frames to a pool of nthreads workers, which correct and FFT frames, and compute any pairwise CCFs which have become possible.
+	CCF jobs take priority over new frames. Only pairs separated by at most options.optband frames are correlated. Returns
+	(outim,immx,csum2,csumc), where immx holds the tiled FFTs of each frame (None unless optshrink>1) and csum2 is a dictionary of CCFs keyed by (i,j) (i<j).
+	If options.optshrink>1, csum2 is left empty and csumc holds the CCFs of tiles downsampled by optshrink, otherwise csumc is None."""
+
+	frames=range(first,flast,step)
+	n=len(frames)
+	nthreads=max(1,nthreads)
+	if options.framewindow>0 : window=options.framewindow
+	else : window=nthreads*2
+
+	outim=[None]*n
+	immx=[None]*n		# tiled FFTs of each frame
+	csum2={}
+	shrink=options.optshrink
+	if shrink>1 :
+		immxc=[None]*n	# tiled FFTs of each downsampled frame
+		csumc={}
+		pairccfs=csumc
+	else :
+		csumc=None
+		pairccfs=csum2
+	band=options.optband if options.optband>0 else n
+	npairs=len([1 for i in xrange(n) for j in xrange(i+1,n) if j-i<=band]) if options.align_frames else 0
+	ready=[]			# frames with tile FFTs available
+	lock=threading.Lock()
+	failed=[]
+
+	rawq=Queue.Queue(window)	# bounds the number of raw frames in memory
+	ccfq=Queue.Queue(0)
+
+	def put(item):
+		"""Queues a raw frame, giving up if any thread has failed, since the workers may no longer be draining rawq"""
+		while not failed:
+			try:
+				rawq.put(item,timeout=0.1)
+				return True
+			except Queue.Full: pass
+		return False
+
+	def reader():
+		try:
+			for k,ii in enumerate(frames):
+				if not put((k,read_frame(fsp,ii))) : return
+		except:
+			failed.append(sys.exc_info())
+			return
+		for i in xrange(nthreads):
+			if not put((None,None)) : return
+
+	def worker():
+		try: work()
+		except: failed.append(sys.exc_info())
+
+	def work():
+		moreframes=True
+		while not failed:
+			# pairwise CCFs first, these free the pipeline fastest
+			# in --optshrink mode only the downsampled CCFs are computed here, full resolution is deferred to refine_ccfs()
+			try:
+				a,b=ccfq.get_nowait()
+				if shrink>1 : c=calc_ccf(immxc[a],immxc[b])
+				else : c=calc_ccf(immx[a],immx[b])
+				with lock:
+					pairccfs[(a,b)]=c
+					if options.verbose>1:
+						print "  {}/{}\r".format(len(pairccfs),npairs),
+						sys.stdout.flush()
+				continue
+			except Queue.Empty: pass
+
+			if moreframes:
+				try: k,im=rawq.get(timeout=0.1)
+				except Queue.Empty: continue
+				if k==None :
+					moreframes=False
+					continue
+
+				correct_frame(im,dark,gain,options)
+				if options.frames :
+					with iolock: im.write_image(fsp.rsplit(".",1)[0]+"_proc_corr.hdf",frames[k]-first)
+				outim[k]=im
+				if options.align_frames : immx[k]=split_fft(im,options.optbox,options.optstep)
+				if options.align_frames and shrink>1 :
+					immxc[k]=split_fft(im.process("math.meanshrink",{"n":shrink}),options.optbox/shrink,options.optstep/shrink)
+
+				if options.align_frames:
+					with lock:
+						for j in ready:
+							if abs(j-k)<=band : ccfq.put((min(j,k),max(j,k)))
+						ready.append(k)
+				if options.verbose==1:
+					print " {}/{}   \r".format(k+1,n),
+					sys.stdout.flush()
+				continue
+
+			# no more frames to read, wait for the remaining CCFs to be queued and computed
+			with lock:
+				if len(pairccfs)==npairs : return
+			sleep(0.05)
+
+	thds=[threading.Thread(target=reader)]+[threading.Thread(target=worker) for i in xrange(nthreads)]
+	for t in thds: t.start()
+	for t in thds: t.join()
+
+	# the first failure (from the reader or any worker) is re-raised here with its original traceback
+	if failed :
+		err=failed[0]
+		raise err[0],err[1],err[2]
+
+	if shrink<=1 : immx=None		# only needed later for the full resolution refinement
+	return outim,immx,csum2,csumc
+
 # CCF calculation
-def calc_ccf(N,box,step,dataa,datab,out):
+def calc_ccf(dataa,datab):
+	"""Computes the sum of the CCFs of corresponding tiles from two frames (as produced by split_fft)"""
 	for i in range(len(dataa)):
 		c=dataa[i].calc_ccf(datab[i],fp_flag.CIRCULANT,True)
 		try: csum.add(c)
 		except: csum=c
 #	csum.process_inplace("normalize.edgemean")
 #	csum.process_inplace("filter.lowpass.gauss",{"cutoff_abs":0.15})
-	out.put((N,csum))
+	return csum
+
+def calc_ccf_sum(dataa,datab):
+	"""Same result as calc_ccf(), but the tile products are summed in Fourier space, so only one inverse FFT is needed"""
+	for i in range(len(dataa)):
+		p=datab[i].copy()
+		p.cconj()
+		p.mult(dataa[i])
+		try: psum.add(p)
+		except: psum=p
+	csum=psum.do_ift()
+	csum.process_inplace("xform.phaseorigin.tocenter")
+	return csum
+
+def refine_ccfs(immx,pairs,nthreads):
+	"""Computes the full resolution CCF for each (i,j) in pairs from the tiled frame FFTs using nthreads threads. Returns a dictionary
+	keyed by pair, as produced by process_frames()"""
+
+	ccfs={}
+	failed=[]
+	pairq=Queue.Queue(0)
+	for p in pairs: pairq.put(p)
+
+	def worker():
+		while not failed:
+			try: a,b=pairq.get_nowait()
+			except Queue.Empty: return
+			try: ccfs[(a,b)]=calc_ccf_sum(immx[a],immx[b])
+			except: failed.append(sys.exc_info())
+
+	thds=[threading.Thread(target=worker) for i in xrange(max(1,nthreads))]
+	for t in thds: t.start()
+	for t in thds: t.join()
+
+	if failed :
+		err=failed[0]
+		raise err[0],err[1],err[2]
+
+	return ccfs
 
 # preprocess regions by normalizing and doing FFT
-def split_fft(img,i,box,step,out):
+def split_fft(img,box,step):
 	lst=[]
 	nx = img["nx"]
 	ny = img["ny"]
 	for dx in range(box/2,nx-box,step):
 		for dy in range(box/2,ny-box,step):
 			lst.append(img.get_clip(Region(dx,dy,box,box)).process("normalize.edgemean").do_fft())
-	out.put((i,lst))
+	return lst
 
 def calcfsc(map1,map2):
 	fsc=map1.calc_fourier_shell_correlation(map2)
@@ -615,19 +792,102 @@ def qsum(imlist):
 	avg.add_image_list(imlist)
 	return avg.finish()
 
+def ccf_bgsub(ccfs):
+	"""Subtracts the pixelwise maximum over all pair CCFs from each CCF (in-place), which suppresses fixed pattern noise,
+	then zeroes values below mean+1.5 sigma"""
+
+	avgr=Averagers.get("minmax",{"max":0})
+	avgr.add_image_list(ccfs.values())
+	csum=avgr.finish()
+	#csum=sum(ccfs.values())
+	#csum.mult(1.0/len(ccfs))
+	#csum.process_inplace("normalize.edgemean")
+	for k in sorted(ccfs.keys()):
+		im=ccfs[k]
+		# This has been disabled since it eliminates the peak for zero shift. Instead we try the zero/zero elimination hack
+		#norm=im[BOX/2,BOX/2]/csum[BOX/2,BOX/2]
+		norm=1.0
+		im.sub(csum*norm)
+
+		# This is critical. Without this, after filtering we get too many false peaks
+		thr=im["mean"]+im["sigma"]*1.5
+		im.process_inplace("threshold.belowtozero",{"minval":thr})
+
+class CCFStack:
+	"""The pairwise CCFs for a movie, stored as a single NumPy array so the alignment objective can be evaluated over
+	all pairs at once. Each CCF may be a window (origin ox,oy) of the full map, whose center is the zero-shift position."""
+
+	def __init__(self,n,pairs,data,cen,ox,oy):
+		self.n=n
+		self.pi=array([p[0] for p in pairs],dtype=int)
+		self.pj=array([p[1] for p in pairs],dtype=int)
+		self.data=data
+		self.cen=cen
+		self.ox=ox
+		self.oy=oy
+		# This is a recognition that we will tend to get better correlation with near neighbors in the sequence
+		self.wt=sqrt((n-absolute(self.pi-self.pj))/float(n))
+
+	def values(self,locs):
+		"""returns the (weighted) CCF value for each pair at the specified (x0,y0,x1,y1,...) shifts"""
+		locs=array(locs,dtype=float)
+		x=locs[0::2]
+		y=locs[1::2]
+		ix=(self.cen+x[self.pj]-x[self.pi]).astype(int)-self.ox
+		iy=(self.cen+y[self.pj]-y[self.pi]).astype(int)-self.oy
+		ny,nx=self.data.shape[1:]
+		good=(ix>=0)&(ix<nx)&(iy>=0)&(iy<ny)
+		val=zeros(len(self.pi))
+		val[good]=self.data[good.nonzero()[0],iy[good],ix[good]]
+		return val*self.wt
+
+def ccf_stack(ccfs,n,scale,guess=None,rng=0):
+	"""Builds a CCFStack from a dictionary of CCFs keyed by (i,j), after optional Gaussian lowpass filtration (scale, absolute
+	frequency). If guess (an x0,y0,x1,y1,... shift list) is provided, only a +-rng window about the predicted peak location
+	of each pair is retained."""
+
+	pairs=sorted(ccfs.keys())
+	nx=ccfs[pairs[0]]["nx"]
+	cen=nx/2
+	if guess!=None : bx=rng*2+1
+	else : bx=nx
+	data=zeros((len(pairs),bx,bx),dtype=float32)
+	ox=zeros(len(pairs),dtype=int)
+	oy=zeros(len(pairs),dtype=int)
+	for p,(i,j) in enumerate(pairs):
+		if scale!=None : im=ccfs[(i,j)].process("filter.lowpass.gauss",{"cutoff_abs":scale})
+		else : im=ccfs[(i,j)]
+		if guess!=None :
+			ox[p]=int(cen+guess[j*2]-guess[i*2])-rng
+			oy[p]=int(cen+guess[j*2+1]-guess[i*2+1])-rng
+			im=im.get_clip(Region(int(ox[p]),int(oy[p]),bx,bx))
+		data[p]=im.numpy()
+
+	return CCFStack(n,pairs,data,cen,ox,oy)
+
 def qual(locs,ccfs):
-	"""computes the quality of the current alignment. Passed a dictionary of CCF images keyed by (i,j) tuple and
-	an (x0,y0,x1,y1,...)  shift array. Smaller numbers are better since that's what the simplex does"""
-
-	nrg=0.0
-	cen=ccfs[(0,1)]["nx"]/2
-	n=len(locs)/2
-	for i in xrange(n-1):
-		for j in xrange(i+1,n):
-#			nrg-=ccfs[(i,j)].sget_value_at_interp(int(cen+locs[j*2]-locs[i*2]),int(cen+locs[j*2+1]-locs[i*2+1]))
-			# This is a recognition that we will tend to get better correlation with near neighbors in the sequence
-			nrg-=ccfs[(i,j)].sget_value_at_interp(int(cen+locs[j*2]-locs[i*2]),int(cen+locs[j*2+1]-locs[i*2+1]))*sqrt(float(n-fabs(i-j))/n)
-	return nrg
+	"""computes the quality of the current alignment. Passed a CCFStack and an (x0,y0,x1,y1,...)  shift array.
+	Smaller numbers are better since that's what the simplex does"""
+
+	return -ccfs.values(locs).sum()
+
+def frame_quals(locs,ccfs):
+	"""quality of each frame based on its correlation peak summed over all pairs it participates in"""
+
+	val=ccfs.values(locs)
+	quals=zeros(ccfs.n)
+	add.at(quals,ccfs.pi,val)
+	add.at(quals,ccfs.pj,val)
+	return list(quals)
+
+def optimize_locs(locs,ccfs,step,scale):
+	"""Simplex optimization of the frame shifts against a CCFStack, starting from locs, with initial step size step"""
+
+	incr=[step]*len(locs)
+	incr[-1]=incr[-2]=step/4.0	# if step is zero for last 2, it gets stuck as an outlier, so we just make the starting step smaller
+	simp=Simplex(qual,locs,incr,data=ccfs)
+	locs=simp.minimize(maxiters=int(100/scale),epsilon=.01)[0]
+	return [int(floor(i*10+.5))/10.0 for i in locs]
 
 def align(s1,s2,guess=(0,0),localrange=192,verbose=0):
 	"""Aligns a pair of images, and returns a (dx,dy,Z) tuple. Z is the Z-score of the best peak, not a shift.
@@ -41,6 +41,8 @@ from numpy import array
 import traceback
 import json
 from time import time
+import threading
+import Queue
 
 try:
 	import numpy as np
@@ -77,6 +79,7 @@ def main():
 	#options associated with e2refine.py
 	#parser.add_argument("--iter", dest = "iter", type = int, default=0, help = "The total number of refinement iterations to perform")
 	#parser.add_argument("--check", "-c", dest="check", default=False, action="store_true",help="Checks the contents of the current directory to verify that e2refine.py command will work - checks for the existence of the necessary starting files and checks their dimensions. Performs no work ")
+	parser.add_argument("--threads", default=4,type=int,help="Number of threads to use with --evalptclqual, --evalclassqual and --anisotropy. Each thread keeps a copy of the 3-D map in memory.")
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 	#parser.add_argument("--input", dest="input", default=None,type=str, help="The name of the image containing the particle data")
 
@@ -152,6 +155,10 @@ def main():
 		ring=(2*nx*apix/100.0,2*nx*apix/10)
 #		fout=open("ptclsnr.txt".format(i),"w")
 		fout=open("aniso_{:02d}.txt".format(options.anisotropy),"w")
+
+		members=[class_members(classmx[eo].numpy()[:,0],nref) for eo in range(2)]
+		cmxparm=[tuple(c[eo].numpy()[:,0].copy() for c in (cmxtx,cmxty,cmxalpha,cmxmirror)) for eo in range(2)]
+
 		# generate a projection for each particle so we can compare
 		for i in [options.anisotropy]:							# this is left as a loop in case we decide to do multiple classes later on
 			if options.verbose>1 : print "--- Class %d"%i
@@ -159,51 +166,19 @@ def main():
 			# The first projection is unmasked, used for scaling
 			proj=threed.project("standard",{"transform":eulers[i]})
 			projmask=ptclmask.project("standard",eulers[i])		# projection of the 3-D mask for the reference volume to apply to particles
+			clsmembers=[members[eo][i] for eo in range(2)]
+			if options.verbose: print "{} even and {} odd particles in class {}".format(len(clsmembers[0]),len(clsmembers[1]),i)
 
-			alt=eulers[i].get_rotation("eman")["alt"]
-			az=eulers[i].get_rotation("eman")["az"]
-			best=(0,0,1.01)
-
-			for angle in xrange(0,180,5):
+			# first find the axis of a fixed 1% anisotropy which best matches the data
+			angles=range(0,180,5)
+			trials=[]
+			for angle in angles:
 				rt=Transform({"type":"2d","alpha":angle})
-				xf=rt*Transform([1.01,0,0,0,0,1/1.01,0,0,0,0,1,0])*rt.inverse()
-				esum=0
-
-				for eo in range(2):
-					for j in xrange(nptcl[eo]):
-						if classmx[eo][0,j]!=i :
-	#						if options.debug: print "XXX {}\t{}\t{}\t{}".format(i,("even","odd")[eo],j,classmx[eo][0,j])
-							continue		# only proceed if the particle is in this class
-						if options.verbose: print "{}\t{}\t{}".format(i,("even","odd")[eo],j)
-
-						# the particle itself
-						try: ptcl=EMData(cptcl[eo],j)
-						except:
-							print "Unable to read particle: {} ({})".format(cptcl[eo],j)
-							sys.exit(1)
-						#try: defocus=ptcl["ctf"].defocus
-						#except: defocus=-1.0
-
-						# Find the transform for this particle (2d) and apply it to the unmasked/masked projections
-						ptcl.transform(xf)		# anisotropy directly on the particle
-						ptclxf=Transform({"type":"2d","alpha":cmxalpha[eo][0,j],"mirror":int(cmxmirror[eo][0,j]),"tx":cmxtx[eo][0,j],"ty":cmxty[eo][0,j]}).inverse()
-						projc=proj.process("xform",{"transform":ptclxf})	# we transform the projection, not the particle (as in the original classification)
-
-						projmaskc=projmask.process("xform",{"transform":ptclxf})
-						ptcl.mult(projmaskc)
-
-
-						# Particle vs projection FSC
-						fsc = ptcl.calc_fourier_shell_correlation(projc)
-						third = len(fsc)/3
-						fsc=array(fsc[third:third*2])
-						esum+= sum(fsc[ring[0]:ring[1]])
-
-						best=max(best,(esum,angle,1.01))
-	#					snr=fsc/(1.0-fsc)
-	#					sums=[sum(fsc[rings[k]:rings[k+1]])/(rings[k+1]-rings[k]) for k in xrange(4)]		# sum the fsc into 5 range values
-	#					sums=[sum(snr[rings[k]:rings[k+1]])/(rings[k+1]-rings[k]) for k in xrange(4)]		# sum the fsc into 5 range values
-	#					fout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t# {};{}\n".format(sums[0],sums[1],sums[2],sums[3],alt,az,i,defocus,j,cptcl[eo]))
+				trials.append(rt*Transform([1.01,0,0,0,0,1/1.01,0,0,0,0,1,0])*rt.inverse())
+
+			best=(0,0,1.01)
+			for angle,esum in zip(angles,aniso_eval(proj,projmask,clsmembers,cmxparm,cptcl,ring,trials,options.threads)):
+				best=max(best,(esum,angle,1.01))
 				fout.write("{}\t{}\t{}\n".format(angle,1.01,esum))
 
 			if options.verbose>1 : print "--- Class %d"%i
@@ -211,44 +186,15 @@ def main():
 			angle=best[1]
 			print best
 
-			for aniso in xrange(0,30):
-				ai=aniso/1000.0+1.0
+			# then the magnitude of the anisotropy along that axis
+			ais=[aniso/1000.0+1.0 for aniso in xrange(0,30)]
+			trials=[]
+			for ai in ais:
 				rt=Transform({"type":"2d","alpha":angle})
-				xf=rt*Transform([ai,0,0,0,0,1/ai,0,0,0,0,1,0])*rt.inverse()
-				esum=0
-
-				for eo in range(2):
-					for j in xrange(nptcl[eo]):
-						if classmx[eo][0,j]!=i :
-	#						if options.debug: print "XXX {}\t{}\t{}\t{}".format(i,("even","odd")[eo],j,classmx[eo][0,j])
-							continue		# only proceed if the particle is in this class
-						if options.verbose: print "{}\t{}\t{}".format(i,("even","odd")[eo],j)
-
-						# the particle itself
-						try: ptcl=EMData(cptcl[eo],j)
-						except:
-							print "Unable to read particle: {} ({})".format(cptcl[eo],j)
-							sys.exit(1)
-						#try: defocus=ptcl["ctf"].defocus
-						#except: defocus=-1.0
-
-						# Find the transform for this particle (2d) and apply it to the unmasked/masked projections
-						ptcl.transform(xf)		# anisotropy directly on the particle
-						ptclxf=Transform({"type":"2d","alpha":cmxalpha[eo][0,j],"mirror":int(cmxmirror[eo][0,j]),"tx":cmxtx[eo][0,j],"ty":cmxty[eo][0,j]}).inverse()
-						projc=proj.process("xform",{"transform":ptclxf})	# we transform the projection, not the particle (as in the original classification)
-
-						projmaskc=projmask.process("xform",{"transform":ptclxf})
-						ptcl.mult(projmaskc)
-
-
-						# Particle vs projection FSC
-						fsc = ptcl.calc_fourier_shell_correlation(projc)
-						third = len(fsc)/3
-						fsc=array(fsc[third:third*2])
-						esum+= sum(fsc[ring[0]:ring[1]])
-
-						best=max(best,(esum,angle,ai))
+				trials.append(rt*Transform([ai,0,0,0,0,1/ai,0,0,0,0,1,0])*rt.inverse())
 
+			for ai,esum in zip(ais,aniso_eval(proj,projmask,clsmembers,cmxparm,cptcl,ring,trials,options.threads)):
+				best=max(best,(esum,angle,ai))
 				fout.write("{}\t{}\t{}\n".format(angle,ai,esum))
 
 			print best
@@ -315,82 +261,8 @@ def main():
 		fout=open(ptclfsc,"w")
 		# generate a projection for each particle so we can compare
 
-		pj = 0
 		pf = "ptclfsc_{}_projections.hdf".format("_".join(args[0].split("_")[1:]))
-
-		tfs = []
-
-		tlast=time()
-
-		for i in xrange(nref):
-			if options.verbose < 6:
-				sys.stdout.write("\rClass %d/%d"%(i,nref-1))
-				sys.stdout.flush()
-			else: print("--- Class %d/%d"%(i,nref-1))
-
-			# update progress every 10s
-			if time()-tlast>10 :
-				E2progress(logid,i/float(nref))
-				tlast=time()
-
-			# The first projection is unmasked, used for scaling
-			proj=threed.project("standard",{"transform":eulers[i]})
-			projmask=ptclmask.project("standard",eulers[i])		# projection of the 3-D mask for the reference volume to apply to particles
-
-			alt=eulers[i].get_rotation("eman")["alt"]
-			az=eulers[i].get_rotation("eman")["az"]
-
-#			fout=open("ptclfsc/f{:04d}.txt".format(i),"w")
-			for eo in range(2):
-				for j in xrange(nptcl[eo]):
-					if classmx[eo][0,j]!=i :
-#						if options.debug: print "XXX {}\t{}\t{}\t{}".format(i,("even","odd")[eo],j,classmx[eo][0,j])
-						continue		# only proceed if the particle is in this class
-					if options.verbose >= 6: print "{}\t{}\t{}".format(i,("even","odd")[eo],j)
-
-					# the particle itself
-					try: ptcl=EMData(cptcl[eo],j)
-					except:
-						print "Unable to read particle: {} ({})".format(cptcl[eo],j)
-						sys.exit(1)
-					try: defocus=ptcl["ctf"].defocus
-					except: defocus=-1.0
-
-					# Find the transform for this particle (2d) and apply it to the unmasked/masked projections
-					ptclxf=Transform({"type":"2d","alpha":cmxalpha[eo][0,j],"mirror":int(cmxmirror[eo][0,j]),"tx":cmxtx[eo][0,j],"ty":cmxty[eo][0,j]}).inverse()
-
-					tfs.append("{}".format(str(ptclxf.get_params("eman"))))
-
-					projc=proj.process("xform",{"transform":ptclxf})	# we transform the projection, not the particle (as in the original classification)
-
-					if options.includeprojs: projc.write_image(pf,pj)
-
-					projmaskc=projmask.process("xform",{"transform":ptclxf})
-					ptcl.mult(projmaskc)
-
-					#ptcl.write_image("tst.hdf",0)
-					#projc[0].write_image("tst.hdf",1)
-
-					# Particle vs projection FSC
-					fsc = ptcl.calc_fourier_shell_correlation(projc)
-
-					third = len(fsc)/3
-					fsc=array(fsc[third:third*2])
-#					snr=fsc/(1.0-fsc)
-					sums=[sum(fsc[rings[k]:rings[k+1]])/(rings[k+1]-rings[k]) for k in xrange(4)]		# sum the fsc into 5 range values
-#					sums=[sum(snr[rings[k]:rings[k+1]])/(rings[k+1]-rings[k]) for k in xrange(4)]		# sum the fsc into 5 range values
-
-					if options.includeprojs:
-						fout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t# {};{};{};{}\n".format(sums[0],sums[1],sums[2],sums[3],alt,az,i,defocus,j,cptcl[eo],pj,pf))
-					else:
-						fout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t# {};{}\n".format(sums[0],sums[1],sums[2],sums[3],alt,az,i,defocus,j,cptcl[eo]))
-					#xaxis = fsc[0:third]
-					#fsc = fsc[third:2*third]
-##					saxis = [x/apix for x in xaxis]
-##					Util.save_data(saxis[1],saxis[1]-saxis[0],fsc[1:-1],args[1])
-					#Util.save_data(xaxis[1],xaxis[1]-xaxis[0],fsc[1:-1],"ptclfsc/f{:04d}_{:1d}_{:06d}.txt".format(i,eo,j))
-
-					pj+=1
+		tfs=ptclqual_eval(fout,logid,eulers,threed,ptclmask,classmx,(cmxtx,cmxty,cmxalpha,cmxmirror),cptcl,rings,pf,options)
 
 		fout.close()
 
@@ -489,6 +361,28 @@ def main():
 	if options.evalclassqual:
 		print "Class quality evaluation mode"
 
+		try:
+			pathmx="{}/classmx_{:02d}_even.hdf".format(args[0],options.iter)
+			classmx=[EMData(pathmx,0)]
+			nptcl=[classmx[0]["ny"]]
+			cmxtx=[EMData(pathmx,2)]
+			cmxty=[EMData(pathmx,3)]
+			cmxalpha=[EMData(pathmx,4)]
+			cmxmirror=[EMData(pathmx,5)]
+
+			pathmx="{}/classmx_{:02d}_odd.hdf".format(args[0],options.iter)
+			classmx.append(EMData(pathmx,0))
+			nptcl.append(classmx[1]["ny"])
+			cmxtx.append(EMData(pathmx,2))
+			cmxty.append(EMData(pathmx,3))
+			cmxalpha.append(EMData(pathmx,4))
+			cmxmirror.append(EMData(pathmx,5))
+		except:
+			traceback.print_exc()
+			print "====\nError reading classification matrix. Must be full classification matrix with alignments"
+			sys.exit(1)
+
+		if options.verbose: print "{} even and {} odd particles in classmx".format(nptcl[0],nptcl[1])
 
 		logid=E2init(sys.argv,options.ppid)
 
@@ -525,82 +419,8 @@ def main():
 		fout=open(ptclfsc,"w")
 		# generate a projection for each particle so we can compare
 
-		pj = 0
 		pf = "ptclfsc_{}_projections.hdf".format("_".join(args[0].split("_")[1:]))
-
-		tfs = []
-
-		tlast=time()
-
-		for i in xrange(nref):
-			if options.verbose < 6:
-				sys.stdout.write("\rClass %d/%d"%(i,nref-1))
-				sys.stdout.flush()
-			else: print("--- Class %d/%d"%(i,nref-1))
-
-			# update progress every 10s
-			if time()-tlast>10 :
-				E2progress(logid,i/float(nref))
-				tlast=time()
-
-			# The first projection is unmasked, used for scaling
-			proj=threed.project("standard",{"transform":eulers[i]})
-			projmask=ptclmask.project("standard",eulers[i])		# projection of the 3-D mask for the reference volume to apply to particles
-
-			alt=eulers[i].get_rotation("eman")["alt"]
-			az=eulers[i].get_rotation("eman")["az"]
-
-#			fout=open("ptclfsc/f{:04d}.txt".format(i),"w")
-			for eo in range(2):
-				for j in xrange(nptcl[eo]):
-					if classmx[eo][0,j]!=i :
-#						if options.debug: print "XXX {}\t{}\t{}\t{}".format(i,("even","odd")[eo],j,classmx[eo][0,j])
-						continue		# only proceed if the particle is in this class
-					if options.verbose >= 6: print "{}\t{}\t{}".format(i,("even","odd")[eo],j)
-
-					# the particle itself
-					try: ptcl=EMData(cptcl[eo],j)
-					except:
-						print "Unable to read particle: {} ({})".format(cptcl[eo],j)
-						sys.exit(1)
-					try: defocus=ptcl["ctf"].defocus
-					except: defocus=-1.0
-
-					# Find the transform for this particle (2d) and apply it to the unmasked/masked projections
-					ptclxf=Transform({"type":"2d","alpha":cmxalpha[eo][0,j],"mirror":int(cmxmirror[eo][0,j]),"tx":cmxtx[eo][0,j],"ty":cmxty[eo][0,j]}).inverse()
-
-					tfs.append("{}".format(str(ptclxf.get_params("eman"))))
-
-					projc=proj.process("xform",{"transform":ptclxf})	# we transform the projection, not the particle (as in the original classification)
-
-					if options.includeprojs: projc.write_image(pf,pj)
-
-					projmaskc=projmask.process("xform",{"transform":ptclxf})
-					ptcl.mult(projmaskc)
-
-					#ptcl.write_image("tst.hdf",0)
-					#projc[0].write_image("tst.hdf",1)
-
-					# Particle vs projection FSC
-					fsc = ptcl.calc_fourier_shell_correlation(projc)
-
-					third = len(fsc)/3
-					fsc=array(fsc[third:third*2])
-#					snr=fsc/(1.0-fsc)
-					sums=[sum(fsc[rings[k]:rings[k+1]])/(rings[k+1]-rings[k]) for k in xrange(4)]		# sum the fsc into 5 range values
-#					sums=[sum(snr[rings[k]:rings[k+1]])/(rings[k+1]-rings[k]) for k in xrange(4)]		# sum the fsc into 5 range values
-
-					if options.includeprojs:
-						fout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t# {};{};{};{}\n".format(sums[0],sums[1],sums[2],sums[3],alt,az,i,defocus,j,cptcl[eo],pj,pf))
-					else:
-						fout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t# {};{}\n".format(sums[0],sums[1],sums[2],sums[3],alt,az,i,defocus,j,cptcl[eo]))
-					#xaxis = fsc[0:third]
-					#fsc = fsc[third:2*third]
-##					saxis = [x/apix for x in xaxis]
-##					Util.save_data(saxis[1],saxis[1]-saxis[0],fsc[1:-1],args[1])
-					#Util.save_data(xaxis[1],xaxis[1]-xaxis[0],fsc[1:-1],"ptclfsc/f{:04d}_{:1d}_{:06d}.txt".format(i,eo,j))
-
-					pj+=1
+		tfs=ptclqual_eval(fout,logid,eulers,threed,ptclmask,classmx,(cmxtx,cmxty,cmxalpha,cmxmirror),cptcl,rings,pf,options)
 
 		fout.close()
 
@@ -881,5 +701,268 @@ def main():
 			n+=1
 
 
+PTCLQUALBATCH=256		# number of particles per batched FFT/FSC in --evalptclqual
+ANISOBATCH=32			# number of particles per batch in --anisotropy, each held as a 2x padded transform
+
+def class_members(cls,ncls):
+	"""Given the class number for each particle (column 0 of a classmx), returns a list with the (sorted) particle numbers
+	in each of ncls classes. Unclassified particles (negative class) are ignored."""
+	cls=np.round(np.asarray(cls)).astype(int)
+	order=np.argsort(cls,kind="mergesort")
+	bounds=np.searchsorted(cls[order],np.arange(ncls+1))
+	return [order[bounds[i]:bounds[i+1]] for i in xrange(ncls)]
+
+def fsc_rings(ny,nx):
+	"""Ring geometry of EMData.calc_fourier_shell_correlation for a real ny x nx image, in the numpy rfft2 layout.
+	Returns (ky,kx,rad,use,inc). ky and kx are the signed frequency of each row/column, rad the (rounded) ring of each
+	pixel and use a mask selecting the pixels included in the FSC, which has rings 0-inc."""
+	nx2=nx//2
+	ny2=ny//2
+	inc=int(max(nx2,ny2)+0.5)
+
+	ky=np.arange(ny)
+	ky[ky>ny2]-=ny
+	kx=np.arange(nx2+1)
+	rad=np.floor(inc*np.sqrt((ky[:,np.newaxis]/float(ny2))**2+(kx[np.newaxis,:]/float(nx2))**2)+0.5).astype(int)
+	use=((kx[np.newaxis,:]>0)|(ky[:,np.newaxis]>=0))&(rad<=inc)		# skip Friedel related values on the kx=0 line
+	return ky,kx,rad,use,inc
+
+def ring_correlation(fa,fb,starts):
+	"""FSC from two (n,m) arrays of Fourier values, sorted by ring, where starts is the first pixel of each ring"""
+	ret=np.add.reduceat(fa.real*fb.real+fa.imag*fb.imag,starts,axis=1)
+	n1=np.add.reduceat(fa.real**2+fa.imag**2,starts,axis=1)
+	n2=np.add.reduceat(fb.real**2+fb.imag**2,starts,axis=1)
+
+	den=np.sqrt(n1*n2)
+	fsc=np.zeros(ret.shape)
+	good=den>0
+	fsc[good]=ret[good]/den[good]
+	return fsc
+
+def ring_fsc(a,b):
+	"""Computes the FSC between corresponding images in two (n,ny,nx) stacks of real 2-D images. Fourier pixels are
+	binned into rings exactly as in EMData.calc_fourier_shell_correlation, so each row of the returned (n,inc+1) array
+	matches the middle third of that function's output."""
+	ky,kx,rad,use,inc=fsc_rings(*a.shape[1:])
+	rad=rad[use]
+	order=np.argsort(rad,kind="mergesort")
+	starts=np.searchsorted(rad[order],np.arange(inc+1))
+
+	return ring_correlation(np.fft.rfft2(a)[:,use][:,order],np.fft.rfft2(b)[:,use][:,order],starts)
+
+def fourier_pad(imgs):
+	"""Returns the FFT of a stack of real (n,ny,nx) images after 2x zero padding, with the EMAN image center (nx/2,ny/2)
+	at the origin. Even pixels are the transform of the original image, odd pixels interpolate between them."""
+	n,ny,nx=imgs.shape
+	pad=np.zeros((n,2*ny,2*nx),np.float32)
+	pad[:,ny//2:ny//2+ny,nx//2:nx//2+nx]=imgs
+	return np.fft.fft2(np.fft.ifftshift(pad,axes=(1,2))).astype(np.complex64)
+
+def fourier_sample(fp,x,y):
+	"""Bilinear interpolation of a stack of complex (n,ny,nx) transforms at fractional pixel coordinates x,y, with
+	periodic wrapping. Returns an (n,len(x)) array."""
+	ny,nx=fp.shape[1:]
+	x0=np.floor(x).astype(int)
+	y0=np.floor(y).astype(int)
+	dx=(x-x0).astype(np.float32)
+	dy=(y-y0).astype(np.float32)
+	x0%=nx
+	y0%=ny
+	x1=(x0+1)%nx
+	y1=(y0+1)%ny
+	return fp[:,y0,x0]*((1-dx)*(1-dy))+fp[:,y0,x1]*(dx*(1-dy))+fp[:,y1,x0]*((1-dx)*dy)+fp[:,y1,x1]*(dx*dy)
+
+def aniso_batch(proj,projmask,eo,js,cmxparm,cptcl,band,trials):
+	"""Reads and FFTs one batch of particles from one class, then computes, for each 2-D transform in trials, the sum over
+	particles of the particle-projection FSC within band. Trial distortions are applied to the particles in Fourier space."""
+	tx,ty,alpha,mirror=cmxparm[eo]
+	try: ptcls=read_images_bulk(cptcl[eo],[int(j) for j in js])
+	except: raise Exception,"Unable to read particles: {} ({}-{})".format(cptcl[eo],js[0],js[-1])
+
+	ptcla=[]
+	proja=[]
+	for j,ptcl in zip(js,ptcls):
+		# Find the transform for this particle (2d) and apply it to the unmasked/masked projections
+		ptclxf=Transform({"type":"2d","alpha":float(alpha[j]),"mirror":int(mirror[j]),"tx":float(tx[j]),"ty":float(ty[j])}).inverse()
+		projc=proj.process("xform",{"transform":ptclxf})	# we transform the projection, not the particle (as in the original classification)
+		projmaskc=projmask.process("xform",{"transform":ptclxf})
+		ptcl.mult(projmaskc)		# the mask is applied before the trial distortion, so it can be done once
+		ptcla.append(ptcl.numpy().copy())
+		proja.append(projc.numpy().copy())
+
+	ky,kx,starts=band
+	ny,nx=ptcla[0].shape
+	fp=fourier_pad(np.array(ptcla))
+	fproj=fourier_pad(np.array(proja))[:,2*ky%(2*ny),2*kx%(2*nx)]		# even pixels, no interpolation
+
+	# a distortion x'=Mx in real space samples the transform at M^T k
+	ret=[]
+	for xf in trials:
+		m=xf.get_matrix()
+		fx=kx/float(nx)
+		fy=ky/float(ny)
+		fsc=ring_correlation(fourier_sample(fp,2*nx*(m[0]*fx+m[4]*fy),2*ny*(m[1]*fx+m[5]*fy)),fproj,starts)
+		ret.append(fsc.sum())
+
+	return np.array(ret)
+
+def aniso_worker(jobs,results,proj,projmask,cmxparm,cptcl,band,trials):
+	"""Thread for --anisotropy. Takes (eo,particle list) batches from jobs until it is empty, putting the per-trial FSC sums
+	or an exception in results"""
+	while True:
+		try: eo,js=jobs.get(False)
+		except Queue.Empty: return
+		try: results.put(aniso_batch(proj,projmask,eo,js,cmxparm,cptcl,band,trials))
+		except Exception,e: results.put(e)
+
+def aniso_eval(proj,projmask,members,cmxparm,cptcl,ring,trials,nthreads):
+	"""Evaluates a list of 2-D distortions of the particles in one class (members is the even and odd particle list),
+	returning the sum of the particle-projection FSC between rings ring[0] and ring[1] for each. Each particle is read
+	and Fourier transformed once, with batches of particles distributed over nthreads threads."""
+	ny=proj["ny"]
+	nx=proj["nx"]
+	ky,kx,rad,use,inc=fsc_rings(ny,nx)
+	r0=int(ring[0])
+	r1=min(int(ring[1]),inc+1)
+	if r1<=r0 : raise Exception,"Image too small for anisotropy evaluation"
+
+	# Fourier pixels in the band, sorted by ring
+	sel=use&(rad>=r0)&(rad<r1)
+	iy,ix=np.nonzero(sel)
+	order=np.argsort(rad[sel],kind="mergesort")
+	starts=np.searchsorted(rad[sel][order],np.arange(r0,r1))
+	band=(ky[iy[order]],kx[ix[order]],starts)
+
+	jobs=Queue.Queue()
+	nbatch=0
+	for eo in range(2):
+		for b in xrange(0,len(members[eo]),ANISOBATCH):
+			jobs.put((eo,members[eo][b:b+ANISOBATCH]))
+			nbatch+=1
+
+	results=Queue.Queue()
+	thrds=[threading.Thread(target=aniso_worker,args=(jobs,results,proj.copy(),projmask.copy(),cmxparm,cptcl,band,trials)) for t in xrange(max(1,min(nthreads,nbatch)))]
+	for t in thrds:
+		t.daemon=True
+		t.start()
+
+	esums=np.zeros(len(trials))
+	for b in xrange(nbatch):
+		r=results.get()
+		if isinstance(r,Exception) :
+			print "\nError in anisotropy evaluation: ",r
+			sys.exit(1)
+		esums+=r
+
+	return list(esums)
+
+def ptclqual_class(i,euler,threed,ptclmask,members,cmxparm,cptcl,rings,includeprojs):
+	"""Computes the particle vs. projection FSC band averages for every particle in class i. The volume and mask are
+	projected once, and particles are read and compared in batches of PTCLQUALBATCH. Returns a list of
+	(sums,defocus,ptcl #,eo,transform string,projection or None) in even then odd particle order."""
+	proj=threed.project("standard",{"transform":euler})
+	projmask=ptclmask.project("standard",euler)		# projection of the 3-D mask for the reference volume to apply to particles
+
+	ret=[]
+	for eo in range(2):
+		tx,ty,alpha,mirror=cmxparm[eo]
+		for b in xrange(0,len(members[eo]),PTCLQUALBATCH):
+			js=members[eo][b:b+PTCLQUALBATCH]
+			try: ptcls=read_images_bulk(cptcl[eo],[int(j) for j in js])
+			except: raise Exception,"Unable to read particles: {} ({}-{})".format(cptcl[eo],js[0],js[-1])
+
+			ptcla=[]
+			proja=[]
+			info=[]
+			for j,ptcl in zip(js,ptcls):
+				try: defocus=ptcl["ctf"].defocus
+				except: defocus=-1.0
+
+				# Find the transform for this particle (2d) and apply it to the unmasked/masked projections
+				ptclxf=Transform({"type":"2d","alpha":float(alpha[j]),"mirror":int(mirror[j]),"tx":float(tx[j]),"ty":float(ty[j])}).inverse()
+				projc=proj.process("xform",{"transform":ptclxf})	# we transform the projection, not the particle (as in the original classification)
+				projmaskc=projmask.process("xform",{"transform":ptclxf})
+				ptcl.mult(projmaskc)
+
+				ptcla.append(ptcl.numpy().copy())
+				proja.append(projc.numpy().copy())
+				info.append((defocus,int(j),eo,"{}".format(str(ptclxf.get_params("eman"))),projc if includeprojs else None))
+
+			# Particle vs projection FSC, averaged over each frequency band
+			fsc=ring_fsc(np.array(ptcla),np.array(proja))
+			sums=np.column_stack([fsc[:,rings[k]:rings[k+1]].sum(axis=1)/(rings[k+1]-rings[k]) for k in xrange(4)])
+			for s,inf in zip(sums,info): ret.append((list(s),)+inf)
+
+	return ret
+
+def ptclqual_worker(jobs,results,eulers,threed,ptclmask,members,cmxparm,cptcl,rings,includeprojs):
+	"""Thread for --evalptclqual. Takes class numbers from jobs until it is empty, putting (class,result list) or
+	(class,exception) in results"""
+	while True:
+		try: i=jobs.get(False)
+		except Queue.Empty: return
+		try: results.put((i,ptclqual_class(i,eulers[i],threed,ptclmask,[members[eo][i] for eo in range(2)],cmxparm,cptcl,rings,includeprojs)))
+		except Exception,e: results.put((i,e))
+
+
+def ptclqual_eval(fout,logid,eulers,threed,ptclmask,classmx,cmxparm,cptcl,rings,pf,options):
+	"""Compares every particle in classmx to the correspondingly oriented projection of threed, with classes distributed over
+	options.threads threads. Writes one line per particle to fout in class order, and returns the list of per-particle
+	transform strings in the same order."""
+	nref=len(eulers)
+	pj = 0
+	tfs = []
+
+	# class -> particle membership for each half, built once rather than scanning the full classmx for every class
+	members=[class_members(classmx[eo].numpy()[:,0],nref) for eo in range(2)]
+	cmxparm=[tuple(c[eo].numpy()[:,0].copy() for c in cmxparm) for eo in range(2)]
+
+	# each worker has its own copy of the volume and mask, and handles one class at a time
+	jobs=Queue.Queue()
+	for i in xrange(nref): jobs.put(i)
+	results=Queue.Queue()
+	nthreads=max(1,min(options.threads,nref))
+	thrds=[threading.Thread(target=ptclqual_worker,args=(jobs,results,eulers,threed.copy(),ptclmask.copy(),members,cmxparm,cptcl,rings,options.includeprojs)) for t in xrange(nthreads)]
+	for t in thrds:
+		t.daemon=True
+		t.start()
+
+	# results are written in class order as soon as each class is complete
+	done={}
+	tlast=time()
+	for i in xrange(nref):
+		while not done.has_key(i):
+			r=results.get()
+			if isinstance(r[1],Exception):
+				print "\nError processing class {}: {}".format(r[0],r[1])
+				sys.exit(1)
+			done[r[0]]=r[1]
+
+		if options.verbose < 6:
+			sys.stdout.write("\rClass %d/%d"%(i,nref-1))
+			sys.stdout.flush()
+		else: print("--- Class %d/%d"%(i,nref-1))
+
+		# update progress every 10s
+		if time()-tlast>10 :
+			E2progress(logid,i/float(nref))
+			tlast=time()
+
+		alt=eulers[i].get_rotation("eman")["alt"]
+		az=eulers[i].get_rotation("eman")["az"]
+
+		for sums,defocus,j,eo,xfs,projc in done.pop(i):
+			if options.verbose >= 6: print "{}\t{}\t{}".format(i,("even","odd")[eo],j)
+			tfs.append(xfs)
+			if options.includeprojs:
+				projc.write_image(pf,pj)
+				fout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t# {};{};{};{}\n".format(sums[0],sums[1],sums[2],sums[3],alt,az,i,defocus,j,cptcl[eo],pj,pf))
+			else:
+				fout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t# {};{}\n".format(sums[0],sums[1],sums[2],sums[3],alt,az,i,defocus,j,cptcl[eo]))
+			pj+=1
+
+	return tfs
+
+
 if __name__ == "__main__":
 	main()
@@ -39,6 +39,8 @@ from math import *
 import os
 import sys
 import time
+import threading
+import Queue
 from numpy import *
 
 
@@ -165,91 +167,52 @@ and this program should be regarded as experimental.
 		volfilto.to_zero()
 	
 	# now do all of the tiled calculations
-	# TODO - parallelize this
-	fys=[]
-	funny=[]		# list of funny curves
-	t=time.time()
-	for oz,z in enumerate(zr):
-		for oy,y in enumerate(yr):
-			for ox,x in enumerate(xr):
-				if options.verbose>1 : print "%d, %d, %d :"%(x,y,z),
-				elif options.verbose:
-					if time.time()-t>.5 :
-						print "  %3d,%3d,%3d / %d,%d,%d\r"%(ox,oy,oz,len(xr),len(yr),len(zr)),
-						sys.stdout.flush()
-						t=time.time()
-						
-				v1m=v1.get_clip(Region(x,y,z,lnx,lnx,lnx))
-				v1m.mult(cenmask)
-				
-				v2m=v2.get_clip(Region(x,y,z,lnx,lnx,lnx))
-				v2m.mult(cenmask)
-				
-				
-				## make a copy of the mask centered at the current position
-				#mask=cenmask.process("xform.translate.int",{"trans":(x-nx/2,y-ny/2,z-nz/2)})		
-
-				#v1m=v1*mask
-				#v2m=v2*mask
-
-				if options.verbose>1 : print v1m["sigma_nonzero"], v2m["sigma_nonzero"],
-				if v1m["maximum"]<thresh1 or v2m["maximum"]<thresh2 :
-					if options.verbose>1 : print " "
-					resvol[ox,oy,oz]=0.0
-					continue
-				if options.verbose>1 : print " ***"
-#				display(v1m)
-				
-				fsc=v1m.calc_fourier_shell_correlation(v2m)
-				fx=array(fsc[1:len(fsc)/3])/apix
-				fy=fsc[len(fsc)/3+1:len(fsc)*2/3]
-				
-				# 0.5 resolution
-				for i,xx in enumerate(fx[:-1]):
-					if fy[i]>0.5 and fy[i+1]<0.5 : break
-				res=(0.5-fy[i])*(fx[i+1]-fx[i])/(fy[i+1]-fy[i])+fx[i]
-				if res<0 : res=0.0
-				if res>fx[-1]: 
-					res=fx[-1]		# This makes the resolution at Nyquist, which is not a good thing
-					funny.append(len(fys))
-#				if res>0 and res<0.04 : funny.append(len(fys))
-				resvol[ox,oy,oz]=res
-				
-				fys.append(fy)
-				if isnan(fy[0]): print "NAN"
-
-				# 0.143 resolution
-				for si,xx in enumerate(fx[:-1]):
-					if fy[si]>0.143 and fy[si+1]<0.143 : break
-				res143=(0.143-fy[si])*(fx[si+1]-fx[si])/(fy[si+1]-fy[si])+fx[si]
-				if res143<0 : res143=0.0
-				if res143>fx[-1]: 
-					res143=fx[-1]		# This makes the resolution at Nyquist, which is not a good thing
-#				if res>0 and res<0.04 : funny.append(len(fys))
-				resvol143[ox,oy,oz]=res143
-				
-				fys.append(fy)
+	# The window grid is split into batches, which are distributed over a pool of threads. Each thread accumulates its own
+	# filtered volumes, which are merged at the end
+	grid=[(ox,oy,oz,x,y,z) for oz,z in enumerate(zr) for oy,y in enumerate(yr) for ox,x in enumerate(xr)]
+	shells=fsc_shells(lnx)
+	jobs=Queue.Queue(0)
+	for i in xrange(0,len(grid),BATCHSIZE): jobs.put([(gi,)+grid[gi][3:] for gi in xrange(i,min(i+BATCHSIZE,len(grid)))])
+	nbatch=jobs.qsize()
 
-				# now we build the locally filtered volume
-				v1m=v1.get_clip(Region(x,y,z,lnx,lnx,lnx))
-				v2m=v2.get_clip(Region(x,y,z,lnx,lnx,lnx))
-#				if res143>.23 : v1m.write_image("zones.hdf",-1)
-				v1m.process_inplace("filter.lowpass.tophat",{"cutoff_pixels":si+1})	# sharp low-pass at 0.143 cutoff
-				v2m.process_inplace("filter.lowpass.tophat",{"cutoff_pixels":si+1})	# sharp low-pass at 0.143 cutoff
-#				if res143>.23 : v1m.write_image("zones.hdf",-1)
-				v1m.mult(avgmask)
-				v2m.mult(avgmask)
+	results=[]
+	accum=[]
+	failed=[]
+	thrds=[threading.Thread(target=localres_thread,args=(jobs,results,accum,failed,v1,v2,cenmask,avgmask,shells,lnx,apix,thresh1,thresh2,options)) for i in xrange(max(1,options.threads))]
+	for th in thrds: th.start()
+	while threading.active_count()>1 and jobs.qsize()>0:
+		if options.verbose:
+			print "  %d/%d batches\r"%(nbatch-jobs.qsize(),nbatch),
+			sys.stdout.flush()
+		time.sleep(.5)
+	for th in thrds: th.join()
 
-#				if res143>.2 : print x,y,z,si,lnx,fx[si],res143
+	# a failed batch would leave holes in the output, so the first failure is raised here
+	if len(failed)>0 :
+		print "Error: local resolution calculation failed in {} thread(s)".format(len(failed))
+		err=failed[0]
+		raise err[0],err[1],err[2]
 
-				volfilt.insert_scaled_sum(v1m,(x+lnx/2,y+lnx/2,z+lnx/2))
-				volfilt.insert_scaled_sum(v2m,(x+lnx/2,y+lnx/2,z+lnx/2))
-				if options.outfilte!=None : 
-					volfilte.insert_scaled_sum(v1m,(x+lnx/2,y+lnx/2,z+lnx/2))
-				if options.outfilto!=None : 
-					volfilto.insert_scaled_sum(v2m,(x+lnx/2,y+lnx/2,z+lnx/2))
-					
-				volnorm.insert_scaled_sum(avgmask,(x+lnx/2,y+lnx/2,z+lnx/2))
+	# merge per-thread filtered volumes
+	for vf,vn,vfe,vfo in accum:
+		volfilt.add(vf)
+		volnorm.add(vn)
+		if options.outfilte!=None : volfilte.add(vfe)
+		if options.outfilto!=None : volfilto.add(vfo)
+
+	# results are collected in grid order so the saved curves are reproducible
+	fys=[]
+	funny=[]		# list of funny curves
+	for gi,res,res143,fy,isfunny in sorted(results,key=lambda r:r[0]):
+		ox,oy,oz=grid[gi][:3]
+		resvol[ox,oy,oz]=res
+		resvol143[ox,oy,oz]=res143
+		if fy is None : continue
+		if isfunny : funny.append(len(fys))
+		fys.append(fy)
+		if isnan(fy[0]): print "NAN"
+		fys.append(fy)
+	fx=shells[2][1:]/apix
 
 	# while the size of avgmask was selected to produce a nearly normalized image without further work
 	# there were minor artifacts. The normalization deals with this.
@@ -295,6 +258,116 @@ and this program should be regarded as experimental.
 
 	E2end(logid)
 
+# number of local windows processed together in a single batched FFT
+BATCHSIZE=32
+
+def fsc_shells(n):
+	"""Prepares the shell bookkeeping for batched FSCs of n^3 cubes with numpy rfftn. This matches the shell assignment
+	and Friedel-pair exclusion of EMData.calc_fourier_shell_correlation. Returns (include mask,shell indicator matrix,
+	spatial frequency of each shell in 1/pixel)"""
+
+	n2=n/2
+	k=arange(n)
+	k[k>n2]-=n				# EMAN convention, +Nyquist is positive
+	kx=arange(n/2+1)
+	kz,ky,kx=meshgrid(k,k,kx,indexing="ij")
+	r=floor(sqrt(kx**2+ky**2+kz**2)+0.5).astype(int)
+	incl=(r<=n2)&((kx>0)|((kz>=0)&((ky>=0)|(kz!=0))))		# Skip Friedel related values
+
+	shell=zeros((incl.sum(),n2+1))
+	shell[arange(incl.sum()),r[incl]]=1.0
+
+	return incl,shell,arange(n2+1)/float(n)
+
+def batch_fsc(b1,b2,shells):
+	"""Computes the FSC between corresponding cubes in two (N,n,n,n) numpy arrays in a single batched FFT. Returns an (N,n/2+1) array"""
+
+	incl,shell,x=shells
+	f1=fft.rfftn(b1,axes=(1,2,3))[:,incl]
+	f2=fft.rfftn(b2,axes=(1,2,3))[:,incl]
+
+	ret=dot((f1*f2.conj()).real,shell)
+	n1=dot((f1*f1.conj()).real,shell)
+	n2=dot((f2*f2.conj()).real,shell)
+	nrm=sqrt(n1*n2)
+	nrm[nrm==0]=1.0
+
+	return ret/nrm
+
+def fsc_crossing(fx,fy,thr):
+	"""Finds the (linearly interpolated) spatial frequency at which each FSC curve (row of fy) first crosses thr. Returns
+	(resolution,shell index preceding the crossing,exceeded Nyquist flag) arrays"""
+
+	cond=(fy[:,:-1]>thr)&(fy[:,1:]<thr)
+	i=where(cond.any(1),cond.argmax(1),len(fx)-2)
+	r=arange(len(fy))
+	res=(thr-fy[r,i])*(fx[i+1]-fx[i])/(fy[r,i+1]-fy[r,i])+fx[i]
+	res[res<0]=0.0
+	nyq=res>fx[-1]
+	res[nyq]=fx[-1]		# This makes the resolution at Nyquist, which is not a good thing
+
+	return res,i,nyq
+
+def localres_thread(jobs,results,accum,failed,v1,v2,cenmask,avgmask,shells,lnx,apix,thresh1,thresh2,options):
+	"""Processes batches of (grid index,x,y,z) local windows from the jobs queue until it is empty. Appends (grid index,res,res143,fsc,funny) to results
+	for each window and appends its own (volfilt,volnorm,volfilte,volfilto) to accum when complete. If processing fails, sys.exc_info()
+	is appended to failed instead"""
+
+	volfilt=v1.copy()
+	volfilt.to_zero()
+	volnorm=volfilt.copy()
+	volfilte=volfilt.copy() if options.outfilte!=None else None
+	volfilto=volfilt.copy() if options.outfilto!=None else None
+	cm=cenmask.numpy()
+	fx=shells[2][1:]/apix
+
+	try:
+		while True:
+			try: batch=jobs.get_nowait()
+			except Queue.Empty: break
+
+			b1=zeros((len(batch),lnx,lnx,lnx),dtype=float32)
+			b2=zeros((len(batch),lnx,lnx,lnx),dtype=float32)
+			for j,(gi,x,y,z) in enumerate(batch):
+				b1[j]=v1.get_clip(Region(x,y,z,lnx,lnx,lnx)).numpy()
+				b2[j]=v2.get_clip(Region(x,y,z,lnx,lnx,lnx)).numpy()
+			b1*=cm
+			b2*=cm
+
+			# windows without significant density are skipped
+			use=(b1.reshape(len(batch),-1).max(1)>=thresh1)&(b2.reshape(len(batch),-1).max(1)>=thresh2)
+			idx=use.nonzero()[0]
+			for j in (~use).nonzero()[0]:
+				results.append((batch[j][0],0.0,0.0,None,False))
+			if len(idx)==0 : continue
+
+			fy=batch_fsc(b1[idx],b2[idx],shells)[:,1:]
+			res,i,nyq=fsc_crossing(fx,fy,0.5)
+			res143,si,nyq143=fsc_crossing(fx,fy,0.143)
+
+			for k,j in enumerate(idx):
+				gi,x,y,z=batch[j]
+				results.append((gi,res[k],res143[k],list(fy[k]),nyq[k]))
+
+				# now we build the locally filtered volume
+				v1m=v1.get_clip(Region(x,y,z,lnx,lnx,lnx))
+				v2m=v2.get_clip(Region(x,y,z,lnx,lnx,lnx))
+				v1m.process_inplace("filter.lowpass.tophat",{"cutoff_pixels":int(si[k])+1})	# sharp low-pass at 0.143 cutoff
+				v2m.process_inplace("filter.lowpass.tophat",{"cutoff_pixels":int(si[k])+1})	# sharp low-pass at 0.143 cutoff
+				v1m.mult(avgmask)
+				v2m.mult(avgmask)
+
+				volfilt.insert_scaled_sum(v1m,(x+lnx/2,y+lnx/2,z+lnx/2))
+				volfilt.insert_scaled_sum(v2m,(x+lnx/2,y+lnx/2,z+lnx/2))
+				if volfilte!=None : volfilte.insert_scaled_sum(v1m,(x+lnx/2,y+lnx/2,z+lnx/2))
+				if volfilto!=None : volfilto.insert_scaled_sum(v2m,(x+lnx/2,y+lnx/2,z+lnx/2))
+				volnorm.insert_scaled_sum(avgmask,(x+lnx/2,y+lnx/2,z+lnx/2))
+	except:
+		failed.append(sys.exc_info())
+		return
+
+	accum.append((volfilt,volnorm,volfilte,volfilto))
+
 if __name__ == "__main__":
         main()
 
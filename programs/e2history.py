@@ -37,7 +37,7 @@
 
 import shelve
 import sys,os,time
-from EMAN2 import base_name, EMArgumentParser
+from EMAN2 import base_name, EMArgumentParser, E2jobhistory
 import EMAN2db
 
 # also defined in EMAN2, but we don't want to have to import it
@@ -94,12 +94,22 @@ class HistoryForm:
 		
 		params = []
 		
+		# the job log written by current versions of E2init takes precedence over the old database history
+		hist=E2jobhistory(self.wd)
+		for h in hist:
+			h["start"]=h["time"]
+			h["path"]=self.wd
+		
 		try:
 			n=int(db.history["count"])
 		except:
 			n = 0
+		if len(hist)==0 and db != None:
+			for i in range(n):
+				try: hist.append(db.history[i+1])
+				except: continue
 		
-		if db == None or n == 0:
+		if len(hist) == 0:
 			params.append(ParamDef(name="blurb",vartype="text",desc_short="",desc_long="",property=None,defaultunits="There appears to be no history in this directory",choices=None))
 		else:
 			from emform import EMParamTable
@@ -112,10 +122,7 @@ class HistoryForm:
 			params.append(ParamDef(name="blurb",vartype="text",desc_short="",desc_long="",property=None,defaultunits="Use this form to examine the EMAN2 commands that have occurred in this directory.",choices=None))
 			p = EMParamTable(name="commands",desc_short="Historical table of EMAN2 commands",desc_long="") 
 			
-			for i in range(n):
-				try: h=db.history[i+1]
-				except: continue
-				
+			for h in hist:
 				if h != None and h.has_key("path") and h["path"]==self.wd:
 					start.append(local_datetime(h["start"]))
 					if h.has_key("end") :
@@ -191,8 +198,23 @@ def time_diff(secs):
 
 
 
+def print_jobs():
+	"""Prints the jobs from the job log in the current directory. Returns False if there is no job log."""
+	hist=E2jobhistory()
+	if len(hist)==0 : return False
+	
+	for h in hist:
+		if h.has_key("end") : print local_datetime(h["time"]),"\t   ",time_diff(h["end"]-h["time"]),"\t"," ".join(h["args"])
+		elif h.has_key("progress") : print local_datetime(h["time"]),"\t   ",int(h["progress"]*100)," % done\t"," ".join(h["args"])
+		else: print local_datetime(h["time"]),"\tincomplete\t"," ".join(h["args"])
+	
+	return True
+
 def print_to_std_out(all):
 
+	# jobs in the current directory come from the job log if there is one, otherwise we fall back to the old histories
+	if not all and print_jobs() : return
+
 	try:
 		import EMAN2db
 		db=EMAN2db.EMAN2DB.open_db()
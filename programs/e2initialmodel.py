@@ -37,6 +37,8 @@ import random
 from math import *
 import os
 import sys
+import threading
+import Queue
 from e2simmx import cmponetomany
 from EMAN2jsondb import JSTask,jsonclasses
 
@@ -63,6 +65,8 @@ def main():
 	parser.add_argument("--sym", dest = "sym", help = "Specify symmetry - choices are: c<n>, d<n>, h<n>, tet, oct, icos",default="c1", guitype='symbox', row=4, col=0, rowspan=1, colspan=2)
 	parser.add_argument("--randorient",action="store_true",help="Instead of seeding with a random volume, seeds by randomizing input orientations",default=False, guitype='boolbox', row=4, col=2, rowspan=1, colspan=1)
 	parser.add_argument("--maskproc", default=None, type=str,help="Default=none. If specified, this mask will be performed after the built-in automask, eg - mask.soft to remove the core of a virus", )
+	parser.add_argument("--coarseiter", type=int, default=0, help="Default=0. Run this many of the initial iterations on class-averages and maps Fourier cropped to half the box size, which is several times faster")
+	parser.add_argument("--prune", type=float, default=0.0, help="Default=0. Fraction of the tries to abandon, based on their score, after the first --coarseiter iterations (or half of --iter if --coarseiter isn't specified). This permits more --tries in the same time")
 #	parser.add_argument("--savemore",action="store_true",help="Will cause intermediate results to be written to flat files",default=False, guitype='boolbox', expert=True, row=5, col=0, rowspan=1, colspan=1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 	parser.add_argument("--orientgen",type=str, default="eman:delta=9.0:inc_mirror=0:perturb=1",help="The type of orientation generator. Default is eman:delta=9.0:inc_mirror=0:perturb=1. See e2help.py orientgens", guitype='strbox', expert=True, row=4, col=2, rowspan=1, colspan=1)
@@ -115,8 +119,22 @@ def main():
 	sym_object = parsesym(options.sym)
 	orts = sym_object.gen_orientations(og_name,og_args)
 
+	if options.prune<0 or options.prune>=1.0 :
+		print "Error, --prune must be between 0 and 1"
+		sys.exit(1)
+
+	# the tries are run in two stages, with the first optionally at reduced sampling, and followed by pruning
+	if options.coarseiter>0 and options.iter>1 : split=min(options.coarseiter,options.iter-1)		# the last iteration is always at full sampling
+	elif options.prune>0 : split=max(1,options.iter/2)
+	else : split=options.iter
+
+	if split<options.iter and options.coarseiter>0 :
+		cbox=good_size_small(boxsize/2)
+		if cbox==None : cbox=(boxsize/2)&~1
+		print "Iterations 0-{} will be run at {}x{}".format(split-1,cbox,cbox)
+	else: cbox=0
+
 	logid=E2init(sys.argv,options.ppid)
-	results=[]
 
 	try: os.mkdir("initial_models")
 	except: pass
@@ -130,20 +148,80 @@ def main():
 	for i,p in enumerate(ptcls):
 		p.write_image(particles_name,i)
 
-	# parallelism
-	from EMAN2PAR import EMTaskCustomer			# we need to put this here to avoid a circular reference
+	# parallelism. With threads, the tries run in this process and share a single copy of the particles
+	if options.parallel.split(":")[0]=="thread" :
+		etc=None
+		ptcl_cache[(particles_name,0)]=ptcls
+	else:
+		from EMAN2PAR import EMTaskCustomer			# we need to put this here to avoid a circular reference
 
-	etc=EMTaskCustomer(options.parallel)
-	pclist=[particles_name]
+		etc=EMTaskCustomer(options.parallel)
+		pclist=[particles_name]
 
-	etc.precache(pclist)		# make sure the input particles are precached on the compute nodes
+		etc.precache(pclist)		# make sure the input particles are precached on the compute nodes
 
 	tasks=[]
 	for t in xrange(options.tries):
-		tasks.append(InitMdlTask(particles_name,len(ptcls),orts,t,sfcurve,options.iter,options.sym,mask2,options.randorient,options.verbose))
+		tasks.append(InitMdlTask(particles_name,len(ptcls),orts,t,sfcurve,split,options.sym,mask2,options.randorient,options.verbose,box=cbox))
+
+	results=run_tasks(etc,tasks,options)
+
+	if split<options.iter :
+		if options.prune>0 :
+			results.sort(key=lambda r:r[0])
+			nkeep=max(1,int(ceil(len(results)*(1.0-options.prune))))
+			if options.verbose>0 : print "Keeping {} of {} tries after iteration {}, scores {:1.4f} - {:1.4f}".format(nkeep,len(results),split-1,results[0][0],results[nkeep-1][0])
+			results=results[:nkeep]
+
+		# the remaining iterations continue from the first stage models, at full sampling
+		tasks=[]
+		for t,r in enumerate(results):
+			tasks.append(InitMdlTask(particles_name,len(ptcls),orts,t,sfcurve,options.iter,options.sym,mask2,False,options.verbose,startiter=split,model=r[1]))
+
+		init=[r[4] for r in results]
+		results=run_tasks(etc,tasks,options)
+		results=[r[:4]+(fourier_resize(init[i],boxsize),) for i,r in enumerate(results)]
+
+
+	# Write out the final results
+	results.sort()
+	for i,j in enumerate(results):
+		out_name = results_name+"_%02d.hdf"%(i+1)
+		j[1].write_image(out_name,0)
+		j[4].write_image(results_name+"_%02d_init.hdf"%(i+1),0)
+		print out_name,j[1]["quality"],j[0],j[1]["apix_x"]
+		for k,l in enumerate(j[3]): l[0].write_image(results_name+"_%02d_proj.hdf"%(i+1),k)	# set of projection images
+		for k,l in enumerate(j[2]):
+			l.process("normalize").write_image(results_name+"_%02d_aptcl.hdf"%(i+1),k*2)						# set of aligned particles
+			j[3][l["match_n"]][0].process("normalize").write_image(results_name+"_%02d_aptcl.hdf"%(i+1),k*2+1)	# set of projections matching aligned particles
+
+
+	E2end(logid)
+
+def run_tasks(etc,tasks,options):
+	"""Runs a list of InitMdlTasks and returns their results in the same order. If etc is None, the tasks are run in
+	threads in this process, otherwise they are sent to the EMTaskCustomer etc."""
+
+	if etc==None :
+		try: nthreads=int(options.parallel.split(":")[1])
+		except: nthreads=1
+
+		jobs=Queue.Queue()
+		for i,t in enumerate(tasks): jobs.put((i,t))
+		results=[None for t in tasks]
+
+		thrds=[threading.Thread(target=run_tasks_thread,args=(jobs,results,options.verbose)) for i in xrange(max(1,min(nthreads,len(tasks))))]
+		for t in thrds: t.start()
+		for t in thrds: t.join()
+
+		if None in results :
+			print "Error: {} of {} tries failed".format(results.count(None),len(results))
+			sys.exit(1)
+		return results
 
 	taskids=etc.send_tasks(tasks)
 	alltaskids=taskids[:]			# we keep a copy for monitoring progress
+	results=[None for t in tasks]
 
 	# This loop runs until all subtasks are complete (via the parallelism system
 	ltime=0
@@ -157,56 +235,88 @@ def main():
 		for i,j in enumerate(curstat):
 			if j==100 :
 				rslt=etc.get_results(taskids[i])		# read the results back from a completed task as a one item dict
-				results.append(rslt[1]["result"])
+				results[alltaskids.index(taskids[i])]=rslt[1]["result"]
 				if options.verbose==1 : print "Task {} ({}) complete".format(i,taskids[i])
 
 		# filter out completed tasks. We can't do this until after the previous loop completes
 		taskids=[taskids[i] for i in xrange(len(taskids)) if curstat[i]!=100]
 
-
-	# Write out the final results
-	results.sort()
-	for i,j in enumerate(results):
-		out_name = results_name+"_%02d.hdf"%(i+1)
-		j[1].write_image(out_name,0)
-		j[4].write_image(results_name+"_%02d_init.hdf"%(i+1),0)
-		print out_name,j[1]["quality"],j[0],j[1]["apix_x"]
-		for k,l in enumerate(j[3]): l[0].write_image(results_name+"_%02d_proj.hdf"%(i+1),k)	# set of projection images
-		for k,l in enumerate(j[2]):
-			l.process("normalize").write_image(results_name+"_%02d_aptcl.hdf"%(i+1),k*2)						# set of aligned particles
-			j[3][l["match_n"]][0].process("normalize").write_image(results_name+"_%02d_aptcl.hdf"%(i+1),k*2+1)	# set of projections matching aligned particles
-
-
-	E2end(logid)
+	return results
+
+def run_tasks_thread(jobs,results,verbose):
+	"""Thread for run_tasks. Executes (n,task) pairs from the jobs queue, putting results in results[n]"""
+	while 1:
+		try: i,task=jobs.get_nowait()
+		except Queue.Empty: return
+
+		try: results[i]=task.execute()["result"]
+		except:
+			import traceback
+			traceback.print_exc()
+			continue
+		if verbose==1 : print "Task {} complete".format(i)
+
+# The particles are read and Fourier cropped only once per process, no matter how many tries are run
+ptcl_cache={}
+ptcl_cache_lock=threading.RLock()
+
+def cached_ptcls(filename,box=0):
+	"""Returns the images from filename, Fourier cropped to box if box>0. The returned images are shared, and must be copied
+	before being modified."""
+	with ptcl_cache_lock:
+		if (filename,box) not in ptcl_cache:
+			if box>0 : ptcl_cache[(filename,box)]=[fourier_resize(p,box) for p in cached_ptcls(filename)]
+			else : ptcl_cache[(filename,box)]=EMData.read_images(filename)
+
+		return ptcl_cache[(filename,box)]
+
+def fourier_resize(img,box):
+	"""Returns a copy of a 2-D or 3-D image resampled to a box size of box by cropping or padding its Fourier transform"""
+	if img["nx"]==box : return img.copy()
+
+	ret=img.process("math.fft.resample",{"n":float(img["nx"])/box})
+	if ret["nx"]!=box :		# the resampled size may be off by one due to rounding
+		if ret["nz"]>1 : ret.clip_inplace(Region((ret["nx"]-box)/2,(ret["ny"]-box)/2,(ret["nz"]-box)/2,box,box,box))
+		else : ret.clip_inplace(Region((ret["nx"]-box)/2,(ret["ny"]-box)/2,box,box))
+	return ret
 
 class InitMdlTask(JSTask):
+	"""Runs iterations startiter to niter-1 of a single try. The try begins from model if specified, otherwise from a random
+	model. If box is specified, the particles, model and mask are Fourier resampled to this size."""
 
-	def __init__(self,ptclfile=None,ptcln=0,orts=[],tryid=0,strucfac=None,niter=5,sym="c1",mask2=None,randorient=False,verbose=0) :
-		data={"images":["cache",ptclfile,(0,ptcln)],"strucfac":strucfac,"orts":orts,"mask2":mask2}
-		JSTask.__init__(self,"InitMdl",data,{"tryid":tryid,"iter":niter,"sym":sym,"randorient":randorient,"verbose":verbose},"")
+	def __init__(self,ptclfile=None,ptcln=0,orts=[],tryid=0,strucfac=None,niter=5,sym="c1",mask2=None,randorient=False,verbose=0,startiter=0,box=0,model=None) :
+		data={"images":["cache",ptclfile,(0,ptcln)],"strucfac":strucfac,"orts":orts,"mask2":mask2,"model":model}
+		JSTask.__init__(self,"InitMdl",data,{"tryid":tryid,"iter":niter,"startiter":startiter,"box":box,"sym":sym,"randorient":randorient,"verbose":verbose},"")
 
 
 	def execute(self,progress=None):
 		sfcurve=self.data["strucfac"]
-		ptcls=EMData.read_images(self.data["images"][1])
+		ptcls=[p.copy() for p in cached_ptcls(self.data["images"][1],self.options.get("box",0))]
 		orts=self.data["orts"]
 		options=self.options
 		verbose=options["verbose"]
 		boxsize=ptcls[0].get_xsize()
 		apix=ptcls[0]["apix_x"]
 		mask2=self.data["mask2"]
+		if mask2!=None and mask2["nx"]!=boxsize :
+			mask2=fourier_resize(mask2,boxsize)
+			mask2.process_inplace("threshold.clampminmax",{"minval":0.0,"maxval":1.0})
+		startiter=options.get("startiter",0)
+		model=self.data.get("model",None)
 
 		# We make one new reconstruction for each loop of t
-		if options["randorient"] : threed=[make_random_map_byort(ptcls)]		# initial model
-		else: threed=[make_random_map(boxsize,sfcurve)]		# initial model
-		apply_sym(threed[0],options["sym"])		# with the correct symmetry
+		if model!=None : threed=[fourier_resize(model,boxsize)]		# continuing a try, the model is already symmetrized
+		else :
+			if options["randorient"] : threed=[make_random_map_byort(ptcls)]		# initial model
+			else: threed=[make_random_map(boxsize,sfcurve)]		# initial model
+			apply_sym(threed[0],options["sym"])		# with the correct symmetry
 
 		# This is the refinement loop
-		for it in range(options["iter"]):
-			if progress != None: progress(it*100/options["iter"])
+		for it in range(startiter,options["iter"]):
+			if progress != None: progress((it-startiter)*100/(options["iter"]-startiter))
 			if verbose>0 : print "Iteration %d"%it
 #			if options.savemore : threed[it].write_image("imdl.%02d.%02d.mrc"%(t,it))
-			projs=[(threed[it].project("standard",ort),None) for ort in orts]		# projections
+			projs=[(threed[-1].project("standard",ort),None) for ort in orts]		# projections
 			for i in projs : i[0].process_inplace("normalize.edgemean")
 			if verbose>2: print "%d projections"%len(projs)
 
@@ -35,8 +35,11 @@ from EMAN2 import *
 import random
 from math import *
 from numpy import *
+import numpy as np
 import os
 import sys
+import threading
+import Queue
 from e2simmx import cmponetomany
 from EMAN2jsondb import JSTask,jsonclasses
 
@@ -114,41 +117,41 @@ def main():
 #	out=file("dbg.txt","w")
 	allbest=[]
 	for n in xrange(len(ptcls)):
-		best=(1e100,None,None,None)
-		best2=(1e100,None,None,None)
+		best=(1e100,None,None,None,None,None,None)
+		best2=(1e100,None,None,None,None,None,None)
 		if options.verbose : print "Particle/average: ",n
+
+		# the test orientations are scored in parallel
+		cands=[]
 		for ort in orts:
 			for phi in arange(0,359.9,daz):
-				if options.verbose>1: print ort.get_rotation()["az"],ort.get_rotation()["alt"],phi, " : ",
-				
-				recon.setup()
-				
-				# we reconstruct the map using a single projection in some test orientation, with symmetry
-				ortins=Transform({"type":"eman","az":ort.get_rotation()["az"],"alt":ort.get_rotation()["alt"],"phi":phi})
-				recon.insert_slice(ptclsf[n],ortins,1.0)
-				trymapf=recon.finish(False)
-				trymap=trymapf.do_ift()
-				trymap.process_inplace("xform.phaseorigin.tocenter")
-				trymap=trymap.get_clip(Region((padsize-boxsize)/2,(padsize-boxsize)/2,(padsize-boxsize)/2,boxsize,boxsize,boxsize))
-	
-				# then we reproject that map to see how well it matches the original image
-				# effectively this is just a very expensive way of doing self-common-lines until we add multiple projections
-				proj=trymap.project("standard",{"transform":ortins})
-#				display((proj,ptcls[n]))
-#				sim=proj.cmp("optsub",ptcls[n])
-				sim=proj.cmp("ccc",ptcls[n])
-			
-				if sim<best[0] :
-					if mapcmp(trymap,best[2])<-0.7:						# this means we have a better version of 'best'
-						best=(sim,ortins,trymap,trymapf,proj,ptcls[n])
-					else:												# the better map doesn't look like the existing map
-						best2=best
-						best=(sim,ortins,trymap,trymapf,proj,ptcls[n])
-				elif sim<best2[0]:
-					if mapcmp(trymap,best[2])>-0.7:						# better than the current second, but not similar to the first
-						best2=(sim,ortins,trymap,trymapf,proj,ptcls[n])
-				
-				if options.verbose>1 : print sim
+				cands.append(Transform({"type":"eman","az":ort.get_rotation()["az"],"alt":ort.get_rotation()["alt"],"phi":phi}))
+
+		jobs=Queue.Queue()
+		for i,ortins in enumerate(cands): jobs.put((i,ortins))
+		sims=[None for i in cands]
+		thrds=[threading.Thread(target=trial_sims,args=(jobs,sims,ptclsf[n].copy(),ptcls[n].copy(),boxsize,padsize,options.sym,options.verbose)) for i in xrange(max(1,options.threads))]
+		for t in thrds: t.start()
+		for t in thrds: t.join()
+
+		# then we find the best and second best (dissimilar) maps, considering the orientations in the original order. Only
+		# orientations which displace one of these need their map rebuilt
+		for ortins,sim in zip(cands,sims):
+			if options.verbose>1: print ortins.get_rotation()["az"],ortins.get_rotation()["alt"],ortins.get_rotation()["phi"], " : ",sim
+			if sim>=best[0] and sim>=best2[0] : continue
+
+			trymap,trymapf,proj=trial_map(recon,ptclsf[n],ptcls[n],ortins,boxsize,padsize)[1:]
+			tryfft=map_fft(trymap)
+
+			if sim<best[0] :
+				if fmapcmp(tryfft,best[6])[0]<-0.7:						# this means we have a better version of 'best'
+					best=(sim,ortins,trymap,trymapf,proj,ptcls[n],tryfft)
+				else:												# the better map doesn't look like the existing map
+					best2=best
+					best=(sim,ortins,trymap,trymapf,proj,ptcls[n],tryfft)
+			elif sim<best2[0]:
+				if fmapcmp(tryfft,best[6])[0]>-0.7:						# better than the current second, but not similar to the first
+					best2=(sim,ortins,trymap,trymapf,proj,ptcls[n],tryfft)
 #				out.write("{}\t{}\t# {},{}\n".format(phi,sim,ort.get_rotation()["az"],ort.get_rotation()["alt"]))
 		if options.verbose: print best[:2]
 		
@@ -183,6 +186,7 @@ def main():
 
 	cursum=min(allbest)[2]			# start with the best matching map we got
 	used=[allbest.index(min(allbest))]
+	cursumfft=map_fft(cursum)
 	if options.verbose : print "Best map: ",used[0]
 	
 	# we add in 1/3 more of the best matching volumes
@@ -191,11 +195,12 @@ def main():
 		best=(1.0,None)
 		for i in xrange(len(allbest)):
 			if i in used : continue
-			best=min(best,(mapcmp(cursum,allbest[i][2]),allbest[i][2],i))
+			best=min(best,(fmapcmp(cursumfft,allbest[i][6])[0],allbest[i][2],i))
 		
 		if options.verbose : print "{}.  {}\t{}".format(i,best[2],best[0])
 		used.append(best[2])
-		cursum=mapsum(cursum,best[1])
+		cursum=mapsum(cursum,best[1],cursumfft,allbest[best[2]][6])
+		cursumfft=map_fft(cursum)
 	
 	if options.verbose: print used
 	cursum.process_inplace("normalize.edgemean")
@@ -206,46 +211,86 @@ def main():
 	
 	# write projection comparisons
 	for i in used:
-		allbest[i][-1].write_image(cmp_name,-1)
+		allbest[i][5].write_image(cmp_name,-1)
 		cursum.project("standard",{"transform":allbest[i][1]}).process("normalize.edgemean").write_image(cmp_name,-1)
 	
 	E2end(logid)
 
-def mapsum(m1,m2):
-	"""Adds 2 maps taking into account handedness flips and 5-fold orientation uncertainty, picking the best solution for m2"""
+def trial_map(recon,ptclf,ptcl,ortins,boxsize,padsize):
+	"""Reconstructs a map, with symmetry, from a single preprocessed particle (ptclf) in orientation ortins, then compares its
+	projection to the original particle. Returns (sim,map,map fft,projection)"""
+	recon.setup()
+
+	# we reconstruct the map using a single projection in some test orientation, with symmetry
+	recon.insert_slice(ptclf,ortins,1.0)
+	trymapf=recon.finish(False)
+	trymap=trymapf.do_ift()
+	trymap.process_inplace("xform.phaseorigin.tocenter")
+	trymap=trymap.get_clip(Region((padsize-boxsize)/2,(padsize-boxsize)/2,(padsize-boxsize)/2,boxsize,boxsize,boxsize))
+
+	# then we reproject that map to see how well it matches the original image
+	# effectively this is just a very expensive way of doing self-common-lines until we add multiple projections
+	proj=trymap.project("standard",{"transform":ortins})
+#	sim=proj.cmp("optsub",ptcl)
+	sim=proj.cmp("ccc",ptcl)
+
+	return (sim,trymap,trymapf,proj)
+
+def trial_sims(jobs,sims,ptclf,ptcl,boxsize,padsize,sym,verbose):
+	"""Thread which runs trial_map for (n,orientation) pairs from the jobs queue, putting the similarity in sims[n]"""
+	recon=Reconstructors.get("fourier",{"size":(padsize,padsize,padsize),"sym":sym,"mode":"gauss_2","verbose":max(verbose-3,0)})
+	while 1:
+		try: i,ortins=jobs.get_nowait()
+		except Queue.Empty: return
+		sims[i]=trial_map(recon,ptclf,ptcl,ortins,boxsize,padsize)[0]
+
+def map_fft(m):
+	"""Returns the Fourier transform of a map for fmapcmp, computed once so the map can be compared to many others. This is the
+	full real-to-complex transform with the origin at the center of the map, and the zero frequency term removed"""
+	f=np.fft.rfftn(np.fft.ifftshift(m.numpy())).astype(np.complex64)
+	f[0,0,0]=0
+	return f
+
+def fmapcmp(f1,f2):
+	"""Compares 2 maps transformed by map_fft taking into account handedness flips and 5-fold orientation uncertainty, as mapcmp.
+	Returns (ccc,n), where n is the transformation of the second map giving the best score: 0 - none, 1 - z flip, 2 - z flip then
+	180 degree rotation about z, 3 - 180 degree rotation about z. Over the full transform, without the zero frequency term, this is
+	the same as the real-space "ccc" of the maps"""
+	if f1 is None or f2 is None : return (2.0,0)
+
+	# the transform only has kx>=0, the other half is implied, so every other kx counts twice
+	w=np.full(f1.shape[2],2.0,dtype=np.float32)
+	w[0]=1.0
+	if f1.shape[1]%2==0 : w[-1]=1.0		# Nyquist plane, even size
+	norm=np.sqrt((w*np.abs(f1)**2).sum()*(w*np.abs(f2)**2).sum())
+	if norm==0 : return (2.0,0)
+
+	# arrays are z,y,x. A z flip inverts kz. Inverting all of k gives the complex conjugate, so the rotation about z, which
+	# inverts kx and ky, is the conjugate of the z flip
+	fz=np.roll(f2[::-1],1,0)
+	c=[-(w*(f1*np.conj(f)).real).sum()/norm for f in (f2,fz,np.conj(f2),np.conj(fz))]
+	return min(zip(c,range(4)))
+
+def mapsum(m1,m2,f1=None,f2=None):
+	"""Adds 2 maps taking into account handedness flips and 5-fold orientation uncertainty, picking the best solution for m2.
+	f1 and f2 may optionally provide map_fft() of m1 and m2 if already computed"""
 	if m1==None or m2==None : return 2.0
-	c1=m1.cmp("ccc",m2)
-	mb=m2
-	m3=m2.process("xform.flip",{"axis":"z"})
-	c2=m1.cmp("ccc",m3)
-	if c2<c1:
-		mb=m3.copy()
-		c1=c2
-	m3.rotate(180.0,0,0)
-	c2=m1.cmp("ccc",m3)
-	if c2<c1:
-		mb=m3.copy()
-		c1=c2
-	m3.process_inplace("xform.flip",{"axis":"z"})
-	c2=m1.cmp("ccc",m3)
-	if c2<c1:
-		mb=m3.copy()
-		c1=c2
+	if f1 is None : f1=map_fft(m1)
+	if f2 is None : f2=map_fft(m2)
+
+	c,v=fmapcmp(f1,f2)
+	if v==0 : mb=m2
+	else:
+		if v<3 : mb=m2.process("xform.flip",{"axis":"z"})
+		else : mb=m2.copy()
+		if v>1 : mb.rotate(180.0,0,0)
 
 	return m1+mb
 
 def mapcmp(m1,m2):
 	"""Compares 2 maps taking into account handedness flips and 5-fold orientation uncertainty"""
 	if m1==None or m2==None : return 2.0
-	c1=m1.cmp("ccc",m2)
-	m3=m2.process("xform.flip",{"axis":"z"})
-	c1=min(c1,m1.cmp("ccc",m3))
-	m3.rotate(180.0,0,0)
-	c1=min(c1,m1.cmp("ccc",m3))
-	m3.process_inplace("xform.flip",{"axis":"z"})
-	c1=min(c1,m1.cmp("ccc",m3))
-
-	return c1
+	return fmapcmp(map_fft(m1),map_fft(m2))[0]
 
 if __name__ == "__main__":
     main()
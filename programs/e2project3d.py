@@ -36,7 +36,8 @@
 # 1. Baldwin, P.R. and Penczek, P.A. 2007. The Transform Class in SPARX and EMAN2. J. Struct. Biol. 157, 250-261.
 # 2. http://blake.bcm.edu/emanwiki/EMAN2/Symmetry
 
-import sys, math, os, random
+import sys, math, os, random, time
+import hashlib
 from EMAN2 import *
 from EMAN2jsondb import JSTask,jsonclasses
 deg2rad = math.pi / 180.0
@@ -49,11 +50,13 @@ NO_MIRROR = False
 
 
 class EMParallelProject3D:
-	def __init__(self,options,fsp,sym,start,modeln=0,logger=None):
+	def __init__(self,options,fsp,sym,start,modeln=0,logger=None,eulers=None,outfile=None):
 		'''
 		@param options the options produced by (options, args) = parser.parse_args()
 		@param args the options produced by (options, args) = parser.parse_args()
 		@param logger and EMAN2 logger, i.e. logger=E2init(sys.argv)
+		@param eulers if specified, projections are generated for this list of Transforms rather than from sym/orientgen
+		@param outfile if specified, projections are written here (starting at start) rather than to options.outfile
 		assumes you have already called the check function.
 		'''
 		self.options = options
@@ -62,6 +65,8 @@ class EMParallelProject3D:
 		self.logger = logger
 		self.start=start
 		self.modeln=modeln
+		self.eulers=eulers
+		self.outfile=outfile
 
 		from EMAN2PAR import EMTaskCustomer
 		self.etc=EMTaskCustomer(options.parallel)
@@ -79,6 +84,7 @@ class EMParallelProject3D:
 		'''
 
 		'''
+		if self.eulers!=None : return
 		sym_object = parsesym(self.sym)
 		[og_name,og_args] = parsemodopt(options.orientgen)
 		self.eulers = sym_object.gen_orientations(og_name, og_args)
@@ -170,11 +176,116 @@ class EMParallelProject3D:
 		for idx,image in rslts.items():
 			if not isinstance(image,EMData): continue # this is here because we get the dimensions of the database as a key (e.g. '40x40x1').
 			image["model_id"]=self.modeln
-			if self.options.append : image.write_image(self.options.outfile,-1)
+			if self.outfile!=None : image.write_image(self.outfile,idx+self.start)
+			elif self.options.append : image.write_image(self.options.outfile,-1)
 			else : image.write_image(self.options.outfile,idx+self.start)
 
 		return True
 
+class ProjectionCache:
+	"""A content-addressed store of projections. Projections are keyed by a hash of the 3-D model (data and apix) and the
+	projection parameters, and within that by orientation, so an existing set may be reused or incrementally extended when
+	the same model is projected again, possibly with a different orientation set. Each model key has a JSON index mapping
+	orientation to (stack file,image number). New projections are always written to a new stack, so concurrent jobs sharing
+	a cache never write to the same image file."""
+
+	def __init__(self,path,model,options):
+		self.path=path
+		try: os.makedirs(path)
+		except: pass
+
+		md5=hashlib.md5()
+		mdl=model.numpy()
+		for z in xrange(model["nz"]): md5.update(mdl[z].tostring())
+		md5.update(str((model["nx"],model["ny"],model["nz"],model["apix_x"])))
+		md5.update(str((parsemodopt(options.projector),options.prethreshold,options.postprocess,options.parallel!=None)))
+		self.key=md5.hexdigest()[:20]
+		self.indexname="{}/proj_{}.json".format(path,self.key)
+		self.index=js_open_dict(self.indexname)
+		try: os.utime(self.indexname,None)		# the index modification time marks when a key was last used
+		except: pass
+
+	@staticmethod
+	def orient_key(xform):
+		d=xform.get_params("eman")
+		return "{:1.4f},{:1.4f},{:1.4f}".format(d["az"],d["alt"],d["phi"])
+
+	def missing(self,eulers):
+		"""returns the list of indices in eulers without a cached projection"""
+		keys=self.index.keys()
+		return [i for i,e in enumerate(eulers) if self.orient_key(e) not in keys]
+
+	def new_stack(self):
+		"""returns the name of a previously unused stack for storing new projections"""
+		return "{}/proj_{}_{}_{}.hdf".format(self.path,self.key,os.getpid(),int(time.time()*1000))
+
+	def add(self,eulers,stack):
+		"""records that stack contains projections for the Transforms in eulers, in order"""
+		self.index.update({self.orient_key(e):(stack,i) for i,e in enumerate(eulers)})
+
+	def get(self,xform):
+		"""returns the cached projection in orientation xform"""
+		stack,n=self.index[self.orient_key(xform)]
+		return EMData(str(stack),n)
+
+	def prune(self,maxbytes):
+		"""removes the least recently used keys (index and stacks) until the cache uses no more than maxbytes. The current key is
+		never removed"""
+		keys={}
+		for f in os.listdir(self.path):
+			if not f.startswith("proj_") : continue
+			k=f[5:25]
+			try: st=os.stat(os.path.join(self.path,f))
+			except: continue
+			if k not in keys : keys[k]=[0,0,[]]
+			keys[k][1]+=st.st_size
+			keys[k][2].append(f)
+			if f=="proj_{}.json".format(k) : keys[k][0]=st.st_mtime
+
+		total=sum([v[1] for v in keys.values()])
+		for k in sorted(keys.keys(),key=lambda k:keys[k][0]):
+			if total<=maxbytes : break
+			if k==self.key : continue
+			for f in keys[k][2]:
+				try: os.unlink(os.path.join(self.path,f))
+				except: pass
+			total-=keys[k][1]
+
+def project_with_cache(options,fsp,sym,start,modeln,logger):
+	"""Generates (or retrieves from options.cache) projections of model fsp and writes them to options.outfile starting at start.
+	Returns (number of projections written, number found in the cache)."""
+
+	data=EMData(fsp,0)
+	cache=ProjectionCache(options.cache,data,options)
+
+	sym_object = parsesym(sym)
+	[og_name,og_args] = parsemodopt(options.orientgen)
+	eulers = sym_object.gen_orientations(og_name, og_args)
+
+	missing=cache.missing(eulers)
+	if options.verbose>1 : print "Projection cache {}: {}/{} projections of {} found in cache".format(cache.key,len(eulers)-len(missing),len(eulers),fsp)
+
+	# compute only the projections we don't already have
+	if len(missing)>0 :
+		meulers=[eulers[i] for i in missing]
+		stack=cache.new_stack()
+		if options.parallel :
+			job = EMParallelProject3D(options,fsp,sym,0,modeln,logger,meulers,stack)
+			job.execute()
+		else :
+			if options.prethreshold : prethreshold(data)
+			generate_and_save_projections(options, data, meulers, options.smear,modeln,stack)
+		cache.add(meulers,stack)
+		cache.prune(options.cachesize*1.0e9)
+
+	for i,euler in enumerate(eulers):
+		p=cache.get(euler)
+		p["model_id"]=modeln
+		if options.append: p.write_image(options.outfile,-1)
+		else : p.write_image(options.outfile,i+start)
+
+	return len(eulers),len(eulers)-len(missing)
+
 def prethreshold(img):
 	"""Applies an automatic threshold to the image"""
 	snz=img["sigma_nonzero"]
@@ -253,6 +364,8 @@ def main():
 	parser.add_argument("--prethreshold",action="store_true", help="Applies an automatic threshold to the volume before projecting",default=False)
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--parallel",help="Parallelism string",default=None,type=str)
+	parser.add_argument("--cache",type=str,default=None,help="Path to a projection cache directory. Projections of an identical model with identical projection parameters are reused from the cache rather than recomputed, and new projections are added to it.")
+	parser.add_argument("--cachesize",type=float,default=10.0,help="Maximum size of the --cache directory in GB. When exceeded, projections of the least recently used models are removed. Default=10")
 
 	(options, args) = parser.parse_args()
 
@@ -297,6 +410,19 @@ def main():
 
 	logger=E2init(sys.argv,options.ppid)
 
+	if options.cache:
+		if options.cuda: EMData.switchoncuda()
+		n=0
+		nhit=0
+		for i,fsp in enumerate(args) :
+			nw,nh=project_with_cache(options,fsp,options.sym[i],n,i+1,logger)
+			n+=nw
+			nhit+=nh
+		if options.cuda: EMData.switchoffcuda()
+		if options.verbose : print "Projection cache: {}/{} projections reused, {} computed".format(nhit,n,n-nhit)
+
+		E2end(logger)
+		exit(0)
 
 	if options.parallel:
 		try:
@@ -346,7 +472,7 @@ def main():
 
 #
 
-def generate_and_save_projections(options, data, eulers, smear=0,modeln=0):
+def generate_and_save_projections(options, data, eulers, smear=0,modeln=0,outfile=None):
 	for i,euler in enumerate(eulers):
 		p=data.project(options.projector,euler)
 		p.set_attr("xform.projection",euler)
@@ -372,10 +498,11 @@ def generate_and_save_projections(options, data, eulers, smear=0,modeln=0):
 
 		p["model_id"]=modeln
 		try:
-			if options.append: p.write_image(options.outfile,-1)
+			if outfile!=None : p.write_image(outfile,i)
+			elif options.append: p.write_image(options.outfile,-1)
 			else : p.write_image(options.outfile,i)
 		except:
-			print "Error: Cannot write to file %s"%options.outfile
+			print "Error: Cannot write to file %s"%(outfile if outfile!=None else options.outfile)
 			exit(1)
 
 		if (options.verbose>0):
@@ -47,6 +47,12 @@ import os
 import sys
 import time
 import traceback
+import threading
+import glob
+import json
+import re
+import subprocess
+import Queue
 import numpy as np
 
 
@@ -54,12 +60,24 @@ import numpy as np
 output_html=[]
 output_html_com=[]
 output_path=None
+html_lock=threading.RLock()		# steps may run concurrently, see run_graph()
+
+# The step log records the time and memory used by each command, and which commands completed, for --resume
+steplog=[]
+steplog_done={}
+steplog_path=None
+
+def steplog_key(command):
+	"""The key under which a command's completion is recorded for --resume. The --threads and --parallel arguments
+	are left out, since they depend on the machine and on how the CPUs were shared between concurrent steps."""
+	return " ".join(re.sub(r"--(threads|parallel)(=|\s+)\S+","",command).split())
 
 def append_html(msg,com=False) :
 	global output_html,output_html_com
-	if com : output_html_com.append(str(msg))
-	else : output_html.append(str(msg))
-	write_html()
+	with html_lock:
+		if com : output_html_com.append(str(msg))
+		else : output_html.append(str(msg))
+		write_html()
 
 
 def write_html() :
@@ -172,6 +190,7 @@ not need to specify any of the following other than the ones already listed abov
 	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, specify type:<option>=<value>:<option>=<value>. See http://blake.bcm.edu/emanwiki/EMAN2/Parallel",default=None, guitype='strbox', row=30, col=0, rowspan=1, colspan=2, mode="refinement[thread:4]")
 	parser.add_argument("--threads", default=1,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful", guitype='intbox', row=30, col=2, rowspan=1, colspan=1, mode="refinement[4]")
 	parser.add_argument("--path", default=None, type=str,help="The name of a directory where results are placed. Default = create new refine_xx")
+	parser.add_argument("--resume", action="store_true", default=False, help="Continue an interrupted refinement in --path. Run with the same options as the original run. Commands which already completed are skipped.")
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 #	parser.add_argument("--usefilt", dest="usefilt", type=str,default=None, help="Specify a particle data file that has been low pass or Wiener filtered. Has a one to one correspondence with your particle data. If specified will be used in projection matching routines, and elsewhere.")
 
@@ -252,6 +271,10 @@ not need to specify any of the following other than the ones already listed abov
 	else:
 		m3dpreprocess="--preprocess "+options.m3dpreprocess
 
+	if options.resume and options.path==None :
+		print "ERROR : --resume requires --path with the refinement to continue"
+		sys.exit(1)
+
 	if options.path == None:
 		fls=[int(i[-2:]) for i in os.listdir(".") if i[:7]=="refine_" and len(i)==9 and str.isdigit(i[-2:])]
 		if len(fls)==0 : fls=[0]
@@ -261,6 +284,21 @@ not need to specify any of the following other than the ones already listed abov
 	try: os.makedirs(output_path)
 	except: pass
 
+	# the log of completed steps, which is how we resume
+	global steplog,steplog_path
+	steplog_path="{}/0_refine_steps.json".format(options.path)
+	if options.resume :
+		steplog=js_open_dict(steplog_path).getdefault("steps",[])
+		for st in steplog:
+			if st["status"]==0 :
+				key=steplog_key(st["cmd"])
+				steplog_done[key]=steplog_done.get(key,0)+1
+		print "Resuming, {} commands completed previously will be skipped".format(sum(steplog_done.values()))
+	js_open_dict(steplog_path)["steps"]=steplog
+
+	# with --profile (or $EMAN2PROFILE), profiles from every program we run are kept with the refinement and summarized per iteration
+	if profile_enabled() : profile_start("{}/profile".format(options.path))
+
 	# make sure the box sizes match
 	if options.input!=None :
 		xsize3d=EMData(options.model,0,True)["nx"]
@@ -584,6 +622,22 @@ are memory concerns, using a smaller pad option may be the only reasonable alter
 	elif options.threads>1: parallel="--parallel thread:{}".format(options.threads)
 	else: parallel=""
 
+	# When the even and odd branches of an iteration run at the same time, the local CPUs are divided between them.
+	# Other types of parallelism are left alone, and the branches are then run one at a time.
+	if options.parallel!=None and options.parallel[:6]!="thread" : maxpar=1
+	elif options.threads>1 : maxpar=2
+	else : maxpar=1
+
+	def threadshare(share):
+		return max(1,options.threads/share)
+
+	def parallelshare(share):
+		if options.parallel!=None and options.parallel[:6]!="thread" : return parallel
+		if options.parallel!=None : nthr=int(options.parallel[7:])
+		else : nthr=options.threads
+		if nthr/share>1 : return "--parallel thread:{}".format(nthr/share)
+		return ""
+
 	if options.prefilt : prefilt="--prefilt"
 	else: prefilt=""
 
@@ -701,6 +755,7 @@ power spectrum of one of the maps to the other. For example <i>e2proc3d.py map_e
 	### Actual refinement loop ###
 	for it in range(1,options.iter+1) :
 		append_html("<h4>Beginning iteration {} at {}</h4>".format(it,time.ctime(time.time())),True)
+		if profile_enabled() : os.environ["EMAN2PROFILETAG"]="it{:02d}".format(it)
 
 		# adjustments to classiter
 		if options.classiter<0 and classiter==initclassiter:
@@ -710,20 +765,21 @@ power spectrum of one of the maps to the other. For example <i>e2proc3d.py map_e
 			append_html("<p>*** Changing classiter from {} to {} ***</p>".format(initclassiter,classiter),True)
 
 
+		### The even and odd halves are independent until postprocessing, so each iteration through 3-D reconstruction is
+		### run as a dependency graph, where the even and odd branches can run at the same time, sharing the CPUs
+		eo=("even","odd")
+		steps=[]
+
 		### 3-D Projections
 		# Note that projections are generated on a single node only as specified by --threads
 		append_html("<p>* Generating 2-D projections of even/odd 3-D maps",True)
-		cmd = "e2project3d.py {path}/threed_{itrm1:02d}_even.hdf  --outfile {path}/projections_{itr:02d}_even.hdf -f --projector {projector} --orientgen {orient} --sym {sym} {prethr} --parallel thread:{threads} {verbose}".format(
-			path=options.path,itrm1=it-1,itr=it,projector=options.projector,orient=options.orientgen,sym=options.sym,prethr=prethreshold,threads=options.threads,verbose=verbose)
-		run(cmd)
-		cmd = "e2project3d.py  {path}/threed_{itrm1:02d}_odd.hdf --outfile {path}/projections_{itr:02d}_odd.hdf -f --projector {projector} --orientgen {orient} --sym {sym} {prethr} --parallel thread:{threads} {verbose}".format(
-			path=options.path,itrm1=it-1,itr=it,projector=options.projector,orient=options.orientgen,sym=options.sym,prethr=prethreshold,threads=options.threads,verbose=verbose)
-		run(cmd)
-		progress += 1.0
-		E2progress(logid,progress/total_procs)
+		def projcmd(share,s):
+			return "e2project3d.py {path}/threed_{itrm1:02d}_{eo}.hdf --outfile {path}/projections_{itr:02d}_{eo}.hdf -f --projector {projector} --orientgen {orient} --sym {sym} {prethr} --parallel thread:{threads} {verbose}".format(
+				path=options.path,itrm1=it-1,itr=it,eo=s,projector=options.projector,orient=options.orientgen,sym=options.sym,prethr=prethreshold,threads=threadshare(share),verbose=verbose)
+		for s in eo: steps.append(("project3d_"+s,[],lambda share,s=s:projcmd(share,s),0.5))
 
 		### We may need to make our own similarity mask file for more accurate particle classification
-		if makesimmask :
+		def simmaskstep(share):
 			av=Averagers.get("minmax",{"max":1})
 			nprj=EMUtil.get_image_count("{path}/projections_{itr:02d}_odd.hdf".format(path=options.path,itr=it))
 			print "Mask from {} projections".format(nprj)
@@ -736,47 +792,39 @@ power spectrum of one of the maps to the other. For example <i>e2proc3d.py map_e
 #			msk.process_inplace("threshold.binary",{"value":msk["sigma"]/50.0})
 			msk.process_inplace("threshold.notzero")
 			msk.write_image("{path}/simmask.hdf".format(path=options.path),0)
+			return None
+		if makesimmask : steps.append(("simmask",["project3d_even","project3d_odd"],simmaskstep,0))
 
 		if options.treeclassify:
 			### Classify using a binary tree
 			append_html("<p>* Classify each particle using a binary tree generated from the projections</p>",True)
-			cmd = "e2classifytree.py {path}/projections_{itr:02d}_even.hdf {inputfile} --output={path}/classmx_{itr:02d}_even.hdf  --nodes {path}/nodes_{itr:02d}_even.hdf --cmp {simcmp} --align {simalign} --aligncmp {simaligncmp} {simralign} {cmpdiff} --incomplete {incomplete} {parallel}".format(path=options.path,itr=it,inputfile=options.input[0],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,cmpdiff=cmpdiff,incomplete=options.treeincomplete, parallel=parallel)
-			run(cmd)
-			progress += 1.0
-
-			cmd = "e2classifytree.py {path}/projections_{itr:02d}_odd.hdf {inputfile} --output={path}/classmx_{itr:02d}_odd.hdf  --nodes {path}/nodes_{itr:02d}_odd.hdf --cmp {simcmp} --align {simalign} --aligncmp {simaligncmp} {simralign} {cmpdiff} --incomplete {incomplete} {parallel}".format(path=options.path,itr=it,inputfile=options.input[1],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,cmpdiff=cmpdiff,incomplete=options.treeincomplete,parallel=parallel)
-			run(cmd)
-			progress += 1.0
-			E2progress(logid,progress/total_procs)
+			def treecmd(share,i):
+				return "e2classifytree.py {path}/projections_{itr:02d}_{eo}.hdf {inputfile} --output={path}/classmx_{itr:02d}_{eo}.hdf  --nodes {path}/nodes_{itr:02d}_{eo}.hdf --cmp {simcmp} --align {simalign} --aligncmp {simaligncmp} {simralign} {cmpdiff} --incomplete {incomplete} {parallel}".format(path=options.path,itr=it,eo=eo[i],inputfile=options.input[i],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,cmpdiff=cmpdiff,incomplete=options.treeincomplete,parallel=parallelshare(share))
+			for i,s in enumerate(eo):
+				steps.append(("classifytree_"+s,["project3d_"+s],lambda share,i=i:treecmd(share,i),1.0))
+			clsstep="classifytree_"
 		else:
 
 			### Simmx
 			#FIXME - Need to combine simmx with classification !!!
 
 			append_html("<p>* Computing similarity of each particle to the set of projections using a hierarchical scheme. This will be the basis for classification.</p>",True)
-			cmd = "e2simmx2stage.py {path}/projections_{itr:02d}_even.hdf {inputfile} {path}/simmx_{itr:02d}_even.hdf {path}/proj_simmx_{itr:02d}_even.hdf {path}/proj_stg1_{itr:02d}_even.hdf {path}/simmx_stg1_{itr:02d}_even.hdf --saveali --cmp {simcmp} \
-	--align {simalign} --aligncmp {simaligncmp} {simralign} {shrinks1} {shrink} {prefilt} {simmask} {verbose} {parallel}".format(
-				path=options.path,itr=it,inputfile=options.input[0],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,
-				shrinks1=shrinks1,shrink=shrink,prefilt=prefilt,simmask=simmask,verbose=verbose,parallel=parallel)
-			run(cmd)
-			cmd = "e2simmx2stage.py {path}/projections_{itr:02d}_odd.hdf {inputfile} {path}/simmx_{itr:02d}_odd.hdf {path}/proj_simmx_{itr:02d}_odd.hdf {path}/proj_stg1_{itr:02d}_odd.hdf {path}/simmx_stg1_{itr:02d}_odd.hdf --saveali --cmp {simcmp} \
+			def simmxcmd(share,i):
+				return "e2simmx2stage.py {path}/projections_{itr:02d}_{eo}.hdf {inputfile} {path}/simmx_{itr:02d}_{eo}.hdf {path}/proj_simmx_{itr:02d}_{eo}.hdf {path}/proj_stg1_{itr:02d}_{eo}.hdf {path}/simmx_stg1_{itr:02d}_{eo}.hdf --saveali --cmp {simcmp} \
 	--align {simalign} --aligncmp {simaligncmp} {simralign} {shrinks1} {shrink} {prefilt} {simmask} {verbose} {parallel}".format(
-				path=options.path,itr=it,inputfile=options.input[1],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,
-				shrinks1=shrinks1,shrink=shrink,prefilt=prefilt,simmask=simmask,verbose=verbose,parallel=parallel)
-			run(cmd)
-			progress += 1.0
-			E2progress(logid,progress/total_procs)
+					path=options.path,itr=it,eo=eo[i],inputfile=options.input[i],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,
+					shrinks1=shrinks1,shrink=shrink,prefilt=prefilt,simmask=simmask,verbose=verbose,parallel=parallelshare(share))
 
 			### Classify
 			append_html("<p>* Based on the similarity values, put each particle in to 1 or more classes (depending on --sep)</p>",True)
-			cmd = "e2classify.py {path}/simmx_{itr:02d}_even.hdf {path}/classmx_{itr:02d}_even.hdf -f --sep {sep} {verbose}".format(
-				path=options.path,itr=it,sep=options.sep,verbose=verbose)
-			run(cmd)
-			cmd = "e2classify.py {path}/simmx_{itr:02d}_odd.hdf {path}/classmx_{itr:02d}_odd.hdf -f --sep {sep} {verbose}".format(
-				path=options.path,itr=it,sep=options.sep,verbose=verbose)
-			run(cmd)
-			progress += 1.0
-			E2progress(logid,progress/total_procs)
+			def classifycmd(share,s):
+				return "e2classify.py {path}/simmx_{itr:02d}_{eo}.hdf {path}/classmx_{itr:02d}_{eo}.hdf -f --sep {sep} {verbose}".format(
+					path=options.path,itr=it,eo=s,sep=options.sep,verbose=verbose)
+
+			for i,s in enumerate(eo):
+				steps.append(("simmx2stage_"+s,["project3d_"+s]+(["simmask"] if makesimmask else []),lambda share,i=i:simmxcmd(share,i),0.5))
+				steps.append(("classify_"+s,["simmx2stage_"+s],lambda share,s=s:classifycmd(share,s),0.5))
+			clsstep="classify_"
 
 		### Class-averaging
 
@@ -797,32 +845,23 @@ power spectrum of one of the maps to the other. For example <i>e2proc3d.py map_e
 			append_html("<p>Warning: classrefsf option requires 'strucfac' amplitude correction. Since this is not being used either by intent or due to the high resolution of the map, 'classrefsf' has been disabled.</p>")
 
 		append_html("<p>* Iteratively align and average all of the particles within each class, discarding the worst fraction</p>",True)
-		cmd="e2classaverage.py {inputfile} --classmx {path}/classmx_{itr:02d}_even.hdf --decayedge --storebad --output {path}/classes_{itr:02d}_even.hdf --ref {path}/projections_{itr:02d}_even.hdf --iter {classiter} \
--f --resultmx {path}/cls_result_{itr:02d}_even.hdf --normproc {normproc} --averager {averager} {classrefsf} {classautomask} --keep {classkeep} {classkeepsig} --cmp {classcmp} \
---align {classalign} --aligncmp {classaligncmp} {classralign} {prefilt} {verbose} {parallel}".format(
-			inputfile=cainput[0], path=options.path, itr=it, classiter=classiter, normproc=options.classnormproc, averager=options.classaverager, classrefsf=classrefsf,
-			classautomask=classautomask,classkeep=options.classkeep, classkeepsig=classkeepsig, classcmp=options.classcmp, classalign=options.classalign, classaligncmp=options.classaligncmp,
-			classralign=classralign, prefilt=prefilt, verbose=verbose, parallel=parallel)
-		run(cmd)
-		cmd="e2classaverage.py {inputfile} --classmx {path}/classmx_{itr:02d}_odd.hdf --decayedge --storebad --output {path}/classes_{itr:02d}_odd.hdf --ref {path}/projections_{itr:02d}_odd.hdf --iter {classiter} \
--f --resultmx {path}/cls_result_{itr:02d}_odd.hdf --normproc {normproc} --averager {averager} {classrefsf} {classautomask} --keep {classkeep} {classkeepsig} --cmp {classcmp} \
+		def classavgcmd(share,i,classrefsf=classrefsf,classiter=classiter):
+			return "e2classaverage.py {inputfile} --classmx {path}/classmx_{itr:02d}_{eo}.hdf --decayedge --storebad --output {path}/classes_{itr:02d}_{eo}.hdf --ref {path}/projections_{itr:02d}_{eo}.hdf --iter {classiter} \
+-f --resultmx {path}/cls_result_{itr:02d}_{eo}.hdf --normproc {normproc} --averager {averager} {classrefsf} {classautomask} --keep {classkeep} {classkeepsig} --cmp {classcmp} \
 --align {classalign} --aligncmp {classaligncmp} {classralign} {prefilt} {verbose} {parallel}".format(
-			inputfile=cainput[1], path=options.path, itr=it, classiter=classiter, normproc=options.classnormproc, averager=options.classaverager, classrefsf=classrefsf,
-			classautomask=classautomask,classkeep=options.classkeep, classkeepsig=classkeepsig, classcmp=options.classcmp, classalign=options.classalign, classaligncmp=options.classaligncmp,
-			classralign=classralign, prefilt=prefilt, verbose=verbose, parallel=parallel)
-		run(cmd)
-		progress += 1.0
-		E2progress(logid,progress/total_procs)
+				inputfile=cainput[i], path=options.path, itr=it, eo=eo[i], classiter=classiter, normproc=options.classnormproc, averager=options.classaverager, classrefsf=classrefsf,
+				classautomask=classautomask,classkeep=options.classkeep, classkeepsig=classkeepsig, classcmp=options.classcmp, classalign=options.classalign, classaligncmp=options.classaligncmp,
+				classralign=classralign, prefilt=prefilt, verbose=verbose, parallel=parallelshare(share))
+		for i,s in enumerate(eo): steps.append(("classaverage_"+s,[clsstep+s],lambda share,i=i:classavgcmd(share,i),0.5))
+		m3ddep="classaverage_"
 
 		### Refine Euler angles of class-averages
 		if options.eulerrefine and it>1 :
-			cmd="e2euler_refine.py --input {path}/classes_{itr:02d}_even.hdf --ref_volume {path}/threed_{itrm1:02d}_even.hdf --threads {threads} {verbose}".format(
-				path=options.path, itr=it, itrm1=it-1,threads=options.threads,verbose=verbose)
-			run(cmd)
-			
-			cmd="e2euler_refine.py --input {path}/classes_{itr:02d}_odd.hdf --ref_volume {path}/threed_{itrm1:02d}_odd.hdf --threads {threads} {verbose}".format(
-				path=options.path, itr=it, itrm1=it-1,threads=options.threads,verbose=verbose)
-			run(cmd)
+			def eulercmd(share,s):
+				return "e2euler_refine.py --input {path}/classes_{itr:02d}_{eo}.hdf --ref_volume {path}/threed_{itrm1:02d}_{eo}.hdf --threads {threads} {verbose}".format(
+					path=options.path, itr=it, itrm1=it-1, eo=s, threads=threadshare(share),verbose=verbose)
+			for s in eo: steps.append(("eulerrefine_"+s,["classaverage_"+s],lambda share,s=s:eulercmd(share,s),0))
+			m3ddep="eulerrefine_"
 
 		### 3-D Reconstruction
 		# FIXME - --lowmem removed due to some tricky bug in e2make3d
@@ -830,46 +869,33 @@ power spectrum of one of the maps to the other. For example <i>e2proc3d.py map_e
 		else : m3dsym=options.sym
 		append_html("<p>* Using the known orientations, reconstruct the even/odd 3-D maps from the even/odd 2-D class-averages.</p>",True)
 
-		if not options.m3dold :
-			cmd="e2make3dpar.py --input {path}/classes_{itr:02d}_even.hdf --sym {sym} --output {path}/threed_{itr:02d}_even.hdf {preprocess} \
+		def make3dcmd(share,s):
+			if not options.m3dold :
+				cmd="e2make3dpar.py --input {path}/classes_{itr:02d}_{eo}.hdf --sym {sym} --output {path}/threed_{itr:02d}_{eo}.hdf {preprocess} \
  --keep {m3dkeep} {keepsig} --apix {apix} --pad {m3dpad} --mode gauss_var --threads {threads} {verbose}".format(
-			path=options.path, itr=it, sym=m3dsym, recon=options.recon, preprocess=m3dpreprocess,  m3dkeep=options.m3dkeep, keepsig=m3dkeepsig,
-			m3dpad=options.pad,fillangle=astep ,threads=options.threads, apix=apix, verbose=verbose)
-		else:
-			cmd="e2make3d.py --input {path}/classes_{itr:02d}_even.hdf --iter 2 -f --sym {sym} --output {path}/threed_{itr:02d}_even.hdf --recon {recon} {preprocess} \
- --keep={m3dkeep} {keepsig} --apix={apix} --pad={m3dpad} {verbose}".format(
-			path=options.path, itr=it, sym=m3dsym, recon=options.recon, preprocess=m3dpreprocess,  m3dkeep=options.m3dkeep, keepsig=m3dkeepsig,
-			m3dpad=options.pad, apix=apix, verbose=verbose)
-
-		#if options.classweight == "count":
-		#	pass # this is the default.
-		#elif options.classweight == "sqrt":
-		#	cmd += " --sqrtnorm"
-		#elif options.classwright == "no_wt":
-		#	cmd += " --no_wt"
-
-		run(cmd)
-
-		if not options.m3dold :
-			cmd="e2make3dpar.py --input {path}/classes_{itr:02d}_odd.hdf --sym {sym} --output {path}/threed_{itr:02d}_odd.hdf {preprocess} \
- --keep {m3dkeep} {keepsig} --apix {apix} --pad {m3dpad} --mode gauss_var --threads {threads} {verbose}".format(
-			path=options.path, itr=it, sym=m3dsym, recon=options.recon, preprocess=m3dpreprocess, m3dkeep=options.m3dkeep, keepsig=m3dkeepsig,
-			m3dpad=options.pad, apix=apix, fillangle=astep ,threads=options.threads, verbose=verbose)
-		else:
-			cmd="e2make3d.py --input {path}/classes_{itr:02d}_odd.hdf --iter 2 -f --sym {sym} --output {path}/threed_{itr:02d}_odd.hdf --recon {recon} {preprocess} \
+				path=options.path, itr=it, eo=s, sym=m3dsym, recon=options.recon, preprocess=m3dpreprocess,  m3dkeep=options.m3dkeep, keepsig=m3dkeepsig,
+				m3dpad=options.pad,fillangle=astep ,threads=threadshare(share), apix=apix, verbose=verbose)
+			else:
+				cmd="e2make3d.py --input {path}/classes_{itr:02d}_{eo}.hdf --iter 2 -f --sym {sym} --output {path}/threed_{itr:02d}_{eo}.hdf --recon {recon} {preprocess} \
  --keep={m3dkeep} {keepsig} --apix={apix} --pad={m3dpad} {verbose}".format(
-			path=options.path, itr=it, sym=m3dsym, recon=options.recon, preprocess=m3dpreprocess, m3dkeep=options.m3dkeep, keepsig=m3dkeepsig,
-			m3dpad=options.pad, apix=apix, verbose=verbose)
-
-		#if options.classweight == "count":
-		#	pass # this is the default.
-		#elif options.classweight == "sqrt":
-		#	cmd += " --sqrtnorm"
-		#elif options.classwright == "no_wt":
-		#	cmd += " --no_wt"
-
-		run(cmd)
-		progress += 1.0
+				path=options.path, itr=it, eo=s, sym=m3dsym, recon=options.recon, preprocess=m3dpreprocess,  m3dkeep=options.m3dkeep, keepsig=m3dkeepsig,
+				m3dpad=options.pad, apix=apix, verbose=verbose)
+
+			#if options.classweight == "count":
+			#	pass # this is the default.
+			#elif options.classweight == "sqrt":
+			#	cmd += " --sqrtnorm"
+			#elif options.classwright == "no_wt":
+			#	cmd += " --no_wt"
+			return cmd
+		for s in eo: steps.append(("make3d_"+s,[m3ddep+s],lambda share,s=s:make3dcmd(share,s),0.5))
+
+		def stepdone(weight):
+			stepprog[0]+=weight
+			E2progress(logid,stepprog[0]/total_procs)
+		stepprog=[progress]
+		run_graph(steps,maxpar,stepdone)
+		progress += 5.0
 
 		### postprocessing
 		append_html("""<p>* Finally, determine the resolution, filter and mask the even/odd maps, and then produce the final 3-D map for this iteration.
@@ -1050,6 +1076,7 @@ ampcorrect=ampcorrect,tophat=tophat))
 			except: append_html("<p>Iteration {}: Didn't find resolutions for all 3 curves".format(it))
 
 		E2progress(logid,progress/total_procs)
+		if profile_enabled() : profile_iteration(options.path,it)
 
 	if len(lastres)==0 :
 		append_html("""<p>I was unable to determine a resolution for your final iteration. This should not normally happen, and generally indicates a problem. 
@@ -1118,10 +1145,7 @@ For the final completed iteration, the unmasked even and odd volumes are also re
 def run(command):
 	"Mostly here for debugging, allows you to control how commands are executed (os.system is normal)"
 
-	print "{}: {}".format(time.ctime(time.time()),command)
-	append_html("<p>{}: {}</p>".format(time.ctime(time.time()),command),True)
-
-	ret=launch_childprocess(command)
+	ret=run_cmd(command)
 
 	# We put the exit here since this is what we'd do in every case anyway. Saves replication of error detection code above.
 	if ret !=0 :
@@ -1130,5 +1154,103 @@ def run(command):
 
 	return
 
+def run_cmd(command,label=None,share=1):
+	"""Runs a single command and returns its exit status. The wall time, CPU time and peak memory of the command are
+recorded in the HTML command log and in 0_refine_steps.json. With --resume, commands which completed in the previous run
+are skipped. May be called from several threads at once."""
+
+	with html_lock:
+		key=steplog_key(command)
+		if steplog_done.get(key,0)>0 :
+			steplog_done[key]-=1
+			print "{}: (completed previously) {}".format(time.ctime(time.time()),command)
+			append_html("<p>{}: (completed previously, skipped) {}</p>".format(time.ctime(time.time()),command),True)
+			return 0
+
+		print "{}: {}".format(time.ctime(time.time()),command)
+		append_html("<p>{}: {}</p>".format(time.ctime(time.time()),command),True)
+
+	t0=time.time()
+	if get_platform()=="Windows" :
+		ret=launch_childprocess(command)
+		cpu=maxrss=-1.0
+	else:
+		# same as launch_childprocess, but wait4 also gives us the resources used by the command and its children
+		p=subprocess.Popen(str(command)+" --ppid=%d"%os.getpid(), shell=True)
+		ret,ru=os.wait4(p.pid,0)[1:]
+		cpu=ru.ru_utime+ru.ru_stime
+		if sys.platform=="darwin" : maxrss=ru.ru_maxrss/1048576.0		# bytes on Mac, kB on Linux
+		else : maxrss=ru.ru_maxrss/1024.0
+	wall=time.time()-t0
+
+	with html_lock:
+		steplog.append({"label":label,"cmd":command,"start":time.ctime(t0),"wall":wall,"cpu":cpu,"maxrss_mb":maxrss,"share":share,"status":ret})
+		js_open_dict(steplog_path)["steps"]=steplog
+		if cpu>=0 : append_html("<p>&nbsp;&nbsp;{}finished in {:1.1f} s ({:1.1f} s CPU, {:1.0f} MB peak)</p>".format("" if label==None else label+" ",wall,cpu,maxrss),True)
+		else : append_html("<p>&nbsp;&nbsp;{}finished in {:1.1f} s</p>".format("" if label==None else label+" ",wall),True)
+
+	return ret
+
+def profile_iteration(path,it):
+	"""Combines the profiles of all programs run during iteration it into {path}/profile/iter_{it}.json and adds a
+	summary to the report"""
+	prof=profile_merge(glob.glob("{}/profile/it{:02d}_*.json".format(path,it)))
+	out=file("{}/profile/iter_{:02d}.json".format(path,it),"w")
+	json.dump(prof,out,indent=1,sort_keys=True)
+	out.close()
+
+	calls=sorted(((v["time"],kind,name,v["n"]) for kind,d in prof["calls"].items() for name,v in d.items()),reverse=True)
+	progs=sorted(((v["cpu"],name,v["n"]) for name,v in prof["programs"].items()),reverse=True)
+	append_html("<p>Profile for iteration {}: {:1.2f} CPU hours, peak memory {:1.2f} GB in a single process.<br>Programs by CPU time: {}<br>Most time consuming algorithms: {}</p>".format(
+		it,(prof["cpu_user"]+prof["cpu_sys"])/3600.0,prof["maxrss_kb"]/1048576.0,
+		", ".join("{} ({:1.0f} s)".format(name,t) for t,name,n in progs[:6]),
+		", ".join("{} {} ({} calls, {:1.0f} s)".format(kind,name,n,t) for t,kind,name,n in calls[:6])))
+
+def run_graph(steps,maxpar=2,callback=None):
+	"""Runs a set of steps with dependencies, eg - the even and odd branches of one iteration. steps is a list of
+(name,deps,action,weight). A step is started once all of the steps named in deps have completed, with up to maxpar steps
+running at once. action(share) returns the command to run, where share is the number of steps dividing the CPUs between
+them when the step starts, or does the work itself and returns None. callback(weight) is called as each step completes.
+If any step fails, the program exits once the other running steps finish, as run() would."""
+
+	pending=list(steps)
+	done=set()
+	running={}
+	finished=Queue.Queue()
+
+	def runstep(name,action,share):
+		try:
+			cmd=action(share)
+			if cmd==None : ret=0
+			else : ret=run_cmd(cmd,name,share)
+		except:
+			traceback.print_exc()
+			ret=1
+		finished.put((name,ret))
+
+	while len(pending)>0 or len(running)>0:
+		ready=[st for st in pending if all(d in done for d in st[1])]
+		if len(ready)==0 and len(running)==0 :
+			raise Exception,"Unsatisfiable step dependencies: {}".format([st[0] for st in pending])
+
+		while len(ready)>0 and len(running)<maxpar:
+			st=ready.pop(0)
+			pending.remove(st)
+			share=min(maxpar,len(running)+len(ready)+1)
+			running[st[0]]=st
+			threading.Thread(target=runstep,args=(st[0],st[2],share)).start()
+
+		name,ret=finished.get()
+		st=running.pop(name)
+		if ret!=0 :
+			while len(running)>0 : running.pop(finished.get()[0])
+			print "Error running step: ",name
+			sys.exit(1)
+
+		done.add(name)
+		if callback!=None : callback(st[3])
+
+	return
+
 if __name__ == "__main__":
     main()
@@ -3956,12 +3956,168 @@ def align3Dfunc(fixedimage,image,ptclnum,label,options,transform,currentIter):
 	return {"final":bestfinal,"coarse":bestcoarse}
 
 
+'''
+CLASS TO ALIGN A GROUP OF PARTICLES AGAINST ALL REFERENCES IN ONE TASK
+'''
+class Align3DMultiTask(JSTask):
+	"""This is a task object for the parallelism system. It aligns a group of 3-D volumes to every reference in a list,
+	reading each particle (and its fine alignment variant) only once for all references"""
+
+	def __init__(self,refs,image,ptclnums,label,options,transform,currentIter,imagefine=None):
+	
+		"""refs is a list of [coarse,fine] pairs, each an EMData object or ["cache",path,number]; fine may be None.
+		image and imagefine are the coarse and fine preprocessed particle stacks, and ptclnums lists the particles
+		to align in this task. label is a descriptive string, not actually used in processing"""
+		
+		data={"image":["cache",image,ptclnums]}
+		if imagefine:
+			data["imagefine"]=["cache",imagefine,ptclnums]
+		
+		#each reference gets its own key so the parallelism system can precache it
+		for i,ref in enumerate(refs):
+			data["ref%d"%i]=ref[0]
+			if ref[1] is not None:
+				data["reffine%d"%i]=ref[1]
+		
+		JSTask.__init__(self,"ClassAv3dMulti",data,{},"")
+
+		self.classoptions={"options":options,"ptclnums":ptclnums,"nrefs":len(refs),"label":label,"transform":transform,"currentIter":currentIter}
+	
+	def execute(self,callback=None):
+		"""This aligns each volume in the group to every reference and returns {"results":[(ptclnum,[{"final","coarse"} per reference])]}"""
+		classoptions=self.classoptions
+		
+		refs=[]
+		for i in xrange(classoptions['nrefs']):
+			ref=self.data["ref%d"%i]
+			if not isinstance(ref,EMData):
+				ref=EMData(ref[1],ref[2])
+			
+			reffine=None
+			if "reffine%d"%i in self.data:
+				reffine=self.data["reffine%d"%i]
+				if not isinstance(reffine,EMData):
+					reffine=EMData(reffine[1],reffine[2])
+			
+			refs.append([ref,reffine])
+		
+		ptclnums=classoptions['ptclnums']
+		ret=[]
+		for i,ptclnum in enumerate(ptclnums):
+			if callback!=None:
+				callback(int(100*i/len(ptclnums)))
+			
+			image=EMData(self.data["image"][1],ptclnum)
+			imagefine=None
+			if "imagefine" in self.data:
+				imagefine=EMData(self.data["imagefine"][1],ptclnum)
+			
+			label="ptcl %d in %s"%(ptclnum,classoptions['label'])
+			ret.append((ptclnum,align3Dmultifunc(refs,image,ptclnum,label,classoptions['options'],classoptions['transform'],classoptions['currentIter'],imagefine)))
+		
+		#the parallelism system requires a dictionary as the task result
+		return {"results":ret}
+
+'''
+FUNCTION FOR ALIGNING ONE PARTICLE AGAINST SEVERAL REFERENCES
+'''
+def align3Dmultifunc(refs,image,ptclnum,label,options,transform,currentIter,imagefine=None):
+	"""This aligns one volume to each [coarse,fine] reference pair in refs and returns one {"final","coarse"} dict per reference"""
+
+	if type(image) is list:
+		image=EMData(image[1],image[2])
+	
+	if type(imagefine) is list:
+		imagefine=EMData(imagefine[1],imagefine[2])
+	
+	if imagefine is None and options.falign and 'rotate_translate_3d_tree' not in options.align[0]:
+		imagefine=image
+	
+	nptcls = EMUtil.get_image_count(options.input)
+	xformslabel = 'subtomo_' + str(ptclnum).zfill( len( str(nptcls) ) )
+	
+	refpreprocess=0
+	
+	try:
+		if not options.ref or options.ref == '' or options.refpreprocess:
+			refpreprocess=1
+	except:
+		refpreprocess=1
+	
+	try:
+		if int(options.iter) > 1 and currentIter > 0:
+			refpreprocess=1
+	except:
+		refpreprocess=1
+	
+	ret=[]
+	for ref,reffine in refs:
+		if not ref['maximum'] and not ref['minimum']:
+			print "Error. Empty reference."
+			sys.exit()
+		
+		if reffine is None and imagefine is not None:
+			reffine=ref
+		
+		#alignment() stores (and rescales) the starting transform inside options, so each reference gets its own copy
+		t=None
+		if transform:
+			t=Transform(transform)
+		
+		r=alignment(ref,image,label,options,xformslabel,currentIter,t,'e2spt_classaverage',refpreprocess,reffine,imagefine)
+		ret.append({"final":r[0],"coarse":r[1]})
+	
+	return ret
+
+
+def ptclchunks(nptcls,ncpus,pertask=3):
+	"""Splits the particle numbers into about 'pertask' contiguous groups per worker, enough to balance the load
+	without paying the per-task overhead of reading references for every particle"""
+	ntasks=max(1,min(nptcls,ncpus*pertask))
+	return [range(i*nptcls/ntasks,(i+1)*nptcls/ntasks) for i in xrange(ntasks)]
+
+
+def get_results_multi(etc,tids,verbose,nptcls,nrefs):
+	'''This will get results for a list of submitted Align3DMultiTask tasks. Won't return until it has all requested results.
+	Returns one list per reference, in the same [final,ptclnum,coarse] format as get_results'''
+	
+	import gc
+	gc.collect()
+	
+	results=[[0]*nptcls for i in xrange(nrefs)]
+	
+	ncomplete=0
+	tidsleft = tids[:]
+	while 1:
+		time.sleep(5)
+		proglist = etc.check_task(tidsleft)
+		for i,prog in enumerate(proglist):
+			if prog == 100:
+				r = etc.get_results( tidsleft[i] )			# results for a completed task
+				for ptcl,ptclresults in r[1]['results']:
+					for j,pr in enumerate(ptclresults):
+						if pr['final']:
+							results[j][ptcl] = [ filter(None,pr['final']), ptcl, filter(None,pr['coarse']) ]
+				
+				ncomplete+=1
+		
+		tidsleft=[j for i,j in enumerate(tidsleft) if proglist[i]!=100]		# remove any completed tasks from the list we ask about
+		if verbose:
+			print "  %d tasks, %d complete        \r"%(len(tids),ncomplete)
+			sys.stdout.flush()
+	
+		if len(tidsleft)==0: break
+		
+	return [filter(None,refresults) for refresults in results]
+
+
 '''
 FUNCTION THAT DOES THE ACTUAL ALIGNMENT OF TWO GIVEN SUBVOLUMES -This is also used by e2spt_hac.py, 
 e2spt_binarytree.py and e2spt_refinemulti.py, any modification to it or its used parameters 
-should be made with caution
+should be made with caution. fixedimagefine and imagefine let callers that align one 
+particle against several references pass in the fine variants they have already read
 '''
-def alignment( fixedimage, image, label, options, xformslabel, iter, transform, prog='e2spt_classaverage', refpreprocess=0 ):
+def alignment( fixedimage, image, label, options, xformslabel, iter, transform, prog='e2spt_classaverage', refpreprocess=0, fixedimagefine=None, imagefine=None ):
 	
 	gc.collect() 	#free up unused memory
 	
@@ -4009,7 +4165,10 @@ def alignment( fixedimage, image, label, options, xformslabel, iter, transform,
 
 	s2fixedimage = fixedimage.copy()
 	
-	if options.falign and 'rotate_translate_3d_tree' not in options.align[0]:
+	if fixedimagefine is not None:
+		s2fixedimage = fixedimagefine
+	
+	elif options.falign and 'rotate_translate_3d_tree' not in options.align[0]:
 		if options.ref:
 			try:
 				s2fixedimage = EMData( options.path + '/' + options.ref.replace('.hdf','_preprocfine.hdf'), 0 )
@@ -4115,7 +4274,10 @@ def alignment( fixedimage, image, label, options, xformslabel, iter, transform,
 	
 	s2image = image.copy()
 	
-	if options.falign and 'rotate_translate_3d_tree' not in options.align[0]:
+	if imagefine is not None:
+		s2image = imagefine
+	
+	elif options.falign and 'rotate_translate_3d_tree' not in options.align[0]:
 		try:
 			s2image = EMData( options.path + '/' + options.input.replace('.hdf','_preprocfine.hdf'), 0 )
 		except:
@@ -4555,6 +4717,7 @@ def alignment( fixedimage, image, label, options, xformslabel, iter, transform,
 	
 
 jsonclasses["Align3DTask"]=Align3DTask.from_jsondict
+jsonclasses["Align3DMultiTask"]=Align3DMultiTask.from_jsondict
 
 
 def classmx_ptcls(classmx,n):
@@ -36,7 +36,7 @@ import os
 from EMAN2 import *
 from EMAN2jsondb import JSTask,jsonclasses
 
-from e2spt_classaverage import Align3DTask, align3Dfunc, get_results
+from e2spt_classaverage import Align3DMultiTask, align3Dmultifunc, get_results_multi, ptclchunks
 
 import subprocess
 
@@ -314,6 +314,9 @@ def main():
 	
 	from e2spt_classaverage import cmdpreproc
 	
+	rawinput = options.input
+	options.inputfine = None
+	
 	if options.mask or options.maskfile or options.normproc or options.threshold or options.clip or (options.shrink > 1) or options.lowpass or options.highpass or options.preprocess:		
 		ret = cmdpreproc( options.input, options, False )
 		if ret: 
@@ -337,9 +340,16 @@ def main():
 	if 'rotate_translate_3d_tree' not in options.align and options.falign:
 		if options.mask or options.maskfile or options.normproc or options.threshold or options.clip or (options.shrinkfine > 1) or options.lowpassfine or options.highpassfine or options.preprocessfine:	
 			
-			ret = cmdpreproc( options.input, options, True ) #True tells the function that particles need to be preprocessed for fine alignment
+			coarseinput = options.input
+			ret = cmdpreproc( rawinput, options, True ) #True tells the function that particles need to be preprocessed for fine alignment
 			if ret: 
 				preprocdone += 1
+				'''
+				Keep the fine alignment stack separate so that each particle's coarse and fine variants are both 
+				computed once here and read directly during alignment
+				'''
+				options.inputfine = options.path + '/' + ret
+				options.input = coarseinput
 			else:
 				print "\n(e2spt_refinemulti)(main) preprocessing --input for fine alignment failed"
 	
@@ -860,6 +870,8 @@ def main():
 				etc=EMTaskCustomer(options.parallel)
 
 				pclist=[options.input]
+				if options.inputfine:
+					pclist.append(options.inputfine)
 
 				etc.precache(pclist)
 		
@@ -973,6 +985,7 @@ def main():
 			print "\nthere are these many refs", len(reffilesrefine)
 			print "these are the refs", reffilesrefine
 		
+			refs = []
 			for refindx in reffilesrefine:
 			
 				#results = refineref ( options, reffilesrefine[refindx], nptcls, it )
@@ -980,12 +993,6 @@ def main():
 			
 				if not finalize:
 			
-					tasks = []
-					results = []
-			
-					transform = None
-					# loop over volumes
-	
 					#ref.write_image(os.path.join(options.path,"tmpref.hdf"),0)
 					reffile = reffilesrefine[refindx]
 			
@@ -1049,33 +1056,65 @@ def main():
 					
 					#print "\nusing this reffile", reffile
 					print "\nusing this ref2use", ref2use
-					'''
-					set up tasks
-					'''
-					for i in range( nptcls ):
-						ptclnum = i
-						if options.parallel:
-							task=Align3DTask( ["cache", ref2use , 0], ["cache",options.input,ptclnum],ptclnum, "ptcl %d in iter %d" % (ptclnum, it), options, transform, it )
-							tasks.append(task)
-						else:
-							#print "No parallelism specified"
-							result=align3Dfunc( ["cache", ref2use , 0], ["cache",options.input,ptclnum],ptclnum, "Ptcl %d in iter %d" % (ptclnum, it), options, transform, it )
-							results.append(result['final'])
-
-
+					
+					reffine = None
+					if options.falign and 'tree' not in options.align[0]:
+						reffine = ["cache", ref2usefine, 0]
+					
+					refs.append( [ ["cache", ref2use, 0], reffine ] )
+			
+			
+			'''
+			set up tasks; each task aligns a group of particles against ALL references, so each particle
+			(and its fine alignment variant) is read once per iteration rather than once per reference
+			'''
+			allresults = []
+			
+			if not finalize:
+				transform = None
+				
+				if options.parallel:
+					tasks = []
+					for ptclnums in ptclchunks( nptcls, etc.cpu_est() ):
+						task = Align3DMultiTask( refs, options.input, ptclnums, "iter %d" % (it), options, transform, it, options.inputfine )
+						tasks.append(task)
+				
 					'''
 					start alignments (execute tasks)
 					'''
-					if options.parallel:
-						tids = etc.send_tasks(tasks)
-						if options.verbose: 
-							print "in iteration %d number of tasks %d queued, to refine ref2use %s"%(it,len(tids),ref2use) 
+					tids = etc.send_tasks(tasks)
+					if options.verbose: 
+						print "in iteration %d number of tasks %d queued, to refine %d references"%(it,len(tids),len(refs)) 
 
-						"""Wait for alignments to finish and get results"""
-						results = get_results(etc,tids,options.verbose, nptcls ,'refinemulti')
+					"""Wait for alignments to finish and get results"""
+					allresults = get_results_multi(etc,tids,options.verbose, nptcls, len(refs))
+				
+				else:
+					#print "No parallelism specified"
+					refimgs = []
+					for ref in refs:
+						reffineimg = None
+						if ref[1]:
+							reffineimg = EMData( ref[1][1], 0 )
+						refimgs.append( [ EMData( ref[0][1], 0 ), reffineimg ] )
+					
+					allresults = [ [] for ref in refs ]
+					for ptclnum in range( nptcls ):
+						image = EMData( options.input, ptclnum )
+						imagefine = None
+						if options.inputfine:
+							imagefine = EMData( options.inputfine, ptclnum )
+						
+						ptclresults = align3Dmultifunc( refimgs, image, ptclnum, "Ptcl %d in iter %d" % (ptclnum, it), options, transform, it, imagefine )
+						for j,result in enumerate( ptclresults ):
+							allresults[j].append( [ result['final'], ptclnum, result['coarse'] ] )
 			
+			for refk,refindx in enumerate( reffilesrefine ):
 			
+				if not finalize:
 				
+					results = allresults[ refk ]
+					ref2use = refs[ refk ][0][1]
 				
 					'''
 					Add info per particle for results from all references to a master dictionary, 'masterInfo',
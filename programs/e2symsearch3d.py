@@ -35,6 +35,9 @@
 from EMAN2 import *
 import math
 import os
+import threading
+import Queue
+import numpy as np
 from EMAN2jsondb import JSTask,jsonclasses
 import sys
 
@@ -102,6 +105,12 @@ def main():
 	parser.add_argument('--subset',type=int,default=0,help="""Number of particles in a subset of particles from the --input stack of particles to run the alignments on.""")
 	
 	parser.add_argument("--steps", dest="steps", type = int, default=10, help="""Number of steps (for the MC). Default=10.""", guitype='intbox', row=5, col=1, rowspan=1, colspan=1)
+
+	parser.add_argument("--fourier", action="store_true", default=False, help="""Default=False. Instead of the MC search, score a grid of orientations covering one asymmetric unit, and refine the best few, entirely in Fourier space, using a single FFT of each volume. The best result is then refined in real space as with the MC. Uses the number of threads from --parallel=thread:N.""")
+
+	parser.add_argument("--delta", type=float, default=10.0, help="""Default=10. Angular step in degrees of the initial grid for --fourier.""")
+
+	parser.add_argument("--maxres", type=float, default=0, help="""Default=0 (1/4 of Nyquist). Highest resolution in A used to compare volumes with --fourier.""")
 	
 	parser.add_argument("--symmetrize", default=False, action="store_true", help="""Symmetrize volume after alignment.""", guitype='boolbox', row=6, col=0, rowspan=1, colspan=1)
 	
@@ -343,10 +352,17 @@ def main():
 			
 			print "\nDone preprocessing on ptcl",i
 		
-		if options.parallel :
-			etc=EMTaskCustomer(options.parallel)
+		if options.fourier :
+			try: nthreads=int(options.parallel.split(":")[1])
+			except: nthreads=1
+			rmax=0
+			if options.maxres>0 : rmax=int(preprocvol["nx"]*preprocvol["apix_x"]/options.maxres)
+			symalgorithm = FourierSymAlignStrategy( preprocvol, options.sym, options.steps, options.cmp, None, options.delta, rmax, nthreads)
+		else:
+			if options.parallel :
+				etc=EMTaskCustomer(options.parallel)
 		
-		symalgorithm = SymALignStrategy( preprocvol, options.sym, options.steps, options.cmp, etc)
+			symalgorithm = SymALignStrategy( preprocvol, options.sym, options.steps, options.cmp, etc)
 		ret = symalgorithm.execute()
 		symxform = ret[0]
 		score = ret[1]
@@ -599,6 +615,174 @@ class SymALignStrategy(Strategy):
 		return [bestxform, bestscore]
 		
 		
+class FourierSymAlignStrategy(Strategy):
+	""" Coarse-to-fine search in Fourier space followed by real-space minimization from the best orientation """
+	def __init__(self, volume, sym, steps, comp, etc, delta=10.0, rmax=0, threads=1):
+		Strategy.__init__(self, volume, sym, steps, comp, etc)
+		self.delta=delta
+		self.rmax=rmax
+		self.threads=threads
+
+	def execute(self):
+		fss=FourierSymSearch(self.volume,self.sym,rmax=self.rmax,threads=self.threads)
+		solns=fss.search(self.delta)
+		print "Best Fourier search scores:"," ".join(["%1.4f"%s[0] for s in solns])
+
+		# the Fourier search assumes the symmetry axes pass through the center, so we finish with a real-space refinement, which includes translation
+		symalign=SymAlignTask(self.volume, self.sym, self.cmp, solns[0][1]).execute()["symalign"]
+
+		return [symalign.get_attr('xform.align3d'), symalign.get_attr('score')]
+
+def xform_to_mat(xf):
+	"""Returns the 3x3 rotation matrix of a Transform as a numpy array"""
+	m=xf.get_matrix()
+	return np.array(((m[0],m[1],m[2]),(m[4],m[5],m[6]),(m[8],m[9],m[10])))
+
+def mat_to_xform(m):
+	"""Returns a Transform for a 3x3 rotation matrix"""
+	return Transform([float(m[0,0]),float(m[0,1]),float(m[0,2]),0.0,float(m[1,0]),float(m[1,1]),float(m[1,2]),0.0,float(m[2,0]),float(m[2,1]),float(m[2,2]),0.0])
+
+def axis_rotations(step):
+	"""Returns (26,3,3) rotations by step degrees about each of the 26 axes pointing from the center to the neighbors of a voxel"""
+	axes=np.array([(x,y,z) for x in (-1,0,1) for y in (-1,0,1) for z in (-1,0,1) if x or y or z],np.float64)
+	axes/=np.sqrt((axes**2).sum(1))[:,np.newaxis]
+	c=math.cos(math.radians(step))
+	s=math.sin(math.radians(step))
+	ret=[]
+	for x,y,z in axes:
+		k=np.array(((0,-z,y),(z,0,-x),(-y,x,0)))
+		ret.append(np.identity(3)+s*k+(1.0-c)*np.dot(k,k))		# Rodrigues
+	return np.array(ret)
+
+def fourier_sample3(fp,x,y,z):
+	"""Trilinear interpolation of a complex (nz,ny,nx) transform at fractional pixel coordinates x,y,z, with periodic wrapping"""
+	nz,ny,nx=fp.shape
+	x0=np.floor(x).astype(int)
+	y0=np.floor(y).astype(int)
+	z0=np.floor(z).astype(int)
+	dx=(x-x0).astype(np.float32)
+	dy=(y-y0).astype(np.float32)
+	dz=(z-z0).astype(np.float32)
+	x0%=nx
+	y0%=ny
+	z0%=nz
+	x1=(x0+1)%nx
+	y1=(y0+1)%ny
+	z1=(z0+1)%nz
+	return ((fp[z0,y0,x0]*(1-dx)+fp[z0,y0,x1]*dx)*(1-dy)+(fp[z0,y1,x0]*(1-dx)+fp[z0,y1,x1]*dx)*dy)*(1-dz) + \
+		((fp[z1,y0,x0]*(1-dx)+fp[z1,y0,x1]*dx)*(1-dy)+(fp[z1,y1,x0]*(1-dx)+fp[z1,y1,x1]*dx)*dy)*dz
+
+class FourierSymSearch:
+	"""Finds the orientation which best aligns a volume to a symmetry, without rotating the volume for each candidate. The volume is
+	Fourier transformed once, band limited to Fourier radii rmin-rmax (in pixels, default rmax is nx/4), whitened, and oversampled 2x
+	for interpolation. A candidate orientation is scored by correlating a fixed random subset of npoints Fourier voxels with the same
+	voxels rotated by each symmetry operator (expressed in the candidate frame). The score is the negative mean correlation, so, as
+	with the 'ccc' cmp, smaller is better. Orientations are Transforms which would rotate the volume into the symmetry frame. Rotations
+	are about the box center, translations are not searched."""
+
+	def __init__(self,vol,sym,rmin=2,rmax=0,npoints=2000,threads=1):
+		xf=Transform()
+		syms=[xform_to_mat(xf.get_sym(sym,i)) for i in xrange(xf.get_nsym(sym))]
+		self.sym=sym
+		self.setup(vol.numpy().copy(),syms,rmin,rmax,npoints,threads)
+
+	def setup(self,vol,syms,rmin,rmax,npoints,threads):
+		n=vol.shape[2]
+		if rmax<=0 : rmax=n/4
+		rmax=min(rmax,n/2-2)
+		self.threads=max(1,threads)
+		self.syms=np.array([s for s in syms if not np.allclose(s,np.identity(3))])		# the identity always correlates perfectly
+		if len(self.syms)==0 : raise Exception,"Symmetry search requires a symmetry with more than one operator"
+
+		# band limit by cropping the transform to m pixels (phase origin at the box center), then oversample by padding in real space
+		m=2*(rmax+2)
+		c=n/2
+		f=np.fft.fftshift(np.fft.fftn(np.fft.ifftshift(vol)))[c-m/2:c+m/2,c-m/2:c+m/2,c-m/2:c+m/2]
+		small=np.fft.fftshift(np.fft.ifftn(np.fft.ifftshift(f))).real
+		pad=np.zeros((2*m,2*m,2*m),np.float32)
+		pad[m/2:m/2+m,m/2:m/2+m,m/2:m/2+m]=small
+		fp=np.fft.fftn(np.fft.ifftshift(pad))
+
+		# whiten, so each shell in the band counts equally. Pixel j of the padded transform is frequency j/2
+		fr=np.fft.fftfreq(2*m)*m
+		shell=np.rint(np.sqrt(fr[:,np.newaxis,np.newaxis]**2+fr[np.newaxis,:,np.newaxis]**2+fr[np.newaxis,np.newaxis,:]**2)).astype(int)
+		amp=np.bincount(shell.ravel(),np.abs(fp).ravel())/np.maximum(np.bincount(shell.ravel()),1)
+		amp[amp==0]=1.0
+		self.fp=(fp/amp[shell]).astype(np.complex64)
+
+		# a fixed subset of the Fourier voxels in one half-space within the band. Real maps have Hermitian transforms
+		r=np.arange(-rmax,rmax+1)
+		x,y,z=[a.ravel() for a in np.meshgrid(r,r,r,indexing="ij")]
+		rad=np.sqrt(x**2+y**2+z**2)
+		use=(rad>=rmin)&(rad<=rmax)&((z>0)|((z==0)&(y>0))|((z==0)&(y==0)&(x>0)))
+		pts=np.array((x[use],y[use],z[use]),np.float64).T
+		if len(pts)>npoints : pts=pts[np.random.RandomState(1).permutation(len(pts))[:npoints]]
+		self.pts=pts
+		self.f0=self.fp[(2*pts[:,2]).astype(int)%(2*m),(2*pts[:,1]).astype(int)%(2*m),(2*pts[:,0]).astype(int)%(2*m)]
+		self.norm0=(np.abs(self.f0)**2).sum()
+
+	def score_batch(self,mats):
+		"""Returns the scores for a (n,3,3) array of rotation matrices"""
+		# each symmetry operator S in the frame of candidate T is T^-1 S T
+		rots=np.einsum("bji,sjk,bkl->bsil",mats,self.syms,mats)
+		q=np.einsum("bsil,pl->bspi",rots,self.pts)*2.0
+		g=fourier_sample3(self.fp,q[...,0],q[...,1],q[...,2])
+		ccc=(self.f0*np.conj(g)).real.sum(2)/np.sqrt(self.norm0*(np.abs(g)**2).sum(2))
+		return -ccc.mean(1)
+
+	def score(self,mats):
+		"""Returns the scores for a (n,3,3) array of rotation matrices, computed in batches, distributed over threads"""
+		mats=np.asarray(mats)
+		nbatch=max(1,500000/(len(self.syms)*len(self.pts)))
+		jobs=Queue.Queue()
+		for i in xrange(0,len(mats),nbatch): jobs.put(i)
+		ret=np.zeros(len(mats))
+
+		def worker():
+			while 1:
+				try: i=jobs.get_nowait()
+				except Queue.Empty: return
+				ret[i:i+nbatch]=self.score_batch(mats[i:i+nbatch])
+
+		thrds=[threading.Thread(target=worker) for i in xrange(min(self.threads,jobs.qsize()))]
+		for t in thrds: t.start()
+		for t in thrds: t.join()
+		return ret
+
+	def search(self,delta=10.0,nbest=6,mindelta=0.5):
+		"""Scores a grid of orientations with angular step delta covering one asymmetric unit, then refines the nbest best
+		by hill climbing with a step halved down to mindelta. Returns a sorted list of (score,Transform)"""
+		# Candidates T and S*T are equivalent, so T^-1 only needs to cover one asymmetric unit of orientations (with mirrors)
+		orts=parsesym(self.sym).gen_orientations("eman",{"delta":delta,"inc_mirror":True})
+		mats=[]
+		for o in orts:
+			rot=o.get_rotation("eman")
+			for phi in np.arange(0,360.0-delta/2.0,delta):
+				mats.append(xform_to_mat(Transform({"type":"eman","az":rot["az"],"alt":rot["alt"],"phi":phi}).inverse()))
+		mats=np.array(mats)
+		scores=self.score(mats)
+
+		best=np.argsort(scores)[:nbest]
+		cands=mats[best]
+		cscores=scores[best]
+
+		step=delta/2.0
+		while step>=mindelta:
+			nbr=axis_rotations(step)
+			for it in xrange(20):
+				trials=np.einsum("nij,cjk->cnik",nbr,cands)
+				tscores=self.score(trials.reshape(-1,3,3)).reshape(len(cands),len(nbr))
+				tbest=tscores.argmin(1)
+				better=tscores[np.arange(len(cands)),tbest]<cscores
+				if not better.any() : break
+				cands[better]=trials[better,tbest[better]]
+				cscores[better]=tscores[better,tbest[better]]
+			step/=2.0
+
+		order=np.argsort(cscores)
+		return [(float(cscores[i]),mat_to_xform(cands[i])) for i in order]
+
+
 class SymAlignTask(JSTask):
 	def __init__(self, volume, sym, comp, xform):
 		data = {"volume":volume}
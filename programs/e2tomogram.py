@@ -39,6 +39,32 @@ from EMAN2 import *
 from math import *
 import os
 import sys
+import numpy
+import threading
+
+MABATCH=256		# number of patches in each batch of FFTs in matrixalign
+
+mamasks={}		# cache of patch and CCF masks for matrixalign, keyed by (box,padbox)
+def matrixalign_masks(box,padbox):
+	"""Returns (mask,fft of mask,ccf mask) as numpy arrays for matrixalign. These are computed once for
+	each box/padbox combination."""
+	try: return mamasks[(box,padbox)]
+	except: pass
+
+	bigpad=(padbox-box)/2
+	mask=EMData(padbox,padbox,1)
+	mask.to_one()
+	mask.process_inplace("mask.sharp",{"outer_radius":box/2})
+
+	ccfmask=EMData(padbox,padbox,1)
+	ccfmask.to_one()
+	if bigpad*2>padbox/2 : ccfmask.process_inplace("mask.sharp",{"outer_radius":padbox/2-1})
+	else : ccfmask.process_inplace("mask.sharp",{"outer_radius":bigpad*2})		# max translation
+
+	m=mask.numpy().astype(float)
+	ret=(m,numpy.fft.rfft2(m),ccfmask.numpy().astype(float))
+	mamasks[(box,padbox)]=ret
+	return ret
 
 def matrixalign(im1,im2,box,padbox,maxrange=64,debug=0) :
 	"""This will calculate a set of alignment vectors between two images
@@ -47,7 +73,9 @@ is the size of the expanded box to search for the smaller box in.
 returns a dict of tuples :  (I,x,y,dx,dy)  where I is the alignment peak
 intensity. The key is the box number centered on the origin, ie - (0,0)
 is the alignment of the center of the image (1,0) is one box to the right
-of the center. maxrange allows calculating a limited distance from the center"""
+of the center. maxrange allows calculating a limited distance from the center.
+Patches are extracted into contiguous blocks of MABATCH and all of their CCFs
+are computed with batched FFTs."""
 	sx=im1.get_xsize()
 	sy=im1.get_ysize()
 	bigpad=(padbox-box)/2			# ostensibly this is the max translation we should
@@ -56,50 +84,64 @@ of the center. maxrange allows calculating a limited distance from the center"""
 	ny=int((sy-2*bigpad)/box)*2-1
 	dx=(sx-padbox)/float(nx-1)
 	dy=(sy-padbox)/float(ny-1)
-	ret={}
+
+	locs=[]
 	for y in range(ny):
 		for x in range(nx):
 			if (abs(x-nx/2-1)>maxrange or abs(y-ny/2-1)>maxrange) : continue
-			
-			clip2=im2.get_clip(Region(int(x*dx),int(y*dy),padbox,padbox))
-			# if there are zeroes in the clipped area we don't want to do correlations here
-#			if float(clip2.get_attr("mean"))!=float(clip2.get_attr("mean_nonzero")) # continue
-			
-			clip1=im1.get_clip(Region(int(x*dx),int(y*dy),padbox,padbox))
-			
-			# mask out the center of im1 and find it within im2
-			
-			# note that this normalization, making the masked out region mean value
-			# exactly 0, is critical to obtaining correct alignments, since it insures
-			# that
-			mask=clip1.copy_head()
-			mask.to_one()
-			mask.process_inplace("mask.sharp",{"outer_radius":box/2})
-			clip1*=mask
-			clip1-=float(clip1.get_attr("mean_nonzero"))
-			clip1*=mask
-			
-			clip2.process_inplace("normalize")
-			clip2s=clip2.copy()
-			clip2s.process_inplace("math.squared")
-			
-			ccf=clip1.calc_ccf(clip2,fp_flag.CIRCULANT)
-			ccfs=mask.calc_ccf(clip2s,fp_flag.CIRCULANT)	# this is the sum of the masked values^2 for each pixel center
-			ccfs.process_inplace("math.sqrt")
-			ccf/=ccfs
-	
-			ccf.process_inplace("normalize")		# peaks relative to 1 std-dev
-			if bigpad*2>padbox/2 : ccf.process_inplace("mask.sharp",{"outer_radius":padbox/2-1})
-			else : ccf.process_inplace("mask.sharp",{"outer_radius":bigpad*2})		# max translation
-			ccf.set_value_at(int(padbox/2),int(padbox/2),0,0)		# remove 0 shift artifacts
-			
-			if (debug):
-				clip1.write_image("dbug.hed",-1)
-				clip2.write_image("dbug.hed",-1)
-				ccf.write_image("dbug.hed",-1)
-			maxloc=ccf.calc_max_location()
-			
-			ret[(x-nx/2-1,y-ny/2-1)]=((float(ccf.get_attr("maximum")),x*box+bigpad/2-sx/2,y*box+bigpad/2-sy/2,maxloc[0]-padbox/2,maxloc[1]-padbox/2))
+			locs.append((x,y,int(x*dx),int(y*dy)))
+
+	mask,maskf,ccfmask=matrixalign_masks(box,padbox)
+	a1=im1.numpy()
+	a2=im2.numpy()
+	ret={}
+	for j in xrange(0,len(locs),MABATCH):
+		blk=locs[j:j+MABATCH]
+		clip1=numpy.array([a1[y0:y0+padbox,x0:x0+padbox] for x,y,x0,y0 in blk],dtype=float)
+		clip2=numpy.array([a2[y0:y0+padbox,x0:x0+padbox] for x,y,x0,y0 in blk],dtype=float)
+
+		# mask out the center of im1 and find it within im2
+
+		# note that this normalization, making the masked out region mean value
+		# exactly 0, is critical to obtaining correct alignments, since it insures
+		# that
+		clip1*=mask
+		nnz=numpy.maximum((clip1!=0).sum(axis=(1,2)),1)
+		clip1-=(clip1.sum(axis=(1,2))/nnz)[:,None,None]		# mean_nonzero
+		clip1*=mask
+
+		clip2-=clip2.mean(axis=(1,2))[:,None,None]
+		sig=clip2.std(axis=(1,2),ddof=1)
+		sig[sig==0]=1.0
+		clip2/=sig[:,None,None]
+
+		clip2f=numpy.fft.rfft2(clip2).conj()
+		clip2sf=numpy.fft.rfft2(clip2*clip2).conj()
+		ccf=numpy.fft.irfft2(numpy.fft.rfft2(clip1)*clip2f,(padbox,padbox))
+		ccfs=numpy.fft.irfft2(maskf*clip2sf,(padbox,padbox))	# this is the sum of the masked values^2 for each pixel center
+		ccfs=numpy.maximum(ccfs,ccfs.max(axis=(1,2))[:,None,None]*1.0e-6)		# FFT roundoff can make this slightly negative
+		ccf/=numpy.sqrt(ccfs)
+		ccf=numpy.roll(numpy.roll(ccf,padbox/2,1),padbox/2,2)		# origin to the center, as calc_ccf does
+
+		# peaks relative to 1 std-dev
+		ccf-=ccf.mean(axis=(1,2))[:,None,None]
+		sig=ccf.std(axis=(1,2),ddof=1)
+		sig[sig==0]=1.0
+		ccf/=sig[:,None,None]
+		ccf*=ccfmask
+		ccf[:,padbox/2,padbox/2]=0		# remove 0 shift artifacts
+
+		if (debug):
+			for k in xrange(len(blk)):
+				from_numpy(clip1[k].astype(numpy.float32)).write_image("dbug.hed",-1)
+				from_numpy(clip2[k].astype(numpy.float32)).write_image("dbug.hed",-1)
+				from_numpy(ccf[k].astype(numpy.float32)).write_image("dbug.hed",-1)
+
+		ccf=ccf.reshape((len(blk),padbox*padbox))
+		maxi=ccf.argmax(1)
+		for k,(x,y,x0,y0) in enumerate(blk):
+			my,mx=divmod(int(maxi[k]),padbox)
+			ret[(x-nx/2-1,y-ny/2-1)]=((float(ccf[k,maxi[k]]),x*box+bigpad/2-sx/2,y*box+bigpad/2-sy/2,mx-padbox/2,my-padbox/2))
 
 	return ret
 	
@@ -124,70 +166,28 @@ def mode(vals):
 		
 	return cnt[-1][1]
 	
-def main():
-	progname = os.path.basename(sys.argv[0])
-	usage = """prog [options] input_stack.hed output.hed
-	
-	Fiducial-less alignment of tomograms. This program has many limitations, and is still being developed.
-	Not yet recommended for routine use.
-	"""
-
-	parser = EMArgumentParser(usage=usage,version=EMANVERSION)
-
-	parser.add_argument("--tilt", "-T", type=float, help="Angular spacing between tilts (fixed)",default=0.0)
-	parser.add_argument("--maxshift","-M", type=int, help="Maximum translational error between images (pixels), default=64",default=64.0)
-	parser.add_argument("--box","-B", type=int, help="Box size for alignment probe (pixels), default=96",default=96.0)
-	parser.add_argument("--highpass",type=float,help="Highpass Gaussian processor radius (pixels), default none", default=-1.0)
-	parser.add_argument("--lowpass",type=float,help="Lowpass Gaussian processor radius (pixels), default none",default=-1.0)
-	parser.add_argument("--mode",type=str,help="centering mode 'modeshift', 'censym' or 'region,<x>,<y>,<clipsize>,<alisize>",default="censym")
-	parser.add_argument("--localavg",type=int,help="Average several images for the alignment",default=1)
-	parser.add_argument("--tiltaxis",type=float,help="Skip automatic tilt axis location, use fixed angle from x",default=400.0)
-	parser.add_argument("--twopass",action="store_true",default=False,help="Skip automatic tilt axis location, use fixed angle from x")
-	parser.add_argument("--nozero",action="store_true",default=False,help="Do not allow 0-translations between images")
-	#parser.add_argument("--het", action="store_true", help="Include HET atoms in the map", default=False)
-	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
-	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
-	
-	(options, args) = parser.parse_args()
-	if len(args)<2 : parser.error("Input and output files required")
-	if options.tilt<=0 : parser.error("--tilt must be specified")
-	
-	nimg=EMUtil.get_image_count(args[0])
-	if (nimg<3) : parser.error("Input file must contain at least 3 images")
-	
-#	Log.logger().set_level(Log.LogLevel.VARIABLE_LOG)
-	
+def align_chain(chain,args,nimg,options,iolock):
+	"""Aligns a chain of (reference,image) tilt pairs in order. Each image is aligned to the (already aligned)
+	reference image from the output file, and written to the output file. iolock serializes file access
+	between chains running in different threads."""
+	chain=list(chain)
 	if options.mode[:6]=="region":
 		rgnp=[int(x) for x in options.mode[7:].split(',')]
 		cen=(rgnp[0],rgnp[1])
-		for i in range(nimg):
-			a=EMData()
-			a.read_image(args[0],i)
-			b=a.get_clip(Region(rgnp[0]+a.get_xsize()/2-rgnp[2]/2,rgnp[1]+a.get_ysize()/2-rgnp[2]/2,rgnp[2],rgnp[2]))
-			b.write_image(args[1],i)
-	else:
-		# copy the file with possible format conversion
-		for i in range(nimg):
-			a=EMData()
-			a.read_image(args[0],i)
-			a.write_image(args[1],i)
-		
 
-		
-	cmplist=[(x,x+1) for x in range(nimg/2,nimg-1)]+[(x,x-1) for x in range(nimg/2,0,-1)]
-	if options.twopass : cmplist+=cmplist
 	ii=-1
-	while ii< len(cmplist)-1:
+	while ii< len(chain)-1:
 		ii+=1
-		i=cmplist[ii]
+		i=chain[ii]
 		if options.mode[:6]=="region" : inn=0
 		else : inn=1
 		
 		# read local set of images to average for alignment
-		if i[1]>i[0] :
-			iml=EMData.read_images(args[inn],range(i[0]-options.localavg+1,i[0]+1))
-		else :
-			iml=EMData.read_images(args[inn],range(i[0],i[0]+options.localavg))
+		with iolock:
+			if i[1]>i[0] :
+				iml=EMData.read_images(args[inn],range(i[0]-options.localavg+1,i[0]+1))
+			else :
+				iml=EMData.read_images(args[inn],range(i[0],i[0]+options.localavg))
 		for img in iml:
 			img.process_inplace("normalize.edgemean")
 		im1=iml[0].copy()
@@ -200,7 +200,7 @@ def main():
 		if options.localavg>1: im1.write_image("aliref.hed",i[0])
 		
 		im2=EMData()
-		im2.read_image(args[inn],i[1])
+		with iolock: im2.read_image(args[inn],i[1])
 		im2.process_inplace("normalize.edgemean")
 		if options.highpass>0 : im2.process_inplace("filter.highpass.gauss",{"cutoff_abs":options.highpass})
 		if (options.lowpass>0) : im2.process_inplace("filter.lowpass.gauss",{"cutoff_abs":options.lowpass})
@@ -251,14 +251,15 @@ def main():
 			ccf.process_inplace("mask.sharp",{"outer_radius":options.maxshift})
 			if options.nozero : ccf.set_value_at(ccf.get_xsize()/2,ccf.get_ysize()/2,0,0)
 
-			if i[1] in range(72,77) : ccf.write_image("dbug.hed",-1)
+			if i[1] in range(72,77) :
+				with iolock: ccf.write_image("dbug.hed",-1)
 			maxloc=ccf.calc_max_location()
 			maxloc=(maxloc[0]-im1.get_xsize()/2,maxloc[1]-im1.get_ysize()/2)
 			print maxloc
 			
 			out=im2.get_clip(Region(cen[0]-maxloc[0]-rgnp[2]/2+im2.get_xsize()/2,cen[1]-maxloc[1]-rgnp[2]/2+im2.get_ysize()/2,rgnp[2],rgnp[2]))
 			cen=(cen[0]-maxloc[0],cen[1]-maxloc[1])
-			out.write_image(args[1],i[1])
+			with iolock: out.write_image(args[1],i[1])
 			print "%d.\t%d\t%d"%(i[1],cen[0],cen[1])
 			continue			
 		elif options.mode=="censym" :
@@ -275,8 +276,10 @@ def main():
 			
 			if len(pairs)==0 : 
 				print "Alignment failed on image %d (%d)"%(i[1],i[0])
-				if (i[1]>nimg/2) : cmplist[ii]=(i[0]-1,i[1])
-				else : cmplist[ii]=(i[0]+1,i[1])
+				# retry with a reference closer to the center, but never past it, since the other chain owns those images
+				if i[0]==nimg/2 : continue
+				if (i[1]>nimg/2) : chain[ii]=(i[0]-1,i[1])
+				else : chain[ii]=(i[0]+1,i[1])
 				if abs(i[0]-i[1])<5 : ii-=1
 				continue
 			else :
@@ -302,10 +305,76 @@ def main():
 		print "%d.\t%5.2f\t%5.2f"%(i[1],best[0],best[1])
 		im2.rotate_translate(0,0,0,best[0],best[1],0)
 		im2.process_inplace("normalize")
-		im2.write_image(args[1],i[1])
+		with iolock: im2.write_image(args[1],i[1])
+
+def main():
+	progname = os.path.basename(sys.argv[0])
+	usage = """prog [options] input_stack.hed output.hed
+	
+	Fiducial-less alignment of tomograms. This program has many limitations, and is still being developed.
+	Not yet recommended for routine use.
+	"""
+
+	parser = EMArgumentParser(usage=usage,version=EMANVERSION)
+
+	parser.add_argument("--tilt", "-T", type=float, help="Angular spacing between tilts (fixed)",default=0.0)
+	parser.add_argument("--maxshift","-M", type=int, help="Maximum translational error between images (pixels), default=64",default=64.0)
+	parser.add_argument("--box","-B", type=int, help="Box size for alignment probe (pixels), default=96",default=96.0)
+	parser.add_argument("--highpass",type=float,help="Highpass Gaussian processor radius (pixels), default none", default=-1.0)
+	parser.add_argument("--lowpass",type=float,help="Lowpass Gaussian processor radius (pixels), default none",default=-1.0)
+	parser.add_argument("--mode",type=str,help="centering mode 'modeshift', 'censym' or 'region,<x>,<y>,<clipsize>,<alisize>",default="censym")
+	parser.add_argument("--localavg",type=int,help="Average several images for the alignment",default=1)
+	parser.add_argument("--tiltaxis",type=float,help="Skip automatic tilt axis location, use fixed angle from x",default=400.0)
+	parser.add_argument("--twopass",action="store_true",default=False,help="Skip automatic tilt axis location, use fixed angle from x")
+	parser.add_argument("--nozero",action="store_true",default=False,help="Do not allow 0-translations between images")
+	#parser.add_argument("--het", action="store_true", help="Include HET atoms in the map", default=False)
+	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
+	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
+	
+	(options, args) = parser.parse_args()
+	if len(args)<2 : parser.error("Input and output files required")
+	if options.tilt<=0 : parser.error("--tilt must be specified")
+	
+	nimg=EMUtil.get_image_count(args[0])
+	if (nimg<3) : parser.error("Input file must contain at least 3 images")
+	
+#	Log.logger().set_level(Log.LogLevel.VARIABLE_LOG)
+	
+	if options.mode[:6]=="region":
+		rgnp=[int(x) for x in options.mode[7:].split(',')]
+		cen=(rgnp[0],rgnp[1])
+		for i in range(nimg):
+			a=EMData()
+			a.read_image(args[0],i)
+			b=a.get_clip(Region(rgnp[0]+a.get_xsize()/2-rgnp[2]/2,rgnp[1]+a.get_ysize()/2-rgnp[2]/2,rgnp[2],rgnp[2]))
+			b.write_image(args[1],i)
+	else:
+		# copy the file with possible format conversion
+		for i in range(nimg):
+			a=EMData()
+			a.read_image(args[0],i)
+			a.write_image(args[1],i)
+		
+
+		
+	# The tilts on either side of the center are aligned outward from the center in two independent chains
+	# which run concurrently
+	chains=[[(x,x+1) for x in range(nimg/2,nimg-1)],[(x,x-1) for x in range(nimg/2,0,-1)]]
+	iolock=threading.Lock()
+	if options.localavg>1 :
+		# local averages near the center use images from both sides, so we can't run the chains concurrently.
+		# With --twopass, both sides are completed before the second pass, as the second pass references depend on that
+		for p in range(2 if options.twopass else 1):
+			for c in chains: align_chain(c,args,nimg,options,iolock)
+	else:
+		if options.twopass : chains=[c+c for c in chains]
+		thrds=[threading.Thread(target=align_chain,args=(c,args,nimg,options,iolock)) for c in chains]
+		for t in thrds: t.start()
+		for t in thrds: t.join()
 	
 	print "Alignment Stage Complete"
 	
+	im1=EMData()
 	if options.tiltaxis!=400.0 :
 		tiltaxis=(0,options.tiltaxis)
 	else: